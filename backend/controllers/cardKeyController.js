@@ -1,4 +1,5 @@
 const CardKey = require('../models/CardKey');
+const { signLicenseToken, getPublicKey, getKeyEndorsement } = require('../utils/licenseToken');
 
 // 生成随机卡密
 const generateRandomKey = (format = 'XXXX-XXXX-XXXX-XXXX') => {
@@ -171,7 +172,7 @@ exports.deleteCardKey = async (req, res) => {
 // @access  公开
 exports.verifyCardKey = async (req, res) => {
   try {
-    const { key, userIdentifier } = req.body;
+    const { key, userIdentifier, hardwareId } = req.body;
     
     if (!key) {
       return res.status(400).json({
@@ -233,7 +234,13 @@ exports.verifyCardKey = async (req, res) => {
         useTime: cardKey.useTime,
         expiryTime: cardKey.expiryTime,
         cardType: cardKey.cardType
-      }
+      },
+      // 客户端用公钥离线验证的授权令牌，绑定卡密、硬件ID和到期时间
+      token: signLicenseToken({
+        key: cardKey.key,
+        hardwareId,
+        expiryTime: cardKey.expiryTime
+      })
     });
   } catch (error) {
     console.error('Verify card key error:', error);
@@ -244,6 +251,29 @@ exports.verifyCardKey = async (req, res) => {
   }
 };
 
+// @desc    获取授权令牌的签名公钥
+// @route   GET /api/card-keys/public-key
+// @access  公开
+exports.getLicensePublicKey = (req, res) => {
+  try {
+    res.status(200).json({
+      success: true,
+      data: {
+        algorithm: 'Ed25519',
+        publicKey: getPublicKey(),
+        // 根私钥对签名公钥的背书，客户端只接受带有效背书（或与固定根公钥相同）的公钥
+        endorsement: getKeyEndorsement()
+      }
+    });
+  } catch (error) {
+    console.error('Get license public key error:', error);
+    res.status(500).json({
+      success: false,
+      message: '服务器错误'
+    });
+  }
+};
+
 // @desc    获取卡密统计信息
 // @route   GET /api/card-keys/statistics
 // @access  私有
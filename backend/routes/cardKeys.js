@@ -5,6 +5,7 @@ const {
   generateCardKeys, 
   deleteCardKey, 
   verifyCardKey, 
+  getLicensePublicKey,
   getStatistics,
   getVerificationLogs 
 } = require('../controllers/cardKeyController');
@@ -12,6 +13,7 @@ const { protect, admin } = require('../middlewares/auth');
 
 // 公开路由
 router.post('/verify', verifyCardKey);
+router.get('/public-key', getLicensePublicKey);
 
 // 受保护路由
 router.get('/', protect, getCardKeys);
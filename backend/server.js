@@ -2,10 +2,19 @@ const express = require('express');
 const mongoose = require('mongoose');
 const cors = require('cors');
 const dotenv = require('dotenv');
+const { loadKeys } = require('./utils/licenseToken');
 
 // 配置环境变量
 dotenv.config();
 
+// 授权令牌签名私钥必须预先配置，缺少时拒绝启动
+try {
+  loadKeys();
+} catch (err) {
+  console.error('授权令牌签名密钥加载失败:', err.message);
+  process.exit(1);
+}
+
 // 初始化Express应用
 const app = express();
 
@@ -0,0 +1,78 @@
+const crypto = require('crypto');
+const fs = require('fs');
+const path = require('path');
+
+// 授权令牌：base64url(JSON载荷).base64url(Ed25519签名)，签名对象为载荷部分的字符串
+// 客户端用服务器公钥离线验证卡密、硬件ID和到期时间，无需再次请求验证接口
+const TOKEN_VERSION = 1;
+
+// 签名私钥：优先使用环境变量 LICENSE_PRIVATE_KEY（PEM），否则读取 LICENSE_KEY_FILE 指定的文件
+// （默认 backend/license_ed25519.pem），都没有时服务器拒绝启动。客户端固定了根公钥，
+// 服务器不能自行生成密钥，否则签发的令牌不会被客户端接受
+const KEY_FILE = process.env.LICENSE_KEY_FILE || path.join(__dirname, '..', 'license_ed25519.pem');
+
+// 签名私钥不是客户端固定的根私钥时，LICENSE_KEY_ENDORSEMENT 为根私钥对
+// ENDORSEMENT_PREFIX + 签名公钥（base64url）的签名（base64url），客户端验证背书后才接受这个公钥
+const ENDORSEMENT_PREFIX = 'kami-license-key:v1:';
+
+let privateKey = null;
+let publicKey = null;
+let endorsement = null;
+
+// 加载签名私钥，未配置或格式错误时抛出异常；服务器启动时调用
+const loadKeys = () => {
+  if (privateKey) return;
+
+  let pem;
+  if (process.env.LICENSE_PRIVATE_KEY) {
+    pem = process.env.LICENSE_PRIVATE_KEY.replace(/\\n/g, '\n');
+  } else if (fs.existsSync(KEY_FILE)) {
+    pem = fs.readFileSync(KEY_FILE);
+  } else {
+    throw new Error(`未配置授权令牌签名私钥：请设置 LICENSE_PRIVATE_KEY，或把私钥放在 ${KEY_FILE}`);
+  }
+
+  const key = crypto.createPrivateKey(pem);
+  if (key.asymmetricKeyType !== 'ed25519') {
+    throw new Error(`授权令牌签名私钥必须是 Ed25519 密钥，当前为 ${key.asymmetricKeyType}`);
+  }
+  privateKey = key;
+  // JWK 的 x 字段即 base64url 编码的32字节原始公钥
+  publicKey = crypto.createPublicKey(privateKey).export({ format: 'jwk' }).x;
+  endorsement = process.env.LICENSE_KEY_ENDORSEMENT || null;
+};
+
+exports.loadKeys = loadKeys;
+
+// 用根私钥（PEM）为签名公钥生成背书，结果填入签名服务器的 LICENSE_KEY_ENDORSEMENT
+exports.endorsePublicKey = (rootPrivateKeyPem, signingPublicKey) =>
+  crypto.sign(null, Buffer.from(ENDORSEMENT_PREFIX + signingPublicKey), crypto.createPrivateKey(rootPrivateKeyPem))
+    .toString('base64url');
+
+// 获取 base64url 编码的原始公钥
+exports.getPublicKey = () => {
+  loadKeys();
+  return publicKey;
+};
+
+// 获取签名公钥的根私钥背书，签名私钥就是根私钥时为 null
+exports.getKeyEndorsement = () => {
+  loadKeys();
+  return endorsement;
+};
+
+// 签发授权令牌，exp 为到期时间的Unix时间戳（秒）
+exports.signLicenseToken = ({ key, hardwareId, expiryTime }) => {
+  loadKeys();
+
+  const payload = {
+    v: TOKEN_VERSION,
+    key,
+    hwid: hardwareId || '',
+    exp: Math.floor(new Date(expiryTime).getTime() / 1000),
+    iat: Math.floor(Date.now() / 1000)
+  };
+  const encoded = Buffer.from(JSON.stringify(payload)).toString('base64url');
+  const signature = crypto.sign(null, Buffer.from(encoded), privateKey).toString('base64url');
+  return `${encoded}.${signature}`;
+};
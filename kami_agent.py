@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+卡密本地授权代理
+一台机器上运行一个常驻代理进程，负责采集硬件ID、解密 verification.bin、定期检查本地验证，
+并持有唯一的验证服务器连接。各个机器人进程通过 Unix 套接字（Windows 为命名管道）向代理查询，
+不再各自派生密钥、解密文件和运行心跳线程，也不会同时读写验证文件。
+
+代理未运行时，客户端连接失败，影刀模块的 KamiSDK 会自动改为在本进程内验证。
+
+用法:
+    python kami_agent.py                 # 在当前目录的 verification.bin 上启动代理
+    python kami_agent.py --status        # 查询正在运行的代理
+    python kami_agent.py --stop          # 停止代理
+
+通信格式：每条消息是一个JSON对象，通过 multiprocessing.connection 的 send_bytes/recv_bytes 收发，
+不使用 pickle。请求为 {"cmd": 命令, ...参数}，响应为 {"ok": true, "result": ...} 或 {"ok": false, "error": 消息}。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+from typing import Dict, Any, Optional, Tuple
+
+from kami_transport import verify_card_key_request
+from verification_utils import (
+    DEFAULT_API_URL, DEFAULT_VERIFICATION_FILE, FileLockTimeout, FileWatcher, KamiVerifier, enable_timings,
+    get_record_expires_at, get_stats
+)
+
+# 默认配置
+DEFAULT_REFRESH_INTERVAL = 60  # 代理重新读取验证文件的间隔（秒）
+DEFAULT_REQUEST_TIMEOUT = 15.0  # 客户端等待代理响应的时间（秒），验证请求需要访问服务器
+DEFAULT_RETRY_INTERVAL = 30.0  # 连接代理失败后，多久之后再尝试连接（秒）
+CONNECTION_POLL_INTERVAL = 0.5  # 服务端检查是否已停止的间隔（秒）
+AGENT_ADDRESS_ENV = 'KAMI_AGENT_ADDRESS'
+
+
+def get_agent_address() -> str:
+    """
+    代理的监听地址，可以通过环境变量 KAMI_AGENT_ADDRESS 指定
+
+    Windows 使用当前用户的命名管道，其他系统使用临时目录中当前用户的Unix套接字。
+    """
+    address = os.environ.get(AGENT_ADDRESS_ENV)
+    if address:
+        return address
+    if sys.platform == 'win32':
+        user = os.environ.get('USERNAME', 'default')
+        return r'\\.\pipe\kami_agent_' + user
+    return os.path.join(tempfile.gettempdir(), f'kami_agent_{os.getuid()}.sock')
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class AgentError(Exception):
+    """代理返回错误或连接中断"""
+
+
+class AgentClient:
+    """
+    代理客户端，保持一个长连接，线程安全
+
+    连接断开时自动重连一次；代理不存在时 connect() 返回False。
+    """
+
+    def __init__(self, address: Optional[str] = None, timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        self.address = address or get_agent_address()
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> bool:
+        """连接代理，成功返回True"""
+        with self._lock:
+            return self._connect()
+
+    def _connect(self) -> bool:
+        if self._conn is not None:
+            return True
+        try:
+            self._conn = Client(self.address)
+            return True
+        except (OSError, EOFError):
+            self._conn = None
+            return False
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
+    def request(self, cmd: str, **params) -> Any:
+        """发送命令并返回结果，代理返回错误时抛出 AgentError"""
+        message = dict(params, cmd=cmd)
+        with self._lock:
+            for attempt in range(2):
+                if not self._connect():
+                    raise AgentError('无法连接授权代理')
+                try:
+                    self._conn.send_bytes(_encode(message))
+                    if not self._conn.poll(self.timeout):
+                        self._close()
+                        raise AgentError('授权代理响应超时')
+                    response = json.loads(self._conn.recv_bytes())
+                    break
+                except (OSError, EOFError):
+                    # 代理重启后旧连接失效，重连后再试一次
+                    self._close()
+                    if attempt:
+                        raise AgentError('与授权代理的连接已断开')
+        if not response.get('ok'):
+            raise AgentError(response.get('error', '授权代理返回错误'))
+        return response.get('result')
+
+    def ping(self) -> bool:
+        try:
+            return self.request('ping') == 'pong'
+        except AgentError:
+            return False
+
+    def hello(self) -> Dict[str, Any]:
+        """查询代理使用的验证文件（绝对路径）和验证API地址"""
+        return self.request('hello')
+
+    def status(self) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """查询本地验证状态，返回 (是否有效, 验证记录)"""
+        result = self.request('status')
+        return result['verified'], result['record']
+
+    def verify(self, key: str, user_identifier: str = '', use_negative_cache: bool = True) -> Dict[str, Any]:
+        """通过代理验证卡密，成功时由代理保存验证信息（结果带有 saved=True）"""
+        return self.request('verify', key=key, user_identifier=user_identifier,
+                            use_negative_cache=use_negative_cache)
+
+    def save(self, result: Dict[str, Any], user_identifier: str = '') -> bool:
+        """让代理保存一次验证结果，result 中的 validated_at 会原样保存"""
+        return self.request('save', result=result, user_identifier=user_identifier)
+
+    def activate(self, key: str, user_identifier: str = '') -> Optional[Dict[str, Any]]:
+        """切换到授权库中之前验证过的卡密，不访问网络，没有有效记录时返回None"""
+        return self.request('activate', key=key, user_identifier=user_identifier)
+
+    def clear(self, key: str = '', user_identifier: str = '') -> bool:
+        """删除代理保存的验证信息，指定卡密时同时从授权库中删除"""
+        return self.request('clear', key=key, user_identifier=user_identifier)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.request('stats')
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+
+_agent_client: Optional[AgentClient] = None
+_agent_checked_at = 0.0
+_agent_lock = threading.Lock()
+
+
+def get_agent_client(retry_interval: float = DEFAULT_RETRY_INTERVAL) -> Optional[AgentClient]:
+    """
+    获取已连接的代理客户端，代理未运行时返回None
+
+    连接失败后 retry_interval 秒内不再尝试，避免每次验证都去连接不存在的代理。
+    """
+    global _agent_client, _agent_checked_at
+    with _agent_lock:
+        if _agent_client is not None:
+            return _agent_client
+        now = time.monotonic()
+        if _agent_checked_at and now - _agent_checked_at < retry_interval:
+            return None
+        _agent_checked_at = now
+        client = AgentClient()
+        if client.connect():
+            _agent_client = client
+        return _agent_client
+
+
+class LicenseAgent:
+    """授权代理服务端，验证状态保存在内存中，状态查询不读取文件"""
+
+    def __init__(self,
+                 address: Optional[str] = None,
+                 api_url: str = DEFAULT_API_URL,
+                 verification_file: str = DEFAULT_VERIFICATION_FILE,
+                 refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+                 watch: bool = True,
+                 multi_license: bool = False):
+        self.address = address or get_agent_address()
+        self.refresh_interval = refresh_interval
+        # 监控验证文件，其他进程修改或删除后立即刷新，不必等到下一次定时刷新
+        self.watch = watch
+        self._watcher: Optional[FileWatcher] = None
+        self.verifier = KamiVerifier(api_url=api_url, verification_file=os.path.abspath(verification_file),
+                                     multi_license=multi_license)
+        self.started_at = time.time()
+        self.request_count = 0
+        self._verified = False
+        self._record: Optional[Dict[str, Any]] = None
+        self._state_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener: Optional[Listener] = None
+
+    def refresh(self) -> None:
+        """重新读取并解密验证文件，检查硬件ID和授权令牌；文件暂时无法读取时保留原来的状态"""
+        try:
+            verified, record = self.verifier.is_verified()
+        except FileLockTimeout as e:
+            print(f"验证文件暂时无法读取: {e}")
+            return
+        with self._state_lock:
+            self._verified = verified
+            self._record = record
+
+    def status(self) -> Dict[str, Any]:
+        """只在内存中检查到期时间，不读取文件"""
+        with self._state_lock:
+            verified, record = self._verified, self._record
+        expires_at = get_record_expires_at(record)
+        if expires_at is not None and expires_at < time.time():
+            verified = False
+        return {'verified': verified, 'record': record}
+
+    def handle(self, message: Dict[str, Any]) -> Any:
+        """执行一条命令"""
+        cmd = message.get('cmd')
+        if cmd == 'ping':
+            return 'pong'
+        if cmd == 'hello':
+            # 客户端据此确认代理管理的是同一个验证文件和验证API
+            return {'verification_file': self.verifier.verification_file, 'api_url': self.verifier.api_url}
+        if cmd == 'status':
+            return self.status()
+        if cmd == 'verify':
+            key = message.get('key', '')
+            user_identifier = message.get('user_identifier', '')
+            if message.get('use_negative_cache', True):
+                result = self.verifier.verify_card_key(key, user_identifier)
+            else:
+                # 后台复验需要服务器的最新状态，不使用失败缓存
+                result = verify_card_key_request(key, user_identifier, self.verifier.api_url,
+                                                 self.verifier.transport, use_negative_cache=False)
+                if result.get('success', False):
+                    self.verifier.save_verification_data(result, user_identifier, sync=True)
+            if result.get('success', False):
+                self.refresh()
+                result = dict(result, saved=True)
+            return result
+        if cmd == 'save':
+            saved = self.verifier.save_verification_data(dict(message.get('result') or {}),
+                                                         message.get('user_identifier', ''),
+                                                         sync=bool(message.get('sync')))
+            self.refresh()
+            return saved
+        if cmd == 'activate':
+            record = self.verifier.activate_license(message.get('key', ''), message.get('user_identifier', ''))
+            if record is not None:
+                self.refresh()
+            return record
+        if cmd == 'clear':
+            cleared = self.verifier.clear_verification_data()
+            if message.get('key'):
+                self.verifier.remove_license(message['key'], message.get('user_identifier', ''))
+            self.refresh()
+            return cleared
+        if cmd == 'stats':
+            return {
+                'pid': os.getpid(),
+                'address': self.address,
+                'uptime': time.time() - self.started_at,
+                'requests': self.request_count,
+                'verification_file': self.verifier.verification_file,
+                'network': self.verifier.transport.get_stats(),
+                'breaker': self.verifier.get_breaker_state(),
+                'file_lock': self.verifier.writer.lock.get_stats(),
+                'file_watcher': self._watcher.backend if self._watcher is not None else None,
+                'timings': get_stats(),
+            }
+        if cmd == 'shutdown':
+            threading.Thread(target=self.stop, daemon=True).start()
+            return True
+        raise ValueError(f'未知命令: {cmd}')
+
+    def _serve_connection(self, conn) -> None:
+        with conn:
+            while not self._stop.is_set():
+                try:
+                    # 定期醒来检查是否已停止，有请求时 poll 立即返回，不增加响应时间
+                    if not conn.poll(CONNECTION_POLL_INTERVAL):
+                        continue
+                    raw = conn.recv_bytes()
+                except (EOFError, OSError):
+                    return
+                self.request_count += 1
+                try:
+                    response = {'ok': True, 'result': self.handle(json.loads(raw))}
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+                try:
+                    conn.send_bytes(_encode(response))
+                except OSError:
+                    return
+
+    def _on_file_changed(self, path: str) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"刷新验证状态失败: {e}")
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"刷新验证状态失败: {e}")
+
+    def stop(self) -> None:
+        """停止代理，已连接的客户端随后改为在本进程内验证"""
+        self._stop.set()
+        # 连接一次自己，唤醒阻塞在 accept() 的主循环
+        try:
+            Client(self.address).close()
+        except (OSError, EOFError):
+            pass
+
+    def _remove_stale_socket(self) -> None:
+        """上次异常退出留下的Unix套接字文件会导致无法监听，确认没有代理在用后删除"""
+        if sys.platform == 'win32' or not os.path.exists(self.address):
+            return
+        if AgentClient(self.address).connect():
+            raise RuntimeError(f'授权代理已在运行: {self.address}')
+        os.remove(self.address)
+
+    def serve_forever(self) -> None:
+        """启动代理并处理请求，直到收到 shutdown 命令"""
+        self._remove_stale_socket()
+        self.refresh()
+        old_umask = os.umask(0o077) if sys.platform != 'win32' else None
+        try:
+            self._listener = Listener(self.address)
+        finally:
+            if old_umask is not None:
+                os.umask(old_umask)
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        if self.watch:
+            self._watcher = FileWatcher(self.verifier.verification_file, self._on_file_changed).start()
+        print(f"授权代理已启动: {self.address}，硬件ID: {self.verifier.hardware_id[:8]}...")
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn = self._listener.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            self._stop.set()
+            if self._watcher is not None:
+                self._watcher.stop()
+            self._listener.close()
+            print("授权代理已停止")
+
+
+def main(argv=None) -> int:
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='卡密本地授权代理')
+    parser.add_argument('--address', help='监听地址，默认为当前用户的Unix套接字或命名管道')
+    parser.add_argument('--api-url', default=DEFAULT_API_URL, help='验证API地址')
+    parser.add_argument('--file', default=DEFAULT_VERIFICATION_FILE, help='验证文件路径')
+    parser.add_argument('--refresh', type=float, default=DEFAULT_REFRESH_INTERVAL, help='重新读取验证文件的间隔（秒）')
+    parser.add_argument('--no-watch', action='store_true', help='不监控验证文件变化，只按 --refresh 间隔刷新')
+    parser.add_argument('--timings', action='store_true', help='统计各阶段耗时（--status 中查看）')
+    parser.add_argument('--multi-license', action='store_true', help='每次验证成功都记入多卡密授权库')
+    parser.add_argument('--status', action='store_true', help='查询正在运行的代理')
+    parser.add_argument('--stop', action='store_true', help='停止正在运行的代理')
+    args = parser.parse_args(argv)
+
+    if args.status or args.stop:
+        client = AgentClient(args.address)
+        if not client.connect():
+            print("授权代理未运行")
+            return 1
+        if args.stop:
+            client.request('shutdown')
+            print("授权代理已停止")
+        else:
+            print(json.dumps({'status': client.request('status'), 'stats': client.stats()},
+                             ensure_ascii=False, indent=2))
+        client.close()
+        return 0
+
+    if args.timings:
+        enable_timings()
+    agent = LicenseAgent(args.address, args.api_url, args.file, args.refresh, watch=not args.no_watch,
+                         multi_license=args.multi_license)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+卡密验证异步客户端
+在 asyncio 事件循环中验证卡密：网络请求使用 asyncio 长连接，文件读写和密钥派生放到线程池执行，
+心跳检测是一个 asyncio 任务而不是线程。
+"""
+
+import asyncio
+import copy
+import json
+import ssl
+import time
+from collections import deque
+from typing import Dict, Any, Optional, Tuple, Callable
+from urllib.parse import urlsplit
+
+from kami_transport import (
+    DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_POOL_SIZE,
+    TransportStats, CircuitBreaker, NegativeCache, CircuitOpenError
+)
+from verification_utils import (
+    DEFAULT_API_URL, DEFAULT_VERIFICATION_FILE, DEFAULT_LEGACY_FILE,
+    FileLockTimeout, KamiVerifier, KdfParams, get_record_expires_at
+)
+
+# 心跳检测间隔（秒），临近到期时会提前到到期时刻检查
+DEFAULT_HEARTBEAT_INTERVAL = 300
+
+
+class AsyncHTTPError(Exception):
+    """HTTP响应格式错误或连接被意外关闭"""
+
+
+class AsyncKamiTransport:
+    """基于 asyncio.open_connection 的HTTP/1.1传输，按主机复用长连接"""
+
+    def __init__(self,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.stats = TransportStats()
+        self.breaker = CircuitBreaker()
+        self.negative_cache = NegativeCache()
+        self._idle: Dict[Tuple[str, str, int], deque] = {}
+
+    async def _connect(self, scheme: str, host: str, port: int):
+        ssl_context = ssl.create_default_context() if scheme == 'https' else None
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context),
+            self.connect_timeout
+        )
+
+    def _acquire(self, pool_key: Tuple[str, str, int]):
+        """取出一个空闲连接，跳过已被服务器关闭的，没有可用连接时返回None"""
+        idle = self._idle.get(pool_key)
+        while idle:
+            reader, writer = idle.popleft()
+            if writer.is_closing() or reader.at_eof():
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    def _release(self, pool_key: Tuple[str, str, int], reader, writer) -> None:
+        idle = self._idle.setdefault(pool_key, deque())
+        if len(idle) < self.pool_size and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_response(self, reader) -> Tuple[int, Dict[str, str], bytes]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise AsyncHTTPError('连接已被服务器关闭')
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise AsyncHTTPError(f'无效的状态行: {status_line!r}')
+        status = int(parts[1])
+
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            headers['connection'] = 'close'
+        return status, headers, body
+
+    async def _send(self, url: str, payload: Dict[str, Any]) -> Tuple[int, bytes]:
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        pool_key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        body = json.dumps(payload).encode('utf-8')
+        request = (
+            f'POST {path} HTTP/1.1\r\n'
+            f'Host: {parts.netloc}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: keep-alive\r\n'
+            '\r\n'
+        ).encode('latin-1') + body
+
+        connection = self._acquire(pool_key)
+        reused = connection is not None
+        reader, writer = connection or await self._connect(scheme, parts.hostname, port)
+        try:
+            writer.write(request)
+            await writer.drain()
+        except ConnectionError as e:
+            writer.close()
+            if reused:
+                # 请求还没有发出，服务器不可能处理过，换新连接重发一次
+                return await self._send_fresh(url, payload)
+            raise AsyncHTTPError(str(e)) from e
+        except BaseException:
+            writer.close()
+            raise
+        try:
+            status, headers, response_body = await asyncio.wait_for(self._read_response(reader), self.read_timeout)
+        except (AsyncHTTPError, ConnectionError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            # 请求已经发出，服务器可能已处理（卡密已激活）后才断开连接，重发会得到"卡密已被使用"，不重发
+            raise AsyncHTTPError(str(e)) from e
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self._release(pool_key, reader, writer)
+        return status, response_body
+
+    async def _send_fresh(self, url: str, payload: Dict[str, Any]) -> Tuple[int, bytes]:
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        for _, writer in self._idle.pop((scheme, parts.hostname, port), ()):
+            writer.close()
+        return await self._send(url, payload)
+
+    async def post_json(self, url: str, payload: Dict[str, Any]) -> Tuple[int, bytes]:
+        """发送JSON POST请求，返回 (状态码, 响应体)；熔断器打开时抛出 CircuitOpenError"""
+        allowed, probe = self.breaker.allow_request()
+        if not allowed:
+            retry_after = self.breaker.to_dict()['retry_after']
+            raise CircuitOpenError(f'验证服务暂时不可用，请{retry_after:.0f}秒后重试')
+
+        start = time.perf_counter()
+        try:
+            try:
+                status, body = await self._send(url, payload)
+            except (OSError, asyncio.TimeoutError, AsyncHTTPError) as e:
+                self.stats.record(url, time.perf_counter() - start, error=type(e).__name__)
+                self.breaker.record_failure(type(e).__name__)
+                raise
+            self.stats.record(url, time.perf_counter() - start, status=status)
+            if status >= 500:
+                self.breaker.record_failure(f'HTTP {status}')
+            else:
+                self.breaker.record_success()
+            return status, body
+        finally:
+            # 探测请求被取消等情况下没有记录结果，释放半开状态的探测名额
+            if probe:
+                self.breaker.release_probe()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取请求耗时统计"""
+        return self.stats.to_dict()
+
+    async def close(self) -> None:
+        """关闭所有空闲连接"""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except (OSError, ConnectionError):
+                    pass
+
+
+async def verify_card_key_request(key: str,
+                                  user_identifier: str = '',
+                                  api_url: str = DEFAULT_API_URL,
+                                  transport: Optional[AsyncKamiTransport] = None,
+                                  hardware_id: str = '') -> Dict[str, Any]:
+    """
+    异步调用验证API，返回值与 kami_transport.verify_card_key_request 相同
+    """
+    transport = transport or AsyncKamiTransport()
+    cached = transport.negative_cache.get(api_url, key)
+    if cached is not None:
+        return cached
+
+    try:
+        payload = {'key': key, 'userIdentifier': user_identifier}
+        if hardware_id:
+            payload['hardwareId'] = hardware_id
+        status, body = await transport.post_json(api_url, payload)
+
+        if status == 200:
+            return json.loads(body)
+        else:
+            try:
+                message = json.loads(body).get('message')
+            except (ValueError, AttributeError):
+                message = None
+            result = {
+                'success': False,
+                'message': message or f'API错误: HTTP {status}',
+                'status_code': status
+            }
+            transport.negative_cache.put(api_url, key, result)
+            return result
+
+    except CircuitOpenError as e:
+        return {'success': False, 'message': str(e), 'circuit_open': True}
+    except asyncio.TimeoutError:
+        return {'success': False, 'message': '连接超时，请检查网络'}
+    except (OSError, AsyncHTTPError):
+        return {'success': False, 'message': '连接失败，请检查网络或API地址'}
+    except json.JSONDecodeError:
+        return {'success': False, 'message': 'API返回的数据格式错误'}
+    except Exception as e:
+        return {'success': False, 'message': f'未知错误: {str(e)}'}
+
+
+class AsyncKamiVerifier:
+    """
+    KamiVerifier 的异步版本
+
+    网络请求在事件循环中完成；硬件ID采集、密钥派生和验证文件读写仍由 KamiVerifier 完成，
+    通过线程池执行，不阻塞事件循环。
+    """
+
+    def __init__(self,
+                 api_url: str = DEFAULT_API_URL,
+                 verification_file: str = DEFAULT_VERIFICATION_FILE,
+                 legacy_file: str = DEFAULT_LEGACY_FILE,
+                 kdf: Optional[KdfParams] = None,
+                 transport: Optional[AsyncKamiTransport] = None):
+        self.api_url = api_url
+        self.verification_file = verification_file
+        self.legacy_file = legacy_file
+        self.kdf = kdf
+        self.transport = transport or AsyncKamiTransport()
+        self._verifier: Optional[KamiVerifier] = None
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _get_verifier(self) -> KamiVerifier:
+        # 构造 KamiVerifier 时会采集硬件ID，同样放到线程池
+        if self._verifier is None:
+            self._verifier = await self._run_blocking(
+                lambda: KamiVerifier(self.api_url, self.verification_file, self.legacy_file, self.kdf)
+            )
+        return self._verifier
+
+    async def verify(self, key: str, user_identifier: str = '') -> Dict[str, Any]:
+        """验证卡密，成功时保存验证信息；同一卡密的并发调用共享一次请求，每个调用者得到结果的副本"""
+        flight_key = (key, user_identifier)
+        future = self._inflight.get(flight_key)
+        if future is not None:
+            return copy.deepcopy(await asyncio.shield(future))
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[flight_key] = future
+        try:
+            # 服务器把硬件ID写入授权令牌，请求前先取得硬件ID
+            verifier = await self._get_verifier()
+            result = await verify_card_key_request(key, user_identifier, self.api_url, self.transport,
+                                                   verifier.hardware_id)
+            if result.get('success', False):
+                await self._run_blocking(verifier.save_verification_data, result)
+            future.set_result(result)
+            return copy.deepcopy(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            del self._inflight[flight_key]
+
+    async def is_verified(self) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """检查本地验证是否有效"""
+        verifier = await self._get_verifier()
+        return await self._run_blocking(verifier.is_verified)
+
+    async def get_hardware_id(self) -> str:
+        verifier = await self._get_verifier()
+        return verifier.hardware_id
+
+    async def close(self) -> None:
+        await self.transport.close()
+
+
+class AsyncKamiSDK:
+    """
+    异步卡密SDK，供 asyncio 程序同时管理多个会话使用
+
+    与影刀模块的 KamiSDK 流程一致：本地验证有效且卡密相同时直接登录，否则在线验证；
+    登录后启动心跳任务，本地验证失效时调用 heartbeat_callback(错误编码, 错误消息) 并退出登录。
+    """
+
+    def __init__(self,
+                 verifier: Optional[AsyncKamiVerifier] = None,
+                 heartbeat_callback: Optional[Callable[[int, str], Any]] = None,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL):
+        self.verifier = verifier or AsyncKamiVerifier()
+        self.heartbeat_callback = heartbeat_callback
+        self.heartbeat_interval = heartbeat_interval
+        self.is_login = False
+        self.current_key = ''
+        self.login_data: Optional[Dict[str, Any]] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    async def verify(self, key: str, user_identifier: str = '') -> Dict[str, Any]:
+        return await self.verifier.verify(key, user_identifier)
+
+    async def is_verified(self) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        return await self.verifier.is_verified()
+
+    async def login(self, card_key: str, user_identifier: str = '') -> Dict[str, Any]:
+        """
+        卡密登录
+
+        返回:
+            dict: success、message，成功时 data 为卡密信息
+        """
+        async with self._lock:
+            if self.is_login:
+                return {'success': False, 'message': '请先退出当前登录'}
+            card_key = (card_key or '').strip()
+            if not card_key:
+                return {'success': False, 'message': '卡密不能为空'}
+
+            try:
+                is_valid, local_data = await self.verifier.is_verified()
+            except FileLockTimeout:
+                # 其他进程长时间占用验证文件，不能据此联网验证（已激活的卡密会返回"卡密已被使用"）
+                return {'success': False, 'message': '验证文件暂时无法读取，请稍后重试'}
+            verified_key = ((local_data or {}).get('data') or {}).get('key', '')
+            if is_valid and local_data and verified_key in (card_key, ''):
+                self._set_login(card_key, local_data.get('data', {}))
+                return {'success': True, 'message': '登录成功（使用本地验证）', 'data': self.login_data}
+
+            result = await self.verifier.verify(card_key, user_identifier)
+            if not result.get('success', False):
+                return result
+            self._set_login(card_key, result.get('data', {}))
+            return {'success': True, 'message': '登录成功', 'data': self.login_data}
+
+    def _set_login(self, card_key: str, data: Dict[str, Any]) -> None:
+        self.is_login = True
+        self.current_key = card_key
+        self.login_data = data
+        self._wake.clear()
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+
+    async def _heartbeat(self) -> None:
+        """心跳任务：检查本地验证，休眠到下次检查时间或卡密到期时刻"""
+        while self.is_login:
+            try:
+                is_valid, data = await self.verifier.is_verified()
+            except FileLockTimeout:
+                # 验证文件暂时无法读取，本次不判断，等待一个心跳周期后再检查
+                is_valid, data = True, None
+            if not is_valid:
+                await self._notify_failure(6003, '卡密已过期或无效')
+                await self.logout()
+                return
+
+            wait_seconds = self.heartbeat_interval
+            expires_at = get_record_expires_at(data)
+            if expires_at is not None:
+                wait_seconds = min(wait_seconds, max(0.0, expires_at - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _notify_failure(self, code: int, message: str) -> None:
+        if self.heartbeat_callback is None:
+            return
+        try:
+            result = self.heartbeat_callback(code, message)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            print(f"心跳回调执行失败: {e}")
+
+    async def logout(self) -> Dict[str, Any]:
+        """退出登录并停止心跳任务"""
+        if not self.is_login:
+            return {'success': True, 'message': '未登录状态'}
+        self.is_login = False
+        self.current_key = ''
+        self.login_data = None
+
+        task, self._heartbeat_task = self._heartbeat_task, None
+        if task is not None and task is not asyncio.current_task():
+            self._wake.set()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        return {'success': True, 'message': '退出登录成功'}
+
+    def wake_heartbeat(self) -> None:
+        """立即执行一次心跳检测"""
+        self._wake.set()
+
+    async def close(self) -> None:
+        await self.logout()
+        await self.verifier.close()
+
+
+# 以下是示例用法
+if __name__ == "__main__":
+    async def main():
+        sdk = AsyncKamiSDK(heartbeat_callback=lambda code, message: print(f"心跳失败: {code} {message}"))
+        key = input("请输入卡密: ").strip()
+        result = await sdk.login(key)
+        print(result['message'])
+        await sdk.close()
+
+    asyncio.run(main())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+卡密批量验证工具
+从文件或标准输入读取卡密，用有界线程池并发验证，每完成一个就输出一行JSON结果，
+结束时在标准错误输出吞吐量和耗时统计。
+
+注意：验证接口会激活未使用的卡密，批量验证同样如此。
+
+用法:
+    python kami_batch.py keys.txt --workers 16 --rate 50 > results.jsonl
+    type keys.txt | python kami_batch.py - --output results.jsonl
+
+输入文件每行一个卡密，也可以是 {"key": "...", "userIdentifier": "..."} 格式的JSON；
+空行和 # 开头的行会被忽略。
+"""
+
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterator, Optional, Tuple, TextIO
+
+from kami_transport import DEFAULT_API_URL, KamiTransport, verify_card_key_request
+
+# 默认配置
+DEFAULT_WORKERS = 8  # 并发验证的线程数
+DEFAULT_RATE = 20.0  # 每秒最多发出的验证请求数，0 表示不限速
+
+
+class RateLimiter:
+    """令牌桶限速器，线程安全"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """取得一个令牌，令牌不足时等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class LatencyHistogram:
+    """
+    固定桶的耗时直方图
+
+    桶按对数间隔划分（每个桶相差约5%），无论记录多少次，占用的内存都不变。
+    """
+
+    MIN_LATENCY = 0.0001  # 0.1毫秒
+    GROWTH = 1.05
+    BUCKETS = 400  # 覆盖到约 0.1ms * 1.05^400 ≈ 3万秒
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if seconds <= self.MIN_LATENCY:
+            index = 0
+        else:
+            index = int(math.log(seconds / self.MIN_LATENCY, self.GROWTH)) + 1
+        self.counts[min(index, self.BUCKETS - 1)] += 1
+
+    def percentile(self, percent: float) -> float:
+        """返回百分位数所在桶的上界"""
+        if not self.count:
+            return 0.0
+        target = math.ceil(self.count * percent / 100)
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.max, self.MIN_LATENCY * self.GROWTH ** index)
+        return self.max
+
+
+def read_keys(stream: TextIO) -> Iterator[Tuple[int, str, str]]:
+    """逐行读取卡密，返回 (行号, 卡密, 用户标识)"""
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                yield line_number, '', ''
+                continue
+            yield line_number, str(item.get('key', '')).strip(), str(item.get('userIdentifier', ''))
+        else:
+            yield line_number, line, ''
+
+
+def run_batch(keys: Iterator[Tuple[int, str, str]],
+              output: TextIO,
+              workers: int = DEFAULT_WORKERS,
+              rate: float = DEFAULT_RATE,
+              api_url: str = DEFAULT_API_URL,
+              transport: Optional[KamiTransport] = None) -> Dict[str, Any]:
+    """
+    并发验证卡密并流式输出结果
+
+    同时在途的卡密最多为 workers 的两倍，读取速度随验证速度调整，内存占用与输入大小无关。
+    结果按完成顺序输出，每行带有输入文件中的行号。
+
+    返回:
+        dict: 汇总统计
+    """
+    transport = transport or KamiTransport(pool_size=workers)
+    limiter = RateLimiter(rate)
+    histogram = LatencyHistogram()
+    summary = {'total': 0, 'success': 0, 'failed': 0, 'cached': 0, 'invalid': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def verify(line_number: int, key: str, user_identifier: str) -> None:
+        try:
+            start = time.perf_counter()
+            if key:
+                limiter.acquire()
+                start = time.perf_counter()
+                result = verify_card_key_request(key, user_identifier, api_url, transport)
+            else:
+                result = {'success': False, 'message': '卡密不能为空'}
+            elapsed = time.perf_counter() - start
+
+            record = {'line': line_number, 'key': key, 'elapsed_ms': round(elapsed * 1000, 2)}
+            record.update(result)
+            text = json.dumps(record, ensure_ascii=False)
+            with lock:
+                output.write(text + '\n')
+                output.flush()
+                summary['total'] += 1
+                if not key:
+                    summary['invalid'] += 1
+                elif result.get('success', False):
+                    summary['success'] += 1
+                else:
+                    summary['failed'] += 1
+                if result.get('cached'):
+                    summary['cached'] += 1
+                if key and not result.get('cached'):
+                    histogram.record(elapsed)
+        finally:
+            slots.release()
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for line_number, key, user_identifier in keys:
+            slots.acquire()
+            executor.submit(verify, line_number, key, user_identifier)
+    elapsed = time.perf_counter() - start_time
+
+    summary.update({
+        'elapsed': elapsed,
+        'throughput': summary['total'] / elapsed if elapsed > 0 else 0.0,
+        'avg': histogram.total / histogram.count if histogram.count else 0.0,
+        'p50': histogram.percentile(50),
+        'p95': histogram.percentile(95),
+        'p99': histogram.percentile(99),
+        'max': histogram.max,
+    })
+    return summary
+
+
+def print_summary(summary: Dict[str, Any], stream: TextIO = sys.stderr) -> None:
+    """打印汇总统计"""
+    print("\n===== 批量验证统计 =====", file=stream)
+    print(f"总数: {summary['total']}  成功: {summary['success']}  失败: {summary['failed']}  "
+          f"无效行: {summary['invalid']}  命中失败缓存: {summary['cached']}", file=stream)
+    print(f"耗时: {summary['elapsed']:.2f}秒  吞吐量: {summary['throughput']:.1f} 个/秒", file=stream)
+    print(f"请求耗时(毫秒): 平均 {summary['avg'] * 1000:.1f}  p50 {summary['p50'] * 1000:.1f}  "
+          f"p95 {summary['p95'] * 1000:.1f}  p99 {summary['p99'] * 1000:.1f}  最大 {summary['max'] * 1000:.1f}",
+          file=stream)
+    print("=======================", file=stream)
+
+
+def main(argv=None, api_url: str = DEFAULT_API_URL) -> int:
+    """命令行入口，api_url 为未指定 --api-url 时使用的地址"""
+    parser = argparse.ArgumentParser(description='批量验证卡密，每个结果输出一行JSON（注意：验证会激活未使用的卡密）')
+    parser.add_argument('input', help='卡密文件，"-" 表示从标准输入读取')
+    parser.add_argument('--output', '-o', help='结果文件，默认输出到标准输出')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS, help=f'并发数，默认 {DEFAULT_WORKERS}')
+    parser.add_argument('--rate', '-r', type=float, default=DEFAULT_RATE, help=f'每秒最多请求数，0 为不限速，默认 {DEFAULT_RATE:g}')
+    parser.add_argument('--api-url', default=api_url, help='API地址')
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error('并发数必须大于0')
+
+    input_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8-sig')
+    output_stream = sys.stdout if not args.output else open(args.output, 'w', encoding='utf-8')
+    try:
+        summary = run_batch(read_keys(input_stream), output_stream, args.workers, args.rate, args.api_url)
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+
+    print_summary(summary)
+    return 0 if summary['failed'] == 0 and summary['invalid'] == 0 else 1
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print("\n程序已被用户中断", file=sys.stderr)
+        sys.exit(130)
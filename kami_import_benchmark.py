@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+模块导入耗时测试
+在全新的子进程中多次导入指定模块，统计导入耗时，并检查导入过程中是否加载了重量级依赖、
+是否有文件读写、启动子进程或网络访问。用于确认影刀流程加载卡密模块时只需几毫秒且没有I/O。
+
+测量的是子进程中 import 语句本身的耗时，不含解释器启动，包含模块导入的标准库模块。
+正式测量前先导入一次并写入字节码缓存（.pyc），与影刀流程第二次及以后加载模块的情况一致；
+--no-warmup 时不预热，设置了 PYTHONDONTWRITEBYTECODE 的环境中每次都要编译源码，耗时会高出数倍。
+--preload 指定的模块（例如影刀环境中的 xbot）在计时前导入，它们本身的耗时和依赖不计入被测模块。
+
+用法（在影刀的Python环境中，模块所在包的上级目录作为 --path）:
+    python kami_import_benchmark.py --path <应用目录> --module <包名>.yingdao_kami_integration --preload xbot
+    python kami_import_benchmark.py --module verification_utils --runs 20
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import Dict, Any, List
+
+DEFAULT_MODULE = 'yingdao_kami_integration'
+DEFAULT_RUNS = 10
+DEFAULT_MAX_MS = 50.0  # 预热字节码缓存后导入耗时中位数的上限（毫秒）
+
+# 导入时不应该加载的模块
+HEAVY_MODULES = ('requests', 'urllib3', 'cryptography', 'wmi', 'pythoncom', 'win32api', 'win32con')
+
+# 在子进程中执行：安装审计钩子记录I/O事件，然后导入模块
+_CHILD_CODE = r'''
+import sys, time, json, importlib
+IMPORT_SUFFIXES = ('.py', '.pyc', '.pyd', '.so', '.pth', '.dll')
+IO_EVENTS = ('open', 'subprocess.Popen', 'os.system', 'os.startfile', 'socket.connect',
+             'socket.getaddrinfo', 'winreg.OpenKey', 'os.remove', 'os.rename')
+events = []
+recording = False
+
+def hook(event, args):
+    if not recording or event not in IO_EVENTS:
+        return
+    if event == 'open':
+        path = str(args[0])
+        mode = str(args[1]) if len(args) > 1 else 'r'
+        # 导入模块本身读取源码和字节码文件，不算作模块的I/O
+        if path.endswith(IMPORT_SUFFIXES) and 'w' not in mode and 'a' not in mode:
+            return
+        events.append(f'open {path} {mode}')
+    else:
+        events.append(f'{event} {args[0] if args else ""}')
+
+for name in json.loads(sys.argv[2]):
+    importlib.import_module(name)
+sys.addaudithook(hook)
+preloaded = set(sys.modules)
+recording = True
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+recording = False
+print(json.dumps({
+    'elapsed': elapsed,
+    'events': events,
+    'loaded': sorted(set(sys.modules) - preloaded),
+}))
+'''
+
+
+def run_once(module: str, paths: List[str], preload: List[str] = None,
+             write_bytecode: bool = False) -> Dict[str, Any]:
+    """在新的子进程中导入一次模块，write_bytecode 为True时允许写入 .pyc（用于预热）"""
+    env = dict(os.environ)
+    if paths:
+        env['PYTHONPATH'] = os.pathsep.join(paths + [env.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+    if write_bytecode:
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.run(
+        [sys.executable, '-c', _CHILD_CODE, module, json.dumps(preload or [])],
+        capture_output=True, text=True, env=env
+    )
+    if output.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{output.stderr.strip()}")
+    # 模块导入时可能有打印输出，结果在最后一行
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(module: str = DEFAULT_MODULE, paths: List[str] = None, runs: int = DEFAULT_RUNS,
+                  preload: List[str] = None, warmup: bool = True) -> Dict[str, Any]:
+    """
+    多次导入模块并汇总
+
+    warmup 为True时先导入一次写入字节码缓存，这次不计入结果。
+
+    返回:
+        dict: 耗时（毫秒）、导入时加载的重量级模块和I/O事件
+    """
+    if warmup:
+        run_once(module, paths or [], preload, write_bytecode=True)
+    results = [run_once(module, paths or [], preload) for _ in range(runs)]
+    times = [result['elapsed'] * 1000 for result in results]
+    loaded = set()
+    events = []
+    for result in results:
+        loaded.update(result['loaded'])
+        for event in result['events']:
+            if event not in events:
+                events.append(event)
+    heavy = sorted(name for name in loaded if name.split('.')[0] in HEAVY_MODULES)
+    return {
+        'module': module,
+        'runs': runs,
+        'warmup': warmup,
+        'preload': list(preload or []),
+        'min_ms': min(times),
+        'median_ms': statistics.median(times),
+        'max_ms': max(times),
+        'heavy_modules': sorted({name.split('.')[0] for name in heavy}),
+        'io_events': events,
+    }
+
+
+def main(argv=None) -> int:
+    """命令行入口，超出耗时上限、加载了重量级模块或有I/O时返回1"""
+    parser = argparse.ArgumentParser(description='测试模块导入耗时和导入时的I/O')
+    parser.add_argument('--module', '-m', default=DEFAULT_MODULE, help=f'要导入的模块，默认 {DEFAULT_MODULE}')
+    parser.add_argument('--path', '-p', action='append', default=[], help='加入 sys.path 的目录，可多次指定')
+    parser.add_argument('--runs', '-n', type=int, default=DEFAULT_RUNS, help=f'导入次数，默认 {DEFAULT_RUNS}')
+    parser.add_argument('--max-ms', type=float, default=DEFAULT_MAX_MS, help=f'导入耗时中位数上限（毫秒），默认 {DEFAULT_MAX_MS:g}')
+    parser.add_argument('--preload', action='append', default=[],
+                        help='计时前导入的模块（如影刀环境中的 xbot），可多次指定')
+    parser.add_argument('--no-warmup', action='store_true', help='不预先写入字节码缓存，测量首次加载')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.module, args.path, args.runs, args.preload, warmup=not args.no_warmup)
+    print(f"===== 导入耗时: {report['module']} =====")
+    print(f"字节码缓存: {'已预热' if report['warmup'] else '未预热'}  "
+          f"计时前导入: {', '.join(report['preload']) or '无'}")
+    print(f"次数: {report['runs']}  最短: {report['min_ms']:.2f}ms  "
+          f"中位数: {report['median_ms']:.2f}ms  最长: {report['max_ms']:.2f}ms")
+    print(f"重量级模块: {', '.join(report['heavy_modules']) or '无'}")
+    if report['io_events']:
+        print("导入时的I/O:")
+        for event in report['io_events']:
+            print(f"  {event}")
+    else:
+        print("导入时的I/O: 无")
+
+    passed = (report['median_ms'] <= args.max_ms and not report['heavy_modules'] and not report['io_events'])
+    print("结果: " + ("通过" if passed else "未通过"))
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
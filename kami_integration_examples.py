@@ -71,6 +71,10 @@ def example_app_startup_protection():
             attempts += 1
             remaining = max_attempts - attempts
             print(f"\n❌ 卡密验证失败: {result['message']}")
+            if result.get('circuit_open'):
+                # 验证服务不可用，继续输入卡密只会立即失败
+                print("验证服务暂时不可用，请稍后再启动程序")
+                return False
             if remaining > 0:
                 print(f"您还有 {remaining} 次尝试机会")
             else:
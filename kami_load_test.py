@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+卡密验证流程压测工具
+启动多个工作进程模拟同时启动的RPA机器人，每个进程有独立的工作目录和 verification.bin，
+对内置的模拟服务器执行登录、心跳、退出场景，最后汇总吞吐量、耗时百分位数和各阶段耗时。
+
+登录流程与影刀模块的 智能验证 → 检查本地验证 → 单码 → 保存 相同，各阶段为：
+    probe      采集硬件ID
+    kdf        派生验证文件密钥（进程内缓存中没有时）
+    key_cache  从进程内缓存取得密钥（保存或之前的检查已经派生过）
+    decrypt    读取并解密 verification.bin
+    http       请求验证API
+    save       加密并保存验证文件
+
+用法:
+    python kami_load_test.py --workers 20 --iterations 10 --scenario login,heartbeat,logout --cold
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from queue import Empty
+from typing import Dict, Any, List, Optional
+
+from kami_batch import LatencyHistogram
+from kami_stub_server import CardKeyStore, FaultConfig, start_server
+from kami_transport import KamiTransport, verify_card_key_request
+from verification_utils import (DEFAULT_VERIFICATION_FILE, HardwareInfo, KamiEncryption, KamiVerifier, KdfParams,
+                                get_file_writer)
+
+# 默认配置
+DEFAULT_WORKERS = 4
+DEFAULT_ITERATIONS = 5
+DEFAULT_SCENARIO = 'login,heartbeat,logout'
+DEFAULT_HEARTBEATS = 3
+STAGES = ('probe', 'kdf', 'key_cache', 'decrypt', 'http', 'save')
+OPERATIONS = ('login', 'heartbeat', 'logout')
+
+
+class WorkerSession:
+    """一个工作进程中的模拟机器人，按阶段计时执行验证流程"""
+
+    def __init__(self, api_url: str, transport: KamiTransport, report):
+        self.api_url = api_url
+        self.transport = transport
+        self.report = report
+        self.verifier: Optional[KamiVerifier] = None
+        self.hardware_id = ''
+
+    def _timed(self, stage: str, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.report('stage', stage, time.perf_counter() - start, True)
+
+    def _check_local(self) -> bool:
+        """检查本地验证：读取文件、派生密钥、解密、比较硬件ID和过期时间"""
+        verifier = self.verifier
+        encrypted_data = verifier.writer.read()
+        if encrypted_data is None:
+            return False
+        header, _ = KamiEncryption.unpack(encrypted_data)
+        kdf = KdfParams.from_header(header) if header else verifier.encryption.legacy_kdf
+        # 保存时已经派生并缓存了密钥，命中缓存的查找单独统计，不计入 kdf
+        stage = 'key_cache' if verifier.encryption.is_key_cached(self.hardware_id, kdf) else 'kdf'
+        self._timed(stage, verifier.encryption.get_fernet, self.hardware_id, kdf)
+        data = self._timed('decrypt', verifier.encryption.decrypt_data, encrypted_data, self.hardware_id)
+        if not data or data.get('hardware_id') != self.hardware_id:
+            return False
+        expires_at = data.get('expires_at')
+        return expires_at is None or expires_at > time.time()
+
+    def login(self, key: str) -> bool:
+        self.hardware_id = self._timed('probe', HardwareInfo.generate_hardware_id)
+        if self.verifier is None:
+            self.verifier = KamiVerifier(api_url=self.api_url, transport=self.transport)
+        if self._check_local():
+            return True
+        result = self._timed('http', verify_card_key_request, key, '', self.api_url, self.transport)
+        if not result.get('success', False):
+            return False
+        # 保存时的密钥派生计入 save 阶段
+        return self._timed('save', self.verifier.save_verification_data, result)
+
+    def heartbeat(self) -> bool:
+        return self._check_local()
+
+    def logout(self) -> bool:
+        KamiEncryption.clear_key_cache()
+        return True
+
+
+def worker_main(workdir: str, api_url: str, keys: List[str], scenario: List[str],
+                heartbeats: int, cold: bool, fresh: bool, queue) -> None:
+    """工作进程入口"""
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    records = []
+
+    def report(kind: str, name: str, seconds: float, ok: bool) -> None:
+        records.append((kind, name, seconds, ok))
+
+    session = WorkerSession(api_url, KamiTransport(), report)
+    for key in keys:
+        if cold:
+            # 模拟每次都是新启动的进程：清除硬件ID和密钥缓存
+            HardwareInfo.invalidate_cache(remove_file=False)
+            KamiEncryption.clear_key_cache()
+        if fresh:
+            get_file_writer(DEFAULT_VERIFICATION_FILE).remove()
+        actions = {
+            'login': lambda: session.login(key),
+            'heartbeat': session.heartbeat,
+            'logout': session.logout,
+        }
+        for operation in scenario:
+            repeat = heartbeats if operation == 'heartbeat' else 1
+            for _ in range(repeat):
+                start = time.perf_counter()
+                try:
+                    ok = actions[operation]()
+                except Exception:
+                    ok = False
+                report('operation', operation, time.perf_counter() - start, ok)
+        # 批量上报，减少进程间通信
+        queue.put(records)
+        records = []
+    queue.put(None)
+
+
+def _summarize(histogram: LatencyHistogram) -> Dict[str, float]:
+    return {
+        'count': histogram.count,
+        'avg': histogram.total / histogram.count if histogram.count else 0.0,
+        'p50': histogram.percentile(50),
+        'p95': histogram.percentile(95),
+        'p99': histogram.percentile(99),
+        'max': histogram.max,
+        'total': histogram.total,
+    }
+
+
+def run_load_test(workers: int = DEFAULT_WORKERS,
+                  iterations: int = DEFAULT_ITERATIONS,
+                  scenario: str = DEFAULT_SCENARIO,
+                  heartbeats: int = DEFAULT_HEARTBEATS,
+                  cold: bool = False,
+                  fresh: bool = False,
+                  faults: Optional[FaultConfig] = None,
+                  api_url: Optional[str] = None,
+                  workdir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    执行压测
+
+    参数:
+        cold: 每轮清除硬件ID和密钥缓存，模拟新启动的进程
+        fresh: 每轮删除 verification.bin 并使用新卡密，使每次登录都请求API
+        api_url: 指定时不启动内置模拟服务器
+
+    返回:
+        dict: 各操作和各阶段的耗时统计
+    """
+    operations = [name.strip() for name in scenario.split(',') if name.strip()]
+    unknown = [name for name in operations if name not in OPERATIONS]
+    if unknown:
+        raise ValueError(f"未知的场景: {', '.join(unknown)}")
+
+    server = None
+    store = CardKeyStore()
+    keys_per_worker = iterations if fresh else 1
+    all_keys = store.generate_keys(workers * keys_per_worker)
+    if api_url is None:
+        server = start_server(store, faults)
+        api_url = server.api_url
+
+    base_dir = workdir or tempfile.mkdtemp(prefix='kami_load_')
+    queue = multiprocessing.Queue()
+    processes = []
+    for index in range(workers):
+        worker_keys = all_keys[index * keys_per_worker:(index + 1) * keys_per_worker]
+        if not fresh:
+            worker_keys = worker_keys * iterations
+        processes.append(multiprocessing.Process(
+            target=worker_main,
+            args=(os.path.join(base_dir, f'worker-{index}'), api_url, worker_keys,
+                  operations, heartbeats, cold, fresh, queue),
+            daemon=True
+        ))
+
+    operation_stats = {name: LatencyHistogram() for name in OPERATIONS}
+    stage_stats = {name: LatencyHistogram() for name in STAGES}
+    failures = {name: 0 for name in OPERATIONS}
+
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    finished = 0
+    while finished < workers:
+        try:
+            records = queue.get(timeout=1)
+        except Empty:
+            # 工作进程异常退出时不再等待
+            if not any(process.is_alive() for process in processes):
+                break
+            continue
+        if records is None:
+            finished += 1
+            continue
+        for kind, name, seconds, ok in records:
+            if kind == 'stage':
+                stage_stats[name].record(seconds)
+            else:
+                operation_stats[name].record(seconds)
+                if not ok:
+                    failures[name] += 1
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    if workdir is None:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    total_operations = sum(h.count for h in operation_stats.values())
+    return {
+        'workers': workers,
+        'elapsed': elapsed,
+        'throughput': total_operations / elapsed if elapsed > 0 else 0.0,
+        'operations': {name: dict(_summarize(h), failed=failures[name])
+                       for name, h in operation_stats.items() if h.count},
+        'stages': {name: _summarize(h) for name, h in stage_stats.items() if h.count},
+        'server': server.stats.to_dict() if server is not None else None,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """打印压测报告"""
+    print("\n===== 压测结果 =====")
+    print(f"进程数: {report['workers']}  耗时: {report['elapsed']:.2f}秒  吞吐量: {report['throughput']:.1f} 次操作/秒")
+    print(f"\n{'操作':<10}{'次数':>8}{'失败':>6}{'平均ms':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'最大':>10}")
+    for name, stats in report['operations'].items():
+        print(f"{name:<12}{stats['count']:>8}{stats['failed']:>6}{stats['avg'] * 1000:>10.2f}"
+              f"{stats['p50'] * 1000:>10.2f}{stats['p95'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}{stats['max'] * 1000:>10.2f}")
+    print(f"\n{'阶段':<10}{'次数':>8}{'总计ms':>12}{'平均ms':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, stats in report['stages'].items():
+        print(f"{name:<12}{stats['count']:>8}{stats['total'] * 1000:>12.1f}{stats['avg'] * 1000:>10.2f}"
+              f"{stats['p50'] * 1000:>10.2f}{stats['p95'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}")
+    if report['server']:
+        print(f"\n模拟服务器请求: {report['server']}")
+    print("===================")
+
+
+def main(argv=None) -> int:
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='卡密验证流程多进程压测')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS, help=f'工作进程数，默认 {DEFAULT_WORKERS}')
+    parser.add_argument('--iterations', '-n', type=int, default=DEFAULT_ITERATIONS, help=f'每个进程执行场景的轮数，默认 {DEFAULT_ITERATIONS}')
+    parser.add_argument('--scenario', default=DEFAULT_SCENARIO, help=f'逗号分隔的操作顺序，可选 login、heartbeat、logout，默认 {DEFAULT_SCENARIO}')
+    parser.add_argument('--heartbeats', type=int, default=DEFAULT_HEARTBEATS, help=f'每轮心跳检测次数，默认 {DEFAULT_HEARTBEATS}')
+    parser.add_argument('--cold', action='store_true', help='每轮清除硬件ID和密钥缓存，模拟新启动的进程')
+    parser.add_argument('--fresh', action='store_true', help='每轮使用新卡密且删除本地验证文件，使每次登录都请求API')
+    parser.add_argument('--latency', default='fixed:0', help='模拟服务器延迟分布（毫秒），如 normal:50,10')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务器返回500错误的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='模拟服务器断开连接的概率')
+    parser.add_argument('--workdir', help='工作目录，默认使用临时目录并在结束后删除')
+    args = parser.parse_args(argv)
+
+    faults = FaultConfig(args.latency, args.error_rate, args.drop_rate)
+    report = run_load_test(args.workers, args.iterations, args.scenario, args.heartbeats,
+                           args.cold, args.fresh, faults, workdir=args.workdir)
+    print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+本地卡密验证模拟服务器
+实现 /api/card-keys/verify 和 /api/card-keys/public-key，响应格式和状态码与后端 cardKeyController 一致
+（验证成功时同样签发Ed25519授权令牌），卡密保存在内存或SQLite文件中。可以设置延迟分布、错误率和断开连接的概率，
+用于在没有真实服务器的情况下测试客户端的重试、连接复用和超时。
+
+用法:
+    python kami_stub_server.py --port 8080 --generate 100 --latency normal:50,10 --error-rate 0.05
+    客户端使用 http://127.0.0.1:8080/api/card-keys/verify 作为API地址
+
+签名密钥默认每次启动随机生成，启动时打印公钥，客户端把它设为 KAMI_LICENSE_PUBLIC_KEY 后才会校验令牌。
+用 --key-file 指定固定的私钥（PEM），再用 --root-key-file 指定根私钥时，/public-key 会附带根私钥的背书，
+可以测试客户端只固定根公钥、运行时获取签名公钥的流程。
+"""
+
+import sys
+import json
+import base64
+import calendar
+import math
+import time
+import random
+import string
+import sqlite3
+import argparse
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat, load_pem_private_key
+
+VERIFY_PATH = '/api/card-keys/verify'
+PUBLIC_KEY_PATH = '/api/card-keys/public-key'
+LICENSE_TOKEN_VERSION = 1
+LICENSE_KEY_ENDORSEMENT_PREFIX = b'kami-license-key:v1:'  # 与后端 utils/licenseToken.js 一致
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_VALID_DAYS = 30
+DEFAULT_CARD_TYPE = '时长卡'
+
+# 卡密状态，与后端 CardKey 模型一致
+STATUS_UNUSED = '未使用'
+STATUS_USED = '已使用'
+STATUS_EXPIRED = '已过期'
+
+
+def _format_time(value: Optional[datetime.datetime]) -> Optional[str]:
+    """按 MongoDB 日期的JSON格式输出，例如 2023-12-31T23:59:59.000Z"""
+    if value is None:
+        return None
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + f'{value.microsecond // 1000:03d}Z'
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LicenseSigner:
+    """授权令牌签名，格式与后端 utils/licenseToken.js 相同，不指定私钥时每次启动生成新的密钥"""
+
+    def __init__(self, private_key: Optional[Ed25519PrivateKey] = None,
+                 root_key: Optional[Ed25519PrivateKey] = None):
+        self._private_key = private_key or Ed25519PrivateKey.generate()
+        self.public_key = _b64url(self._private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+        # 根私钥对签名公钥的背书，客户端固定根公钥时据此信任运行时获取的签名公钥
+        self.endorsement = None
+        if root_key is not None:
+            self.endorsement = _b64url(root_key.sign(LICENSE_KEY_ENDORSEMENT_PREFIX + self.public_key.encode('ascii')))
+
+    @staticmethod
+    def load_key(path: str) -> Ed25519PrivateKey:
+        """读取PEM格式的Ed25519私钥"""
+        with open(path, 'rb') as f:
+            key = load_pem_private_key(f.read(), password=None)
+        if not isinstance(key, Ed25519PrivateKey):
+            raise ValueError(f"{path} 不是Ed25519私钥")
+        return key
+
+    def sign(self, key: str, hardware_id: str, expiry_time: str) -> str:
+        """签发令牌，expiry_time 为响应中的 expiryTime（UTC）"""
+        payload = {
+            'v': LICENSE_TOKEN_VERSION,
+            'key': key,
+            'hwid': hardware_id or '',
+            'exp': calendar.timegm(time.strptime(expiry_time[:19], '%Y-%m-%dT%H:%M:%S')),
+            'iat': int(time.time()),
+        }
+        encoded = _b64url(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        return f'{encoded}.{_b64url(self._private_key.sign(encoded.encode("ascii")))}'
+
+
+class CardKeyStore:
+    """卡密存储，db_path 为 ':memory:' 时只保存在内存中"""
+
+    def __init__(self, db_path: str = ':memory:'):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS card_keys ('
+            ' key TEXT PRIMARY KEY,'
+            ' status TEXT NOT NULL,'
+            ' card_type TEXT NOT NULL,'
+            ' valid_days INTEGER NOT NULL,'
+            ' use_time TEXT,'
+            ' expiry_time TEXT,'
+            ' used_by TEXT,'
+            ' user_ip TEXT)'
+        )
+        self._conn.commit()
+
+    def add_key(self, key: str, valid_days: int = DEFAULT_VALID_DAYS,
+                card_type: str = DEFAULT_CARD_TYPE, status: str = STATUS_UNUSED,
+                use_time: Optional[datetime.datetime] = None) -> None:
+        """添加卡密，use_time 不为空时按已使用处理并计算过期时间"""
+        expiry_time = None
+        if use_time is not None:
+            expiry_time = use_time + datetime.timedelta(days=valid_days)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO card_keys VALUES (?, ?, ?, ?, ?, ?, NULL, NULL)',
+                (key, status, card_type, valid_days,
+                 use_time.isoformat() if use_time else None,
+                 expiry_time.isoformat() if expiry_time else None)
+            )
+            self._conn.commit()
+
+    def generate_keys(self, count: int, valid_days: int = DEFAULT_VALID_DAYS) -> List[str]:
+        """生成 XXXX-XXXX-XXXX-XXXX 格式的未使用卡密"""
+        alphabet = string.ascii_uppercase + string.digits
+        keys = []
+        for _ in range(count):
+            key = '-'.join(''.join(random.choice(alphabet) for _ in range(4)) for _ in range(4))
+            self.add_key(key, valid_days)
+            keys.append(key)
+        return keys
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT key, status, card_type, valid_days, use_time, expiry_time, used_by, user_ip '
+                'FROM card_keys WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('key', 'status', 'cardType', 'validDays', 'useTime', 'expiryTime', 'usedBy', 'userIP'), row))
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM card_keys GROUP BY status').fetchall()
+        return dict(rows)
+
+    def verify(self, key: str, user_identifier: str = '', user_ip: str = '') -> Tuple[int, Dict[str, Any]]:
+        """
+        验证并使用卡密，返回 (HTTP状态码, 响应体)
+
+        与 cardKeyController.verifyCardKey 相同：已使用且未过期的卡密返回"卡密已被使用"，
+        已使用且已过期的卡密标记为已过期。
+        """
+        if not key:
+            return 400, {'success': False, 'message': '请提供卡密'}
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, card_type, valid_days, use_time FROM card_keys WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return 404, {'success': False, 'message': '卡密不存在'}
+
+            status, card_type, valid_days, use_time = row
+            now = _utcnow()
+            if status == STATUS_USED:
+                if use_time and now > datetime.datetime.fromisoformat(use_time) + datetime.timedelta(days=valid_days):
+                    self._conn.execute('UPDATE card_keys SET status = ? WHERE key = ?', (STATUS_EXPIRED, key))
+                    self._conn.commit()
+                    return 400, {'success': False, 'message': '卡密已过期'}
+                return 400, {'success': False, 'message': '卡密已被使用'}
+
+            if status == STATUS_EXPIRED:
+                return 400, {'success': False, 'message': '卡密已过期'}
+
+            expiry_time = now + datetime.timedelta(days=valid_days)
+            self._conn.execute(
+                'UPDATE card_keys SET status = ?, use_time = ?, expiry_time = ?, used_by = ?, user_ip = ? WHERE key = ?',
+                (STATUS_USED, now.isoformat(), expiry_time.isoformat(), user_identifier or None, user_ip or None, key)
+            )
+            self._conn.commit()
+
+        return 200, {
+            'success': True,
+            'message': '卡密验证成功',
+            'data': {
+                'key': key,
+                'validDays': valid_days,
+                'useTime': _format_time(now),
+                'expiryTime': _format_time(expiry_time),
+                'cardType': card_type,
+            }
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class FaultConfig:
+    """
+    故障注入配置
+
+    latency 为延迟分布（毫秒）：
+        fixed:50          固定50毫秒
+        uniform:20,200    20到200毫秒均匀分布
+        normal:50,10      均值50、标准差10的正态分布
+        lognormal:50,0.5  中位数50、sigma为0.5的对数正态分布（长尾）
+    error_rate 为返回 500 服务器错误的概率，drop_rate 为读完请求后直接断开连接、不做任何处理的概率。
+    """
+
+    def __init__(self, latency: str = 'fixed:0', error_rate: float = 0.0,
+                 drop_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sampler = self._parse_latency(latency)
+
+    def _parse_latency(self, spec: str):
+        kind, _, args = spec.partition(':')
+        values = [float(v) for v in args.split(',') if v.strip()] if args else []
+        if kind == 'fixed':
+            value = values[0] if values else 0.0
+            return lambda rnd: value
+        if kind == 'uniform' and len(values) == 2:
+            return lambda rnd: rnd.uniform(values[0], values[1])
+        if kind == 'normal' and len(values) == 2:
+            return lambda rnd: max(0.0, rnd.gauss(values[0], values[1]))
+        if kind == 'lognormal' and len(values) == 2:
+            mu = math.log(values[0])
+            return lambda rnd: rnd.lognormvariate(mu, values[1])
+        raise ValueError(f'无法识别的延迟分布: {spec}')
+
+    def sample(self) -> Tuple[float, bool, bool]:
+        """返回 (延迟秒数, 是否断开连接, 是否返回服务器错误)"""
+        with self._lock:
+            delay = self._sampler(self._random) / 1000
+            drop = self._random.random() < self.drop_rate
+            error = self._random.random() < self.error_rate
+        return delay, drop, error
+
+
+class StubServerStats:
+    """模拟服务器的请求计数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """处理验证请求，支持HTTP/1.1长连接"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'KamiStub/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self):
+        # 与后端的CORS中间件一样直接应答，客户端用它预热连接
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, {
+                'requests': self.server.stats.to_dict(),
+                'keys': self.server.store.count_by_status(),
+            })
+        elif self.path == PUBLIC_KEY_PATH:
+            self.server.stats.add('public_key')
+            self._send_json(200, {
+                'success': True,
+                'data': {'algorithm': 'Ed25519', 'publicKey': self.server.signer.public_key,
+                         'endorsement': self.server.signer.endorsement},
+            })
+        else:
+            self._send_json(404, {'success': False, 'message': '接口不存在'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+
+        if self.path != VERIFY_PATH:
+            self._send_json(404, {'success': False, 'message': '接口不存在'})
+            return
+
+        stats = self.server.stats
+        stats.add('total')
+        delay, drop, error = self.server.faults.sample()
+        if delay > 0:
+            time.sleep(delay)
+        if drop:
+            # 模拟连接中断：请求没有被处理，也没有任何响应
+            stats.add('dropped')
+            self.close_connection = True
+            return
+        if error:
+            stats.add('error')
+            self._send_json(500, {'success': False, 'message': '服务器错误'})
+            return
+
+        try:
+            payload = json.loads(raw_body or b'{}')
+        except ValueError:
+            stats.add('error')
+            self._send_json(500, {'success': False, 'message': '服务器错误'})
+            return
+
+        status, body = self.server.store.verify(
+            str(payload.get('key') or ''),
+            str(payload.get('userIdentifier') or ''),
+            self.headers.get('X-Forwarded-For') or self.client_address[0]
+        )
+        if status == 200:
+            data = body['data']
+            body['token'] = self.server.signer.sign(data['key'], str(payload.get('hardwareId') or ''),
+                                                    data['expiryTime'])
+        stats.add(str(status))
+        self._send_json(status, body)
+
+
+class StubServer(ThreadingHTTPServer):
+    """模拟验证服务器"""
+
+    daemon_threads = True
+    request_queue_size = 128  # 大量并发连接时避免 listen 队列溢出导致的握手重传
+
+    def __init__(self, store: CardKeyStore, faults: Optional[FaultConfig] = None,
+                 host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, verbose: bool = False,
+                 signer: Optional[LicenseSigner] = None):
+        self.store = store
+        self.faults = faults or FaultConfig()
+        self.signer = signer or LicenseSigner()
+        self.stats = StubServerStats()
+        self.verbose = verbose
+        super().__init__((host, port), StubRequestHandler)
+
+    @property
+    def api_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}{VERIFY_PATH}'
+
+
+def start_server(store: Optional[CardKeyStore] = None, faults: Optional[FaultConfig] = None,
+                 host: str = DEFAULT_HOST, port: int = 0,
+                 signer: Optional[LicenseSigner] = None) -> StubServer:
+    """
+    在后台线程中启动模拟服务器，port 为0时自动选择空闲端口
+
+    返回:
+        StubServer: 通过 api_url 获取验证地址，用完后调用 shutdown() 和 server_close()
+    """
+    server = StubServer(store or CardKeyStore(), faults, host, port, signer=signer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main(argv=None) -> int:
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='本地卡密验证模拟服务器')
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'监听地址，默认 {DEFAULT_HOST}')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'监听端口，默认 {DEFAULT_PORT}')
+    parser.add_argument('--db', default=':memory:', help='SQLite数据库文件，默认只保存在内存中')
+    parser.add_argument('--generate', type=int, default=0, help='启动时生成的未使用卡密数量')
+    parser.add_argument('--valid-days', type=int, default=DEFAULT_VALID_DAYS, help='生成卡密的有效天数')
+    parser.add_argument('--keys-file', help='把生成的卡密写入该文件，每行一个')
+    parser.add_argument('--latency', default='fixed:0', help='延迟分布（毫秒），如 fixed:50、uniform:20,200、normal:50,10、lognormal:50,0.5')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500错误的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='断开连接不响应的概率')
+    parser.add_argument('--seed', type=int, help='随机数种子，便于复现')
+    parser.add_argument('--verbose', action='store_true', help='输出每个请求的日志')
+    parser.add_argument('--key-file', help='令牌签名私钥（PEM），默认每次启动随机生成')
+    parser.add_argument('--root-key-file', help='根私钥（PEM），指定后 /public-key 附带对签名公钥的背书')
+    args = parser.parse_args(argv)
+
+    signer = LicenseSigner(LicenseSigner.load_key(args.key_file) if args.key_file else None,
+                           LicenseSigner.load_key(args.root_key_file) if args.root_key_file else None)
+
+    store = CardKeyStore(args.db)
+    if args.generate:
+        keys = store.generate_keys(args.generate, args.valid_days)
+        if args.keys_file:
+            with open(args.keys_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(keys) + '\n')
+            print(f"已生成 {len(keys)} 个卡密，写入 {args.keys_file}")
+        else:
+            print('\n'.join(keys))
+
+    faults = FaultConfig(args.latency, args.error_rate, args.drop_rate, args.seed)
+    server = StubServer(store, faults, args.host, args.port, args.verbose, signer)
+    print(f"模拟服务器已启动: {server.api_url}")
+    print(f"令牌签名公钥: {signer.public_key}")
+    print(f"请求统计: http://{args.host}:{server.server_address[1]}/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n模拟服务器已停止")
+    finally:
+        server.server_close()
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
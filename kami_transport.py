@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+卡密验证HTTP传输层
+所有验证客户端共用一个带连接池的长连接会话，连接超时与读取超时分开设置，并记录每次请求的耗时
+"""
+
+import sys
+import json
+import hashlib
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+except ImportError:
+    print("[警告] 未安装 requests，运行前请执行:\n  pip install requests")
+    sys.exit(1)
+
+# 默认配置
+DEFAULT_API_URL = 'http://170.106.175.187/api/card-keys/verify'
+DEFAULT_CONNECT_TIMEOUT = 3.05  # 建立TCP连接的超时（秒）
+DEFAULT_READ_TIMEOUT = 10  # 等待服务器响应的超时（秒）
+DEFAULT_POOL_SIZE = 10  # 每个主机保持的长连接数量
+DEFAULT_STATS_HISTORY = 1000  # 保留最近多少次请求的耗时记录
+DEFAULT_MAX_ATTEMPTS = 3  # 连接失败时最多尝试的次数
+DEFAULT_BACKOFF_BASE = 0.2  # 退避的初始等待时间（秒）
+DEFAULT_BACKOFF_MAX = 2.0  # 单次退避的最长等待时间（秒）
+DEFAULT_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断
+DEFAULT_RESET_TIMEOUT = 30.0  # 熔断后多久允许一次探测请求（秒）
+DEFAULT_NEGATIVE_CACHE_SIZE = 256  # 最多缓存多少个被拒绝的卡密
+# 被拒绝的卡密在本地直接返回失败的时间（秒），按服务器返回的原因区分
+DEFAULT_NEGATIVE_TTLS = {
+    '卡密不存在': 120,
+    '卡密已被使用': 600,
+    '卡密已过期': 3600,
+}
+
+# 熔断器状态
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发出"""
+
+
+class TransportStats:
+    """HTTP请求耗时统计"""
+
+    def __init__(self, history: int = DEFAULT_STATS_HISTORY):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.recent: deque = deque(maxlen=history)
+
+    def record(self, url: str, elapsed: float, status: Optional[int] = None, error: Optional[str] = None) -> None:
+        """记录一次请求"""
+        with self._lock:
+            self.count += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            if error is not None:
+                self.errors += 1
+            self.recent.append({
+                'time': time.time(),
+                'url': url,
+                'status': status,
+                'elapsed': elapsed,
+                'error': error,
+            })
+
+    @staticmethod
+    def _percentile(values, percent: float) -> float:
+        if not values:
+            return 0.0
+        index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+        return values[index]
+
+    def to_dict(self, include_recent: bool = False) -> Dict[str, Any]:
+        """导出统计信息，百分位数基于最近的请求记录"""
+        with self._lock:
+            latencies = sorted(item['elapsed'] for item in self.recent)
+            stats = {
+                'count': self.count,
+                'errors': self.errors,
+                'avg': self.total_time / self.count if self.count else 0.0,
+                'max': self.max_time,
+                'p50': self._percentile(latencies, 50),
+                'p95': self._percentile(latencies, 95),
+                'p99': self._percentile(latencies, 99),
+            }
+            if include_recent:
+                stats['recent'] = list(self.recent)
+            return stats
+
+    def reset(self) -> None:
+        with self._lock:
+            self.count = 0
+            self.errors = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.recent.clear()
+
+
+class CircuitBreaker:
+    """
+    验证API的熔断器
+
+    连续失败达到阈值后进入打开状态，此后的请求直接失败；经过 reset_timeout 秒后
+    进入半开状态，只放行一个探测请求，探测成功则关闭熔断器，失败则重新打开。
+    """
+
+    def __init__(self,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.last_error: Optional[str] = None
+
+    def _current_state(self) -> str:
+        if self._state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = CIRCUIT_HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow_request(self) -> Tuple[bool, bool]:
+        """
+        是否允许发出请求，半开状态下只放行一个探测请求
+
+        返回 (是否放行, 是否占用了探测名额)，占用了名额的调用结束时要调用 release_probe()。
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CIRCUIT_CLOSED:
+                return True, False
+            if state == CIRCUIT_HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True, True
+            return False, False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CIRCUIT_CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+            self.last_error = None
+
+    def record_failure(self, error: Optional[str] = None) -> None:
+        with self._lock:
+            self._failures += 1
+            self.last_error = error
+            if self._state == CIRCUIT_HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """
+        探测请求结束但没有记录成功或失败时（例如抛出了非网络异常）释放半开状态的探测名额
+
+        只能由 allow_request() 返回占用了探测名额的调用在 finally 中调用；已记录结果时熔断器已不在半开状态，
+        调用没有影响。
+        """
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN:
+                self._probe_in_flight = False
+
+    def reset(self) -> None:
+        """手动关闭熔断器"""
+        self.record_success()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """导出熔断器状态"""
+        with self._lock:
+            state = self._current_state()
+            retry_after = 0.0
+            if state == CIRCUIT_OPEN:
+                retry_after = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+            return {
+                'state': state,
+                'failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'retry_after': retry_after,
+                'last_error': self.last_error,
+            }
+
+
+class NegativeCache:
+    """
+    被服务器拒绝的卡密的本地缓存
+
+    只缓存卡密不存在、已被使用、已过期这类确定的业务失败，有效期内再次验证直接返回原失败消息，
+    不再请求服务器。缓存键是API地址和卡密的SHA-256摘要，不保存卡密明文。
+    """
+
+    def __init__(self,
+                 max_entries: int = DEFAULT_NEGATIVE_CACHE_SIZE,
+                 ttls: Optional[Dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_NEGATIVE_TTLS if ttls is None else ttls)
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self.hits = 0
+
+    @staticmethod
+    def _cache_key(api_url: str, key: str) -> str:
+        return hashlib.sha256(f'{api_url}\n{key}'.encode('utf-8')).hexdigest()
+
+    def get(self, api_url: str, key: str) -> Optional[Dict[str, Any]]:
+        """返回未过期的失败结果，没有时返回None"""
+        cache_key = self._cache_key(api_url, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[cache_key]
+                return None
+            self.hits += 1
+            return dict(result, cached=True)
+
+    def put(self, api_url: str, key: str, result: Dict[str, Any]) -> bool:
+        """记录失败结果，只有 ttls 中列出的失败原因会被缓存"""
+        ttl = self.ttls.get(result.get('message', ''))
+        if not ttl or result.get('success', False):
+            return False
+        cache_key = self._cache_key(api_url, key)
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + ttl, dict(result))
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def clear(self) -> int:
+        """清空缓存，返回清除的条目数"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+def is_connect_error(error: Exception) -> bool:
+    """
+    判断异常是否发生在建立连接阶段
+
+    只有连接阶段的错误才能确定请求没有到达服务器；验证接口会把卡密标记为已使用，
+    读取超时等请求已发出的错误不能重试。
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def backoff_delay(attempt: int,
+                  base: float = DEFAULT_BACKOFF_BASE,
+                  cap: float = DEFAULT_BACKOFF_MAX) -> float:
+    """第 attempt 次重试前的等待时间（指数退避，全抖动）"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class KamiTransport:
+    """共享的HTTP传输，复用TCP连接"""
+
+    def __init__(self,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.stats = TransportStats()
+        self.breaker = breaker or CircuitBreaker()
+        self.negative_cache = NegativeCache()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        """requests 使用的 (连接超时, 读取超时)"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def _send(self, url: str, payload: Dict[str, Any]) -> requests.Response:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.stats.record(url, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        self.stats.record(url, time.perf_counter() - start, status=response.status_code)
+        return response
+
+    def post_json(self, url: str, payload: Dict[str, Any]) -> requests.Response:
+        """
+        发送JSON POST请求
+
+        连接阶段失败时按指数退避重试，其余网络异常原样抛出；熔断器打开时抛出 CircuitOpenError。
+        """
+        allowed, probe = self.breaker.allow_request()
+        if not allowed:
+            retry_after = self.breaker.to_dict()['retry_after']
+            raise CircuitOpenError(f'验证服务暂时不可用，请{retry_after:.0f}秒后重试')
+
+        try:
+            attempt = 0
+            while True:
+                try:
+                    response = self._send(url, payload)
+                except requests.exceptions.RequestException as e:
+                    attempt += 1
+                    if attempt >= self.max_attempts or not is_connect_error(e):
+                        self.breaker.record_failure(type(e).__name__)
+                        raise
+                    time.sleep(backoff_delay(attempt - 1))
+                    continue
+
+                if response.status_code >= 500:
+                    self.breaker.record_failure(f'HTTP {response.status_code}')
+                else:
+                    self.breaker.record_success()
+                return response
+        finally:
+            # 只有占用了探测名额的请求才释放，否则会放行第二个探测请求
+            if probe:
+                self.breaker.release_probe()
+
+    def get(self, url: str) -> requests.Response:
+        """发送GET请求，用于获取公钥等只读接口，不重试也不经过熔断器"""
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.stats.record(url, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        self.stats.record(url, time.perf_counter() - start, status=response.status_code)
+        return response
+
+    def warm_up(self, url: str = DEFAULT_API_URL) -> bool:
+        """
+        预先解析域名并建立长连接，之后的首次验证无需再等待握手
+
+        使用 OPTIONS 请求（后端的CORS中间件会直接应答），不会触发卡密验证。
+        """
+        parts = urlsplit(url)
+        try:
+            socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+            self.session.options(url, timeout=self.timeout)
+            return True
+        except (OSError, requests.exceptions.RequestException):
+            return False
+
+    def get_stats(self, include_recent: bool = False) -> Dict[str, Any]:
+        """获取请求耗时统计"""
+        return self.stats.to_dict(include_recent)
+
+    def get_breaker_state(self) -> Dict[str, Any]:
+        """获取熔断器状态"""
+        return self.breaker.to_dict()
+
+    def close(self) -> None:
+        """关闭连接池"""
+        self.session.close()
+
+
+_transport: Optional[KamiTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> KamiTransport:
+    """获取进程内共享的传输实例"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = KamiTransport()
+    return _transport
+
+
+def set_transport(transport: KamiTransport) -> None:
+    """替换共享的传输实例，例如调整超时或连接池大小"""
+    global _transport
+    with _transport_lock:
+        old, _transport = _transport, transport
+    if old is not None and old is not transport:
+        old.close()
+
+
+def clear_negative_cache() -> int:
+    """清空共享传输中被拒绝卡密的缓存，返回清除的条目数"""
+    return get_transport().negative_cache.clear()
+
+
+def verify_card_key_request(key: str,
+                            user_identifier: str = '',
+                            api_url: str = DEFAULT_API_URL,
+                            transport: Optional[KamiTransport] = None,
+                            use_negative_cache: bool = True,
+                            hardware_id: str = '') -> Dict[str, Any]:
+    """
+    通过共享传输调用验证API
+
+    参数:
+        key (str): 要验证的卡密
+        user_identifier (str, 可选): 用户标识符
+        api_url (str, 可选): API地址
+        transport (KamiTransport, 可选): 使用的传输，默认为共享实例
+        use_negative_cache (bool, 可选): 为False时不读取被拒绝卡密缓存，总是请求服务器
+        hardware_id (str, 可选): 硬件ID，服务器把它写入返回的授权令牌
+
+    返回:
+        dict: 包含验证结果的字典，网络错误也以 success=False 的字典返回；
+              命中被拒绝卡密缓存时带有 cached=True
+    """
+    transport = transport or get_transport()
+    if use_negative_cache:
+        cached = transport.negative_cache.get(api_url, key)
+        if cached is not None:
+            return cached
+
+    try:
+        payload = {'key': key, 'userIdentifier': user_identifier}
+        if hardware_id:
+            payload['hardwareId'] = hardware_id
+        response = transport.post_json(api_url, payload)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # 卡密不存在、已被使用、已过期等业务错误由服务器在响应体中说明
+            try:
+                message = response.json().get('message')
+            except (ValueError, AttributeError):
+                message = None
+            result = {
+                'success': False,
+                'message': message or f'API错误: HTTP {response.status_code}',
+                'status_code': response.status_code
+            }
+            transport.negative_cache.put(api_url, key, result)
+            return result
+
+    except CircuitOpenError as e:
+        return {'success': False, 'message': str(e), 'circuit_open': True}
+    except requests.exceptions.Timeout:
+        return {'success': False, 'message': '连接超时，请检查网络'}
+    except requests.exceptions.ConnectionError:
+        return {'success': False, 'message': '连接失败，请检查网络或API地址'}
+    except json.JSONDecodeError:
+        return {'success': False, 'message': 'API返回的数据格式错误'}
+    except Exception as e:
+        return {'success': False, 'message': f'未知错误: {str(e)}'}
@@ -14,20 +14,33 @@ import subprocess
 import base64
 import hashlib
 import datetime
-from typing import Dict, Any, Optional, Tuple, Union
+import re
+import copy
+import sqlite3
+from collections import OrderedDict
+import threading
+import time
+import atexit
+import bisect
+import functools
+from typing import Dict, List, Any, Optional, Tuple, Union
 
 try:
     import requests  # type: ignore
+    from kami_transport import KamiTransport, get_transport, verify_card_key_request  # type: ignore
     # cryptography 可能在某些环境未安装，运行时才必需；
     # 加上 "type: ignore" 以消除 Pyright 的 missing-import 警告。
     from cryptography.fernet import Fernet  # type: ignore
     from cryptography.hazmat.primitives import hashes  # type: ignore
     from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC  # type: ignore
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt  # type: ignore
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey  # type: ignore
+    from cryptography.exceptions import InvalidSignature  # type: ignore
 except ImportError:
     # 在静态分析或缺少依赖时提供兜底定义，防止 IDE 报错
     import types
     requests = types.ModuleType("requests")  # type: ignore
-    Fernet = hashes = PBKDF2HMAC = object  # type: ignore
+    Fernet = hashes = PBKDF2HMAC = Scrypt = Ed25519PublicKey = InvalidSignature = object  # type: ignore
     print("[警告] 未安装 requests 或 cryptography，运行前请执行:\n  pip install requests cryptography")
     sys.exit(1)
 
@@ -36,20 +49,980 @@ DEFAULT_API_URL = 'http://170.106.175.187/api/card-keys/verify'
 DEFAULT_VERIFICATION_FILE = 'verification.bin'
 DEFAULT_LEGACY_FILE = 'verification.json'
 DEFAULT_SALT = b'kami_verification_system_salt'
+DEFAULT_KDF_ALGORITHM = 'pbkdf2-sha256'
+DEFAULT_KDF_ITERATIONS = 100000
+# 文件头中KDF参数的允许范围：验证文件可以被篡改，超出范围的参数会让派生耗尽CPU或内存
+MAX_KDF_ITERATIONS = 1000000
+SCRYPT_ALLOWED_N = (2 ** 14, 2 ** 15, 2 ** 16, 2 ** 17)
+MAX_SCRYPT_R = 8
+MAX_SCRYPT_P = 4
+MAX_KDF_SALT_LENGTH = 64
+# 验证文件头：KAMI/ + JSON参数 + 换行，之后是Fernet密文
+KAMI_FILE_MAGIC = b'KAMI/'
+KAMI_FILE_VERSION = 1
+# 进程内最多缓存的派生密钥数量
+DEFAULT_KEY_CACHE_SIZE = 8
+# 硬件ID磁盘缓存文件，None 表示只使用进程内缓存
+DEFAULT_HARDWARE_CACHE_FILE = None
+# 硬件信息单项采集期限和整体时间预算（秒）
+DEFAULT_PROBE_TIMEOUT = 3.0
+DEFAULT_PROBE_BUDGET = 5.0
+# 一次硬件采集中通过同一个WMI连接查询的属性
+WMI_PROBE_QUERIES = (
+    ('Win32_Processor', 'ProcessorId'),
+    ('Win32_DiskDrive', 'SerialNumber'),
+    ('Win32_BaseBoard', 'SerialNumber'),
+)
+# 授权令牌：服务器用Ed25519签名，客户端用公钥离线验证卡密、硬件ID和到期时间
+LICENSE_TOKEN_VERSION = 1
+# 固定的服务器根公钥（base64url），也可以用环境变量 KAMI_LICENSE_PUBLIC_KEY 指定；
+# 设置后本地验证必须带有有效的授权令牌，运行时获取的公钥只有带根私钥背书时才被接受
+LICENSE_PUBLIC_KEY = None
+LICENSE_PUBLIC_KEY_ENV = 'KAMI_LICENSE_PUBLIC_KEY'
+# 签名公钥的背书：根私钥对 前缀 + base64url签名公钥 的签名
+LICENSE_KEY_ENDORSEMENT_PREFIX = b'kami-license-key:v1:'
+# 背书有效的签名公钥缓存在验证文件所在目录的这个文件中
+DEFAULT_PUBLIC_KEY_FILE = 'license_public.key'
+# 本机保存过带令牌的记录后创建的标记文件，之后不再接受没有令牌的旧记录
+DEFAULT_TOKEN_MARKER_FILE = 'license_token.required'
+# 两次从服务器获取签名公钥之间至少间隔（秒）
+PUBLIC_KEY_RETRY_INTERVAL = 300
+# 内存中缓存的已验证令牌数量
+DEFAULT_TOKEN_CACHE_SIZE = 16
+# 多卡密授权库：保存在验证文件所在目录，内存中最多缓存的解密记录数
+DEFAULT_LICENSE_DB = 'licenses.db'
+DEFAULT_LICENSE_CACHE_SIZE = 32
+# 验证文件写入：冗余的连续保存在这个时间窗口（秒）内合并为一次磁盘写入；备份文件保存最后一次同步写入的内容
+DEFAULT_WRITE_COALESCE_WINDOW = 0.2
+BACKUP_SUFFIX = '.bak'
+# 多进程读写验证文件时的文件锁：锁文件为验证文件路径加 .lock，等待锁最多这么久（秒）；
+# 读取超时后再等待这么多次，写入超时直接失败，任何情况下都不会不加锁读写
+LOCK_SUFFIX = '.lock'
+DEFAULT_LOCK_TIMEOUT = 2.0
+READ_LOCK_RETRIES = 1
+# 验证文件变更监控：无法使用 inotify / ReadDirectoryChangesW 时改为定时检查文件状态，间隔（秒）
+DEFAULT_WATCH_POLL_INTERVAL = 1.0
+# 各阶段耗时统计（默认关闭）：直方图各桶的上限（毫秒），超过最后一个上限的计入最后一桶；
+# 单次耗时达到阈值（秒）时调用慢操作回调
+TIMING_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+DEFAULT_SLOW_THRESHOLD = 1.0
+
+
+# 过期时间格式：2023-12-31、2023-12-31 23:59:59、2023-12-31T23:59:59.000Z、2023-12-31T23:59:59+08:00
+_EXPIRY_TIME_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d{2}:?\d{2})?$'
+)
+
+
+class _NullTimer:
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    __slots__ = ('timings', 'stage', 'start')
+    
+    def __init__(self, timings: 'StageTimings', stage: str):
+        self.timings = timings
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.timings.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimings:
+    """
+    验证流程各阶段耗时统计
+    
+    默认关闭，关闭时计时点只多一次属性判断。开启后按阶段记录次数、总耗时、最大耗时和直方图，
+    单次耗时达到 slow_threshold 秒时调用 slow_callback(阶段, 耗时秒)。
+    """
+    
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = DEFAULT_SLOW_THRESHOLD
+        self.slow_callback = None
+        self._lock = threading.Lock()
+        self._stages: Dict[str, List[Any]] = {}
+    
+    def enable(self, enabled: bool = True, slow_threshold: Optional[float] = None, slow_callback=None) -> None:
+        """开启或关闭统计，slow_callback 为None时保留原来的回调"""
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if slow_callback is not None:
+            self.slow_callback = slow_callback
+        self.enabled = enabled
+    
+    def timing(self, stage: str):
+        """计时上下文：with stage_timings.timing('阶段'): ..."""
+        return _StageTimer(self, stage) if self.enabled else _NULL_TIMER
+    
+    def record(self, stage: str, elapsed: float) -> None:
+        """记录一次耗时（秒）"""
+        bucket = min(bisect.bisect_left(TIMING_BUCKETS_MS, elapsed * 1000), len(TIMING_BUCKETS_MS) - 1)
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [0, 0.0, 0.0, [0] * len(TIMING_BUCKETS_MS)]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3][bucket] += 1
+        callback = self.slow_callback
+        if callback is not None and elapsed >= self.slow_threshold:
+            try:
+                callback(stage, elapsed)
+            except Exception as e:
+                print(f"慢操作回调执行失败: {e}")
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        按阶段导出统计：count 次数，total/avg/max 耗时（秒），
+        histogram 为各耗时区间的次数（键为区间上限，如 "<=5ms"，最后一桶包括更慢的）
+        """
+        labels = [f'<={bound:g}ms' for bound in TIMING_BUCKETS_MS]
+        with self._lock:
+            return {
+                stage: {
+                    'count': count,
+                    'total': total,
+                    'avg': total / count if count else 0.0,
+                    'max': max_time,
+                    'histogram': dict(zip(labels, buckets)),
+                }
+                for stage, (count, total, max_time, buckets) in sorted(self._stages.items())
+            }
+    
+    def reset(self) -> None:
+        with self._lock:
+            self._stages.clear()
+
+
+stage_timings = StageTimings()
+
+
+def timed_stage(stage: str):
+    """函数计时装饰器，统计关闭时直接调用原函数"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not stage_timings.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage_timings.record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def enable_timings(enabled: bool = True, slow_threshold: Optional[float] = None, slow_callback=None) -> None:
+    """开启或关闭各阶段耗时统计，slow_callback(阶段, 耗时秒) 在单次耗时达到 slow_threshold 秒时调用"""
+    stage_timings.enable(enabled, slow_threshold, slow_callback)
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """获取各阶段耗时统计，见 StageTimings.get_stats()"""
+    return stage_timings.get_stats()
+
+
+@timed_stage('parse_expiry')
+def parse_expiry_time(expiry_time: Any) -> Optional[float]:
+    """
+    将过期时间解析为Unix时间戳，无法解析时返回None
+    
+    带 Z 或时区偏移的时间按对应时区解析，不带时区的按本地时间解析；数字视为已是时间戳。
+    """
+    if isinstance(expiry_time, (int, float)) and not isinstance(expiry_time, bool):
+        return float(expiry_time)
+    if not isinstance(expiry_time, str):
+        return None
+    
+    match = _EXPIRY_TIME_PATTERN.match(expiry_time.strip())
+    if not match:
+        return None
+    
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    tzinfo = None
+    if zone == 'Z':
+        tzinfo = datetime.timezone.utc
+    elif zone:
+        sign = -1 if zone[0] == '-' else 1
+        digits = zone[1:].replace(':', '')
+        offset = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+        tzinfo = datetime.timezone(sign * offset)
+    
+    try:
+        expiry = datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour or 0), int(minute or 0), int(second or 0),
+            int((fraction or '0').ljust(6, '0')),
+            tzinfo=tzinfo,
+        )
+        return expiry.timestamp()
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+def get_record_expires_at(record: Optional[Dict[str, Any]]) -> Optional[float]:
+    """获取验证记录的过期时间戳，优先使用保存时记录的 expires_at"""
+    if not record:
+        return None
+    expires_at = record.get('expires_at')
+    if isinstance(expires_at, (int, float)) and not isinstance(expires_at, bool):
+        return float(expires_at)
+    data = record.get('data') or {}
+    return parse_expiry_time(data.get('expiryTime'))
+
+
+class SingleFlight:
+    """
+    合并相同键的并发调用
+    
+    同一键的调用正在进行时，后到的调用者不再重复执行，而是等待并共享第一次调用的结果（或异常）。
+    每个调用者（包括执行 func 的第一个调用者）得到的都是结果的独立副本，修改不会影响其他调用者。
+    """
+    
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result: Any = None
+            self.error: Optional[BaseException] = None
+            self.waiters = 0
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, 'SingleFlight._Call'] = {}
+    
+    def do(self, key: Any, func) -> Any:
+        """执行 func()，同一键并发调用时只执行一次，每个调用者得到结果的副本"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+            else:
+                call.waiters += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+        
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return copy.deepcopy(call.result)
+    
+    def in_flight(self) -> int:
+        """正在进行的调用数量"""
+        with self._lock:
+            return len(self._calls)
+
+
+class FileLockTimeout(OSError):
+    """等待文件锁超时，验证文件暂时无法读写"""
+    pass
+
+
+class FileLock:
+    """
+    跨进程文件锁（建议锁）
+    
+    共享锁用于读取，多个进程可以同时持有；排他锁用于写入和删除。Linux/macOS 使用 fcntl.flock，
+    Windows 使用 LockFileEx（通过 msvcrt 获取文件句柄，msvcrt.locking 不支持共享锁）。
+    每次加锁单独打开锁文件，同一进程的不同线程之间同样互斥。等待超过 timeout 秒时抛出 FileLockTimeout。
+    """
+    
+    def __init__(self, path: str, timeout: float = DEFAULT_LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self._stats = {'shared': 0, 'exclusive': 0, 'contended': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+    
+    if os.name == 'nt':
+        _overlapped_type = None
+        
+        @staticmethod
+        def _win_args(fd: int):
+            import ctypes
+            import msvcrt
+            from ctypes import wintypes
+            if FileLock._overlapped_type is None:
+                class _Overlapped(ctypes.Structure):
+                    _fields_ = [('Internal', ctypes.c_void_p), ('InternalHigh', ctypes.c_void_p),
+                                ('Offset', wintypes.DWORD), ('OffsetHigh', wintypes.DWORD),
+                                ('hEvent', wintypes.HANDLE)]
+                FileLock._overlapped_type = _Overlapped
+            handle = wintypes.HANDLE(msvcrt.get_osfhandle(fd))
+            return ctypes.windll.kernel32, handle, ctypes.byref(FileLock._overlapped_type())
+        
+        @staticmethod
+        def _try_lock(fd: int, exclusive: bool) -> bool:
+            kernel32, handle, overlapped = FileLock._win_args(fd)
+            flags = 0x1  # LOCKFILE_FAIL_IMMEDIATELY
+            if exclusive:
+                flags |= 0x2  # LOCKFILE_EXCLUSIVE_LOCK
+            return bool(kernel32.LockFileEx(handle, flags, 0, 1, 0, overlapped))
+        
+        @staticmethod
+        def _unlock(fd: int) -> None:
+            kernel32, handle, overlapped = FileLock._win_args(fd)
+            kernel32.UnlockFileEx(handle, 0, 1, 0, overlapped)
+    else:
+        @staticmethod
+        def _try_lock(fd: int, exclusive: bool) -> bool:
+            import fcntl
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                return False
+        
+        @staticmethod
+        def _unlock(fd: int) -> None:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    
+    def acquire(self, exclusive: bool = False, timeout: Optional[float] = None) -> int:
+        """加锁并返回锁文件描述符，传给 release() 释放（关闭描述符即释放锁）"""
+        timeout = self.timeout if timeout is None else timeout
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        start = None
+        delay = 0.001
+        try:
+            while not self._try_lock(fd, exclusive):
+                now = time.monotonic()
+                if start is None:
+                    start = now
+                elif now - start >= timeout:
+                    with self._stats_lock:
+                        self._stats['contended'] += 1
+                        self._stats['timeouts'] += 1
+                        self._stats['wait_seconds'] += now - start
+                    raise FileLockTimeout(f"等待文件锁超时: {self.path}")
+                time.sleep(min(delay, max(timeout - (now - start), 0.0)))
+                delay = min(delay * 2, 0.05)
+        except BaseException:
+            os.close(fd)
+            raise
+        with self._stats_lock:
+            self._stats['exclusive' if exclusive else 'shared'] += 1
+            if start is not None:
+                waited = time.monotonic() - start
+                self._stats['contended'] += 1
+                self._stats['wait_seconds'] += waited
+        if start is not None and stage_timings.enabled:
+            stage_timings.record('file.lock_wait', waited)
+        return fd
+    
+    @staticmethod
+    def release(fd: int) -> None:
+        try:
+            FileLock._unlock(fd)
+        finally:
+            os.close(fd)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """加锁次数（shared/exclusive）、需要等待的次数（contended）、超时次数和累计等待时间"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 6)
+        return stats
+
+
+def atomic_write_file(path: str, data: bytes) -> None:
+    """
+    原子写入文件：先写入同目录下的临时文件并 fsync，再重命名覆盖目标文件
+    
+    写入过程中崩溃或断电时，目标文件保持原来的完整内容，不会出现写了一半的文件。
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if os.name != 'nt':
+        # 重命名本身也要落盘，否则断电后目录中可能仍是旧文件
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+
+class AtomicFileWriter:
+    """
+    验证文件写入器
+    
+    每次写入都是原子的（临时文件、fsync、重命名）。sync 写入立即落盘，并同样原子地更新备份文件（路径加 .bak），
+    作为最后一次完好的副本，因此每次 sync 写入会写两个文件。调用方只对冗余的写入（例如只刷新复验时间）
+    不传 sync：一段时间内的第一次立即落盘（不更新备份），窗口内随后的写入只保留最新内容，在窗口结束时
+    合并为一次写入，进程退出时写入未落盘的内容；进程崩溃或被强制结束时最多丢失这些冗余写入。
+    写入失败时 write()、flush() 抛出 OSError；后台合并写入失败时，下一次 write() 立即写入并报告错误。
+    同一路径在进程内共用一个写入器，通过 get_file_writer() 获取。
+    
+    读取时持有共享锁、写入和删除时持有排他锁（锁文件为路径加 .lock），多个进程共用同一文件时不会读到
+    正在替换的文件；Windows 上也不会因为其他进程正打开文件而替换失败。从不在没有锁的情况下读写：
+    读取等锁超时后重试 READ_LOCK_RETRIES 次，仍超时或写入等锁超时时抛出 FileLockTimeout，
+    无法创建锁文件时抛出 OSError。超时次数记录在 lock.get_stats() 中。
+    """
+    
+    def __init__(self, path: str, coalesce_window: float = DEFAULT_WRITE_COALESCE_WINDOW, backup: bool = True,
+                 lock_timeout: float = DEFAULT_LOCK_TIMEOUT):
+        self.path = path
+        self.backup_path = path + BACKUP_SUFFIX if backup else None
+        self.coalesce_window = coalesce_window
+        self.lock = FileLock(path + LOCK_SUFFIX, lock_timeout)
+        self._lock = threading.RLock()
+        self._pending: Optional[bytes] = None
+        self._timer: Optional[threading.Timer] = None
+        self._failed: Optional[OSError] = None
+        self._last_write = 0.0
+        self.writes = 0
+        self.coalesced = 0
+    
+    def _lock_file(self, exclusive: bool) -> int:
+        """加文件锁；共享锁超时后重试，仍超时或排他锁超时时抛出 FileLockTimeout"""
+        retries = 0 if exclusive else READ_LOCK_RETRIES
+        while True:
+            try:
+                return self.lock.acquire(exclusive)
+            except FileLockTimeout:
+                if retries <= 0:
+                    raise
+                retries -= 1
+    
+    def _unlock_file(self, fd: int) -> None:
+        self.lock.release(fd)
+    
+    @timed_stage('file.read')
+    def _read_file(self, path: str) -> bytes:
+        fd = self._lock_file(exclusive=False)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            self._unlock_file(fd)
+    
+    @timed_stage('file.write')
+    def _write_now(self, data: bytes, backup: bool = False) -> None:
+        fd = self._lock_file(exclusive=True)
+        try:
+            atomic_write_file(self.path, data)
+            if backup and self.backup_path:
+                atomic_write_file(self.backup_path, data)
+        finally:
+            self._unlock_file(fd)
+        self._failed = None
+        self._last_write = time.monotonic()
+        self.writes += 1
+    
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+    
+    def write(self, data: bytes, sync: bool = False) -> None:
+        """
+        写入数据，失败时抛出 OSError
+        
+        sync 为True时立即落盘并更新备份，取代尚未落盘的内容；否则处于合并窗口内时推迟到窗口结束再落盘。
+        """
+        with self._lock:
+            # 上次推迟的写入失败时立即写入，让调用方得知
+            sync = sync or self._failed is not None
+            wait = self._last_write + self.coalesce_window - time.monotonic()
+            if sync or (self._timer is None and wait <= 0):
+                self._cancel_timer()
+                self._write_now(data, backup=sync)
+                self._pending = None
+                return
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = data
+            if self._timer is None:
+                self._timer = threading.Timer(max(wait, 0.0), self._flush_timer)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def _flush_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            try:
+                self._flush_pending()
+            except OSError as e:
+                # 内容保留在 _pending 中，下一次 write() 或 flush() 时重试并报告错误
+                print(f"写入文件失败: {self.path}: {e}")
+    
+    def _flush_pending(self) -> None:
+        if self._pending is None:
+            return
+        try:
+            self._write_now(self._pending)
+        except OSError as e:
+            self._failed = e
+            raise
+        self._pending = None
+    
+    def flush(self) -> None:
+        """立即写入尚未落盘的内容，失败时抛出 OSError"""
+        with self._lock:
+            self._cancel_timer()
+            self._flush_pending()
+    
+    def pending(self) -> Optional[bytes]:
+        """尚未落盘的内容，没有时返回None"""
+        with self._lock:
+            return self._pending
+    
+    def read(self) -> Optional[bytes]:
+        """读取最新内容（包括尚未落盘的），文件不存在时返回None"""
+        with self._lock:
+            if self._pending is not None:
+                return self._pending
+        try:
+            return self._read_file(self.path)
+        except FileNotFoundError:
+            return None
+    
+    def read_backup(self) -> Optional[bytes]:
+        """读取最后一次完好的副本，没有时返回None"""
+        if not self.backup_path:
+            return None
+        try:
+            return self._read_file(self.backup_path)
+        except OSError:
+            return None
+    
+    def restore_backup(self) -> bool:
+        """用备份文件恢复损坏的文件"""
+        data = self.read_backup()
+        if data is None:
+            return False
+        with self._lock:
+            if self._pending is not None:
+                return False
+            fd = self._lock_file(exclusive=True)
+            try:
+                atomic_write_file(self.path, data)
+            finally:
+                self._unlock_file(fd)
+        return True
+    
+    def remove(self, backup: bool = True) -> None:
+        """丢弃尚未落盘的内容并删除文件（backup 为True时同时删除备份）"""
+        with self._lock:
+            self._cancel_timer()
+            self._pending = None
+            self._failed = None
+            paths = [self.path] + ([self.backup_path] if backup and self.backup_path else [])
+            fd = self._lock_file(exclusive=True)
+            try:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                self._unlock_file(fd)
+
+
+_file_writers: Dict[str, AtomicFileWriter] = {}
+_file_writers_lock = threading.Lock()
+
+
+def get_file_writer(path: str) -> AtomicFileWriter:
+    """获取路径对应的写入器，同一文件在进程内只有一个写入器"""
+    path = os.path.abspath(path)
+    with _file_writers_lock:
+        writer = _file_writers.get(path)
+        if writer is None:
+            writer = _file_writers[path] = AtomicFileWriter(path)
+        return writer
+
+
+class FileWatcher:
+    """
+    验证文件变更监控
+    
+    在后台线程中监控文件所在目录，文件被创建、修改、替换或删除时调用 callback(path)，
+    其他进程重新验证或清理验证文件后，本进程几毫秒内即可得知，无需定时重新读取解密。
+    Linux 使用 inotify，Windows 使用 ReadDirectoryChangesW，都不可用时每隔 poll_interval 秒
+    比较一次文件的 (mtime, size, inode)。同一批事件只调用一次回调，本进程自己的写入也会触发。
+    """
+    
+    # inotify 事件：写入后关闭、移入（原子替换）、移出、创建、删除
+    _IN_EVENTS = 0x8 | 0x80 | 0x40 | 0x100 | 0x200
+    # ReadDirectoryChangesW：文件名、大小、最后写入时间变化
+    _WIN_FILTER = 0x1 | 0x8 | 0x10
+    
+    def __init__(self, path: str, callback, poll_interval: float = DEFAULT_WATCH_POLL_INTERVAL,
+                 use_native: bool = True):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.use_native = use_native
+        self.backend: Optional[str] = None
+        self.events = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._wake_fds: Optional[Tuple[int, int]] = None
+        self._win_handle = None
+    
+    def start(self) -> 'FileWatcher':
+        """启动监控线程，backend 为实际使用的方式：inotify、windows 或 polling"""
+        if self._thread is not None:
+            return self
+        target = self._poll_loop
+        self.backend = 'polling'
+        if self.use_native:
+            try:
+                if sys.platform.startswith('linux'):
+                    target = self._inotify_setup()
+                    self.backend = 'inotify'
+                elif os.name == 'nt':
+                    target = self._windows_setup()
+                    self.backend = 'windows'
+            except (OSError, AttributeError) as e:
+                print(f"无法使用系统文件监控，改为定时检查: {e}")
+        self._thread = threading.Thread(target=target, name='kami-file-watcher', daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        """停止监控线程"""
+        self._stop.set()
+        if self._wake_fds is not None:
+            try:
+                os.write(self._wake_fds[1], b'x')
+            except OSError:
+                pass
+        if self._win_handle is not None:
+            import ctypes
+            ctypes.windll.kernel32.CancelIoEx(self._win_handle, None)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.poll_interval + 1)
+        self._thread = None
+    
+    def _notify(self) -> None:
+        self.events += 1
+        try:
+            self.callback(self.path)
+        except Exception as e:
+            print(f"文件变更回调执行失败: {e}")
+    
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    
+    def _poll_loop(self) -> None:
+        last = self._stat()
+        while not self._stop.wait(self.poll_interval):
+            current = self._stat()
+            if current != last:
+                last = current
+                self._notify()
+    
+    def _inotify_setup(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+        directory = os.path.dirname(self.path).encode()
+        if libc.inotify_add_watch(fd, directory, FileWatcher._IN_EVENTS) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, 'inotify_add_watch 失败')
+        self._wake_fds = os.pipe()
+        return lambda: self._inotify_loop(fd)
+    
+    def _inotify_loop(self, fd: int) -> None:
+        import select
+        import struct
+        name = os.path.basename(self.path).encode()
+        wake_r, wake_w = self._wake_fds
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select([fd, wake_r], [], [])
+                if wake_r in readable:
+                    break
+                try:
+                    buf = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                changed = False
+                offset = 0
+                # struct inotify_event { int wd; uint32 mask, cookie, len; char name[len]; }
+                while offset + 16 <= len(buf):
+                    _, _, _, length = struct.unpack_from('iIII', buf, offset)
+                    if buf[offset + 16:offset + 16 + length].rstrip(b'\0') == name:
+                        changed = True
+                    offset += 16 + length
+                if changed:
+                    self._notify()
+        finally:
+            os.close(fd)
+            os.close(wake_r)
+            os.close(wake_w)
+            self._wake_fds = None
+    
+    def _windows_setup(self):
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        handle = kernel32.CreateFileW(
+            os.path.dirname(self.path), 0x1,  # FILE_LIST_DIRECTORY
+            0x1 | 0x2 | 0x4, None, 3,  # FILE_SHARE_READ | WRITE | DELETE, OPEN_EXISTING
+            0x02000000, None  # FILE_FLAG_BACKUP_SEMANTICS
+        )
+        if handle in (None, wintypes.HANDLE(-1).value):
+            raise OSError(ctypes.GetLastError(), 'CreateFileW 失败')
+        self._win_handle = wintypes.HANDLE(handle)
+        return self._windows_loop
+    
+    def _windows_loop(self) -> None:
+        import ctypes
+        import struct
+        from ctypes import wintypes
+        kernel32 = ctypes.windll.kernel32
+        name = os.path.basename(self.path).lower()
+        buf = ctypes.create_string_buffer(65536)
+        returned = wintypes.DWORD()
+        try:
+            while not self._stop.is_set():
+                # 同步等待目录变化，stop() 调用 CancelIoEx 后返回失败
+                if not kernel32.ReadDirectoryChangesW(self._win_handle, buf, len(buf), False,
+                                                      FileWatcher._WIN_FILTER, ctypes.byref(returned),
+                                                      None, None):
+                    break
+                data = buf.raw[:returned.value]
+                changed = False
+                offset = 0
+                # FILE_NOTIFY_INFORMATION { DWORD NextEntryOffset, Action, FileNameLength; WCHAR FileName[]; }
+                while offset + 12 <= len(data):
+                    next_offset, _, length = struct.unpack_from('<III', data, offset)
+                    if data[offset + 12:offset + 12 + length].decode('utf-16-le').lower() == name:
+                        changed = True
+                    if not next_offset:
+                        break
+                    offset += next_offset
+                if changed or not data:
+                    # 缓冲区溢出时 returned 为0，无法得知具体文件，按变化处理
+                    self._notify()
+        finally:
+            kernel32.CloseHandle(self._win_handle)
+            self._win_handle = None
+
+
+@atexit.register
+def flush_file_writers() -> None:
+    """写入所有尚未落盘的内容，进程退出时自动调用"""
+    with _file_writers_lock:
+        writers = list(_file_writers.values())
+    for writer in writers:
+        try:
+            writer.flush()
+        except OSError as e:
+            print(f"写入文件失败: {writer.path}: {e}")
+
+
+class _WmiProbeRun:
+    """
+    一次硬件采集内共享的WMI查询
+    
+    各采集线程并行调用，第一个调用者用同一个WMI连接查完 queries 中的全部属性，
+    其余调用者等待它的结果，避免每项采集都建立一次WMI连接。
+    """
+    
+    def __init__(self, queries):
+        self.queries = tuple(queries)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = False
+        self._results: Optional[Dict[Tuple[str, str], Optional[str]]] = None
+    
+    def get(self, wmi_class: str, prop: str) -> Optional[str]:
+        if (wmi_class, prop) not in self.queries:
+            return HardwareInfo._query_wmi_all([(wmi_class, prop)]).get((wmi_class, prop))
+        
+        with self._lock:
+            leader = not self._started
+            self._started = True
+        if leader:
+            try:
+                self._results = HardwareInfo._query_wmi_all(self.queries)
+            finally:
+                self._done.set()
+        else:
+            self._done.wait()
+        return (self._results or {}).get((wmi_class, prop))
+
+
+class HardwareProbeStats:
+    """一次硬件ID获取过程的统计信息"""
+    
+    def __init__(self):
+        self.source = 'probe'  # probe：实际采集；disk：命中磁盘缓存
+        self.total_time = 0.0
+        self.durations: Dict[str, float] = {}
+        self.timed_out: List[str] = []
+    
+    @property
+    def complete(self) -> bool:
+        """所有硬件信息是否都在期限内采集完成"""
+        return not self.timed_out
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'source': self.source,
+            'total_time': self.total_time,
+            'durations': dict(self.durations),
+            'timed_out': list(self.timed_out),
+        }
 
 
 class HardwareInfo:
     """硬件信息收集工具类"""
     
+    # 进程内缓存的硬件ID，以及可选的磁盘缓存文件
+    _cached_hardware_id: Optional[str] = None
+    _cache_lock = threading.Lock()
+    cache_file: Optional[str] = DEFAULT_HARDWARE_CACHE_FILE
+    # 单项采集期限和整体时间预算（秒）
+    probe_timeout: float = DEFAULT_PROBE_TIMEOUT
+    probe_budget: float = DEFAULT_PROBE_BUDGET
+    last_probe_stats: Optional[HardwareProbeStats] = None
+    # 采集线程中记录本次采集共享的WMI查询（_WmiProbeRun）
+    _probe_local = threading.local()
+    
+    @staticmethod
+    def _read_sys_file(path: str) -> Optional[str]:
+        """读取 sysfs/procfs 文件并去掉首尾空白，文件不存在或为空时返回None"""
+        try:
+            with open(path, 'r') as f:
+                value = f.read().strip()
+            return value or None
+        except (OSError, UnicodeDecodeError):
+            return None
+    
+    @staticmethod
+    def _query_wmi_all(queries) -> Dict[Tuple[str, str], Optional[str]]:
+        """
+        用同一个WMI连接依次查询多个 (类名, 属性) 第一条记录的值
+        
+        每项返回值与 wmic 输出首行一致（去掉首尾空白）；WMI不可用、连接失败或单项查询失败时该项为None。
+        """
+        results: Dict[Tuple[str, str], Optional[str]] = {query: None for query in queries}
+        try:
+            import pythoncom
+            import wmi
+        except ImportError:
+            return results
+        
+        try:
+            pythoncom.CoInitialize()
+            try:
+                connection = wmi.WMI()
+                for wmi_class, prop in queries:
+                    try:
+                        rows = getattr(connection, wmi_class)([prop])
+                        results[(wmi_class, prop)] = str(getattr(rows[0], prop) or '').strip() if rows else ''
+                    except Exception:
+                        pass
+            finally:
+                pythoncom.CoUninitialize()
+        except Exception:
+            pass
+        return results
+    
+    @staticmethod
+    def _query_wmi(wmi_class: str, prop: str) -> Optional[str]:
+        """
+        进程内查询WMI第一条记录的属性，替代启动 wmic 子进程
+        
+        在 probe_hardware_id 中调用时与其他采集项共用一个WMI连接。
+        返回值与 wmic 输出首行一致（去掉首尾空白）；WMI不可用或查询失败时返回None。
+        """
+        wmi_run = getattr(HardwareInfo._probe_local, 'wmi_run', None)
+        if wmi_run is not None:
+            return wmi_run.get(wmi_class, prop)
+        return HardwareInfo._query_wmi_all([(wmi_class, prop)])[(wmi_class, prop)]
+    
+    @staticmethod
+    def get_machine_id() -> Optional[str]:
+        """获取系统机器ID（Linux 的 /etc/machine-id 或 Windows 的 MachineGuid），不启动子进程"""
+        if platform.system() == "Windows":
+            try:
+                import winreg
+                with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography",
+                                    0, winreg.KEY_READ | winreg.KEY_WOW64_64KEY) as reg_key:
+                    return str(winreg.QueryValueEx(reg_key, "MachineGuid")[0])
+            except Exception:
+                return None
+        
+        for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+            machine_id = HardwareInfo._read_sys_file(path)
+            if machine_id:
+                return machine_id
+        return None
+    
     @staticmethod
     def get_cpu_id() -> str:
         """获取CPU ID"""
         if platform.system() == "Windows":
-            try:
-                output = subprocess.check_output("wmic cpu get ProcessorId", shell=True).decode()
-                return output.strip().split('\n')[1].strip()
-            except:
-                pass
+            processor_id = HardwareInfo._query_wmi('Win32_Processor', 'ProcessorId')
+            if processor_id:
+                return processor_id
+            if processor_id is None:
+                try:
+                    output = subprocess.check_output("wmic cpu get ProcessorId", shell=True,
+                                                     timeout=HardwareInfo.probe_timeout).decode()
+                    return output.strip().split('\n')[1].strip()
+                except:
+                    pass
         elif platform.system() == "Linux":
             try:
                 with open('/proc/cpuinfo', 'r') as f:
@@ -60,7 +1033,8 @@ class HardwareInfo:
                 pass
         elif platform.system() == "Darwin":  # macOS
             try:
-                output = subprocess.check_output("ioreg -l | grep IOPlatformSerialNumber", shell=True).decode()
+                output = subprocess.check_output("ioreg -l | grep IOPlatformSerialNumber", shell=True,
+                                                 timeout=HardwareInfo.probe_timeout).decode()
                 return output.strip().split('=')[1].strip().replace('"', '')
             except:
                 pass
@@ -71,15 +1045,21 @@ class HardwareInfo:
     def get_disk_serial() -> str:
         """获取硬盘序列号"""
         if platform.system() == "Windows":
+            serial = HardwareInfo._query_wmi('Win32_DiskDrive', 'SerialNumber')
+            if serial is not None:
+                return serial if serial else str(uuid.getnode())
             try:
-                output = subprocess.check_output("wmic diskdrive get SerialNumber", shell=True).decode()
+                output = subprocess.check_output("wmic diskdrive get SerialNumber", shell=True,
+                                                 timeout=HardwareInfo.probe_timeout).decode()
                 serial = output.strip().split('\n')[1].strip()
                 return serial if serial and serial != "" else str(uuid.getnode())
             except:
                 pass
         elif platform.system() == "Linux":
+            # 硬件ID依赖 lsblk 的输出格式（设备顺序、列宽），不自行读取 sysfs 拼装，以免与已有验证文件不一致
             try:
-                output = subprocess.check_output("lsblk -d -o name,serial | grep -v loop", shell=True).decode()
+                output = subprocess.check_output("lsblk -d -o name,serial | grep -v loop", shell=True,
+                                                 timeout=HardwareInfo.probe_timeout).decode()
                 return output.strip().split('\n')[1].strip()
             except:
                 pass
@@ -91,141 +1071,986 @@ class HardwareInfo:
     def get_motherboard_serial() -> str:
         """获取主板序列号"""
         if platform.system() == "Windows":
-            try:
-                output = subprocess.check_output("wmic baseboard get SerialNumber", shell=True).decode()
-                return output.strip().split('\n')[1].strip()
-            except:
-                pass
+            serial = HardwareInfo._query_wmi('Win32_BaseBoard', 'SerialNumber')
+            if serial:
+                return serial
+            if serial is None:
+                try:
+                    output = subprocess.check_output("wmic baseboard get SerialNumber", shell=True,
+                                                     timeout=HardwareInfo.probe_timeout).decode()
+                    return output.strip().split('\n')[1].strip()
+                except:
+                    pass
         elif platform.system() == "Linux":
             try:
-                output = subprocess.check_output("dmidecode -s baseboard-serial-number", shell=True).decode()
-                return output.strip()
-            except:
-                pass
+                with open('/sys/class/dmi/id/board_serial', 'r') as f:
+                    serial = f.read().strip()
+                if serial:
+                    return serial
+                run_dmidecode = True
+            except PermissionError:
+                # 普通用户无权读取时 dmidecode 同样会失败，直接使用兜底值
+                run_dmidecode = False
+            except OSError:
+                run_dmidecode = True
+            
+            if run_dmidecode:
+                try:
+                    output = subprocess.check_output("dmidecode -s baseboard-serial-number", shell=True,
+                                                     timeout=HardwareInfo.probe_timeout).decode()
+                    return output.strip()
+                except:
+                    pass
         
         # 如果无法获取特定序列号，使用计算机名称和当前用户名
         return platform.node() + os.getlogin()
     
     @staticmethod
-    def generate_hardware_id() -> str:
-        """生成唯一的硬件标识符"""
-        cpu_id = HardwareInfo.get_cpu_id()
-        disk_serial = HardwareInfo.get_disk_serial()
-        motherboard_serial = HardwareInfo.get_motherboard_serial()
+    def get_boot_key() -> str:
+        """
+        获取本次开机和本机的廉价标识（不启动子进程）
         
-        hardware_info = f"{cpu_id}|{disk_serial}|{motherboard_serial}"
+        用于判断磁盘缓存的硬件ID是否仍然可信：重启或换机后标识会变化，缓存随之失效。
+        """
+        parts = [platform.system(), platform.node()]
+        
+        boot_id = HardwareInfo._read_sys_file('/proc/sys/kernel/random/boot_id')
+        if boot_id:
+            parts.append(boot_id)
+        machine_id = HardwareInfo.get_machine_id()
+        if machine_id:
+            parts.append(machine_id)
+        
+        if platform.system() == "Windows":
+            try:
+                import ctypes
+                get_tick_count = ctypes.windll.kernel32.GetTickCount64
+                get_tick_count.restype = ctypes.c_ulonglong
+                # 开机时间精确到分钟，避免计算误差导致缓存频繁失效
+                parts.append(str(int(time.time() - get_tick_count() / 1000) // 60))
+            except Exception:
+                pass
+        
+        return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+    
+    @staticmethod
+    @timed_stage('hardware.cache_file')
+    def _load_cache_file(boot_key: str) -> Optional[str]:
+        """读取磁盘缓存的硬件ID，标识不匹配时返回None"""
+        if not HardwareInfo.cache_file or not os.path.exists(HardwareInfo.cache_file):
+            return None
+        try:
+            with open(HardwareInfo.cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('boot_key') == boot_key and cache.get('hardware_id'):
+                return cache['hardware_id']
+        except Exception:
+            pass
+        return None
+    
+    @staticmethod
+    def _save_cache_file(boot_key: str, hardware_id: str) -> None:
+        """写入磁盘缓存，失败时忽略"""
+        if not HardwareInfo.cache_file:
+            return
+        try:
+            with open(HardwareInfo.cache_file, 'w') as f:
+                json.dump({'boot_key': boot_key, 'hardware_id': hardware_id}, f)
+        except Exception:
+            pass
+    
+    @staticmethod
+    def set_cache_file(cache_file: Optional[str]) -> None:
+        """设置硬件ID磁盘缓存文件，传入None关闭磁盘缓存"""
+        with HardwareInfo._cache_lock:
+            HardwareInfo.cache_file = cache_file
+    
+    @staticmethod
+    def invalidate_cache(remove_file: bool = True) -> None:
+        """清除缓存的硬件ID，下次调用时重新采集硬件信息"""
+        with HardwareInfo._cache_lock:
+            HardwareInfo._cached_hardware_id = None
+            if remove_file and HardwareInfo.cache_file:
+                try:
+                    os.remove(HardwareInfo.cache_file)
+                except OSError:
+                    pass
+    
+    @staticmethod
+    def _fallback_cpu_id() -> str:
+        return platform.processor() + platform.machine()
+    
+    @staticmethod
+    def _fallback_disk_serial() -> str:
+        return str(uuid.getnode())
+    
+    @staticmethod
+    def _fallback_motherboard_serial() -> str:
+        return platform.node() + os.getlogin()
+    
+    @staticmethod
+    @timed_stage('hardware.probe')
+    def probe_hardware_id(probe_timeouts: Optional[Dict[str, float]] = None,
+                          total_timeout: Optional[float] = None) -> str:
+        """
+        并行采集硬件信息并计算硬件标识符（不使用缓存）
+        
+        每项采集在独立线程中运行，超过自身期限或总时间预算的项改用固定的兜底值，
+        因此结果仍是确定的；超时项记录在 last_probe_stats.timed_out 中。
+        """
+        probes = (
+            ('cpu', HardwareInfo.get_cpu_id, HardwareInfo._fallback_cpu_id),
+            ('disk', HardwareInfo.get_disk_serial, HardwareInfo._fallback_disk_serial),
+            ('motherboard', HardwareInfo.get_motherboard_serial, HardwareInfo._fallback_motherboard_serial),
+        )
+        if total_timeout is None:
+            total_timeout = HardwareInfo.probe_budget
+        
+        stats = HardwareProbeStats()
+        results: Dict[str, str] = {}
+        errors: Dict[str, BaseException] = {}
+        
+        wmi_run = _WmiProbeRun(WMI_PROBE_QUERIES)
+        
+        def run_probe(name, probe):
+            probe_start = time.perf_counter()
+            HardwareInfo._probe_local.wmi_run = wmi_run
+            try:
+                results[name] = probe()
+            except BaseException as e:
+                errors[name] = e
+            finally:
+                stats.durations.setdefault(name, time.perf_counter() - probe_start)
+                if stage_timings.enabled:
+                    stage_timings.record(f'hardware.probe.{name}', time.perf_counter() - probe_start)
+        
+        start = time.perf_counter()
+        threads = []
+        for name, probe, _ in probes:
+            # 守护线程：卡死的 wmic 不会阻止进程退出
+            thread = threading.Thread(target=run_probe, args=(name, probe), daemon=True)
+            thread.start()
+            threads.append(thread)
+        
+        values = []
+        for (name, _, fallback), thread in zip(probes, threads):
+            timeout = (probe_timeouts or {}).get(name, HardwareInfo.probe_timeout)
+            deadline = start + min(timeout, total_timeout)
+            thread.join(max(0.0, deadline - time.perf_counter()))
+            
+            if thread.is_alive():
+                stats.timed_out.append(name)
+                stats.durations[name] = time.perf_counter() - start
+                values.append(fallback())
+            elif name in errors:
+                raise errors[name]
+            else:
+                values.append(results[name])
+        
+        stats.total_time = time.perf_counter() - start
+        HardwareInfo.last_probe_stats = stats
+        if stats.timed_out:
+            print(f"硬件信息采集超时: {', '.join(stats.timed_out)}，已使用兜底值")
+        
+        hardware_info = "|".join(values)
         hardware_hash = hashlib.sha256(hardware_info.encode()).hexdigest()
         
         return hardware_hash
+    
+    @staticmethod
+    def get_probe_stats() -> Optional[HardwareProbeStats]:
+        """获取最近一次 generate_hardware_id 的统计信息"""
+        return HardwareInfo.last_probe_stats
+    
+    @staticmethod
+    def is_complete(hardware_id: str) -> bool:
+        """硬件ID是否来自完整的采集（没有超时项）；只有完整采集的结果会进入缓存"""
+        return hardware_id is not None and hardware_id == HardwareInfo._cached_hardware_id
+    
+    @staticmethod
+    def generate_hardware_id(use_cache: bool = True) -> str:
+        """
+        生成唯一的硬件标识符
+        
+        默认使用进程内缓存，其次是磁盘缓存（需设置 cache_file），都未命中时才采集硬件信息。
+        use_cache=False 时强制重新采集并刷新缓存。有超时项（使用了兜底值）的结果不缓存，
+        下次调用时重新采集，可以用 is_complete 判断返回的硬件ID是否完整。
+        """
+        if use_cache:
+            cached = HardwareInfo._cached_hardware_id
+            if cached is not None:
+                return cached
+        
+        with HardwareInfo._cache_lock:
+            if use_cache and HardwareInfo._cached_hardware_id is not None:
+                return HardwareInfo._cached_hardware_id
+            
+            start = time.perf_counter()
+            boot_key = HardwareInfo.get_boot_key() if HardwareInfo.cache_file else ''
+            hardware_id = HardwareInfo._load_cache_file(boot_key) if use_cache else None
+            if hardware_id is None:
+                hardware_id = HardwareInfo.probe_hardware_id()
+                # 有超时项的结果与真实硬件ID不同，不写入任何缓存
+                if not (HardwareInfo.last_probe_stats and HardwareInfo.last_probe_stats.complete):
+                    return hardware_id
+                HardwareInfo._save_cache_file(boot_key, hardware_id)
+            else:
+                stats = HardwareProbeStats()
+                stats.source = 'disk'
+                stats.total_time = time.perf_counter() - start
+                HardwareInfo.last_probe_stats = stats
+            
+            HardwareInfo._cached_hardware_id = hardware_id
+            return hardware_id
+
+
+class KdfParams:
+    """密钥派生参数，随验证文件的文件头一起保存"""
+    
+    SUPPORTED_ALGORITHMS = ('pbkdf2-sha256', 'scrypt')
+    
+    def __init__(self,
+                 algorithm: str = DEFAULT_KDF_ALGORITHM,
+                 salt: bytes = DEFAULT_SALT,
+                 iterations: int = DEFAULT_KDF_ITERATIONS,
+                 n: int = 2 ** 14,
+                 r: int = 8,
+                 p: int = 1):
+        if algorithm not in self.SUPPORTED_ALGORITHMS:
+            raise ValueError(f"不支持的密钥派生算法: {algorithm}")
+        self.algorithm = algorithm
+        self.salt = salt
+        self.iterations = iterations
+        self.n = n
+        self.r = r
+        self.p = p
+    
+    @timed_stage('encryption.kdf')
+    def derive(self, secret: bytes) -> bytes:
+        """派生32字节原始密钥"""
+        if self.algorithm == 'scrypt':
+            kdf = Scrypt(salt=self.salt, length=32, n=self.n, r=self.r, p=self.p)
+        else:
+            kdf = PBKDF2HMAC(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=self.salt,
+                iterations=self.iterations,
+            )
+        return kdf.derive(secret)
+    
+    def cache_key(self) -> Tuple[Any, ...]:
+        if self.algorithm == 'scrypt':
+            return (self.algorithm, self.salt, self.n, self.r, self.p)
+        return (self.algorithm, self.salt, self.iterations)
+    
+    def to_header(self) -> Dict[str, Any]:
+        """转换为文件头中的参数字段"""
+        header: Dict[str, Any] = {
+            'kdf': self.algorithm,
+            'salt': base64.b64encode(self.salt).decode(),
+        }
+        if self.algorithm == 'scrypt':
+            header.update({'n': self.n, 'r': self.r, 'p': self.p})
+        else:
+            header['iterations'] = self.iterations
+        return header
+    
+    @classmethod
+    def from_header(cls, header: Dict[str, Any]) -> 'KdfParams':
+        """从文件头恢复参数，参数超出允许范围时抛出 ValueError"""
+        params = cls(
+            algorithm=header.get('kdf', DEFAULT_KDF_ALGORITHM),
+            salt=base64.b64decode(header['salt']) if 'salt' in header else DEFAULT_SALT,
+            iterations=int(header.get('iterations', DEFAULT_KDF_ITERATIONS)),
+            n=int(header.get('n', 2 ** 14)),
+            r=int(header.get('r', 8)),
+            p=int(header.get('p', 1)),
+        )
+        if len(params.salt) > MAX_KDF_SALT_LENGTH:
+            raise ValueError(f"密钥派生盐过长: {len(params.salt)}")
+        if params.algorithm == 'scrypt':
+            if params.n not in SCRYPT_ALLOWED_N or not 1 <= params.r <= MAX_SCRYPT_R or \
+                    not 1 <= params.p <= MAX_SCRYPT_P:
+                raise ValueError(f"不支持的scrypt参数: n={params.n}, r={params.r}, p={params.p}")
+        elif not 1 <= params.iterations <= MAX_KDF_ITERATIONS:
+            raise ValueError(f"不支持的迭代次数: {params.iterations}")
+        return params
 
 
 class KamiEncryption:
     """卡密验证加密工具类"""
     
-    def __init__(self, salt: bytes = DEFAULT_SALT):
+    # 进程内共享的派生密钥缓存：(硬件ID, KDF参数) -> (密钥, Fernet实例)
+    _key_cache: "OrderedDict[Tuple[Any, ...], Tuple[bytearray, Any]]" = OrderedDict()
+    _key_cache_lock = threading.Lock()
+    key_cache_size: int = DEFAULT_KEY_CACHE_SIZE
+    
+    def __init__(self, salt: bytes = DEFAULT_SALT, iterations: int = DEFAULT_KDF_ITERATIONS,
+                 kdf: Optional[KdfParams] = None):
         self.salt = salt
+        self.iterations = iterations
+        # 保存时使用的参数；旧版无文件头的文件固定为 PBKDF2 + 默认迭代次数
+        self.kdf = kdf or KdfParams(salt=salt, iterations=iterations)
+        self.legacy_kdf = KdfParams(salt=salt, iterations=DEFAULT_KDF_ITERATIONS)
     
     def get_key_from_hardware(self) -> bytes:
         """从当前硬件生成加密密钥"""
         hardware_id = HardwareInfo.generate_hardware_id()
         return self.get_key(hardware_id)
     
-    def get_key(self, hardware_id: str) -> bytes:
-        """从硬件ID生成加密密钥"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=self.salt,
-            iterations=100000,
-        )
+    def derive_key(self, hardware_id: str, kdf: Optional[KdfParams] = None) -> bytes:
+        """从硬件ID派生加密密钥（不使用缓存）"""
+        kdf = kdf or self.kdf
         key = base64.urlsafe_b64encode(kdf.derive(hardware_id.encode()))
         return key
     
+    def _get_cached_key(self, hardware_id: str, kdf: Optional[KdfParams] = None,
+                        copy_key: bool = False) -> Tuple[Union[bytearray, bytes], Any]:
+        """
+        从缓存获取密钥和Fernet实例，未命中时派生并放入缓存
+        
+        copy_key 为True时在持有锁期间复制密钥，其他线程淘汰缓存时清零的是缓存中的那一份。
+        """
+        kdf = kdf or self.kdf
+        cache_key = (hardware_id,) + kdf.cache_key()
+        cache = KamiEncryption._key_cache
+        
+        with KamiEncryption._key_cache_lock:
+            entry = cache.get(cache_key)
+            if entry is not None:
+                cache.move_to_end(cache_key)
+                return (bytes(entry[0]), entry[1]) if copy_key else entry
+        
+        # 在锁外派生，避免阻塞其他线程读取缓存
+        key = bytearray(self.derive_key(hardware_id, kdf))
+        entry = (key, Fernet(bytes(key)))
+        
+        with KamiEncryption._key_cache_lock:
+            existing = cache.get(cache_key)
+            if existing is not None:
+                KamiEncryption._zero_key(key)
+                entry = existing
+            else:
+                cache[cache_key] = entry
+            result = (bytes(entry[0]), entry[1]) if copy_key else entry
+            while len(cache) > max(1, KamiEncryption.key_cache_size):
+                _, (old_key, _) = cache.popitem(last=False)
+                KamiEncryption._zero_key(old_key)
+        
+        return result
+    
+    @staticmethod
+    def _zero_key(key: bytearray) -> None:
+        """覆盖密钥内容（Fernet 内部持有的副本无法擦除，只能丢弃引用）"""
+        key[:] = b'\x00' * len(key)
+    
+    @classmethod
+    def evict_key(cls, hardware_id: Optional[str] = None) -> int:
+        """从缓存移除指定硬件ID的密钥，hardware_id 为None时清空全部，返回移除数量"""
+        with cls._key_cache_lock:
+            cache_keys = [cache_key for cache_key in cls._key_cache
+                          if hardware_id is None or cache_key[0] == hardware_id]
+            for cache_key in cache_keys:
+                key, _ = cls._key_cache.pop(cache_key)
+                cls._zero_key(key)
+        return len(cache_keys)
+    
+    @classmethod
+    def clear_key_cache(cls) -> int:
+        """清空密钥缓存并清零已缓存的密钥，退出登录时调用"""
+        return cls.evict_key()
+    
+    def is_key_cached(self, hardware_id: str, kdf: Optional[KdfParams] = None) -> bool:
+        """硬件ID和KDF参数对应的密钥是否已在进程内缓存中（取得密钥时不需要再派生）"""
+        cache_key = (hardware_id,) + (kdf or self.kdf).cache_key()
+        with KamiEncryption._key_cache_lock:
+            return cache_key in KamiEncryption._key_cache
+    
+    def get_key(self, hardware_id: str) -> bytes:
+        """从硬件ID生成加密密钥，同一进程内只派生一次"""
+        return self._get_cached_key(hardware_id, copy_key=True)[0]
+    
+    def get_fernet(self, hardware_id: str, kdf: Optional[KdfParams] = None) -> Any:
+        """获取对应硬件ID的Fernet实例"""
+        return self._get_cached_key(hardware_id, kdf)[1]
+    
+    def pack(self, token: bytes) -> bytes:
+        """在密文前加上带版本号和KDF参数的文件头"""
+        header = {'version': KAMI_FILE_VERSION}
+        header.update(self.kdf.to_header())
+        header.update({'payload': 'fernet', 'encoding': 'json'})
+        return KAMI_FILE_MAGIC + json.dumps(header, separators=(',', ':')).encode() + b'\n' + token
+    
+    @staticmethod
+    def unpack(encrypted_data: bytes) -> Tuple[Optional[Dict[str, Any]], bytes]:
+        """拆分文件头和密文；旧版无文件头的文件返回 (None, 原始数据)"""
+        if not encrypted_data.startswith(KAMI_FILE_MAGIC):
+            return None, encrypted_data
+        
+        header_line, _, token = encrypted_data[len(KAMI_FILE_MAGIC):].partition(b'\n')
+        header = json.loads(header_line.decode())
+        if header.get('version') != KAMI_FILE_VERSION:
+            raise ValueError(f"不支持的验证文件版本: {header.get('version')}")
+        if header.get('payload', 'fernet') != 'fernet' or header.get('encoding', 'json') != 'json':
+            raise ValueError(f"不支持的验证文件编码: {header.get('payload')}/{header.get('encoding')}")
+        return header, token
+    
+    def needs_upgrade(self, encrypted_data: bytes) -> bool:
+        """文件是否为旧格式或使用了与当前配置不同的KDF参数"""
+        try:
+            header, _ = self.unpack(encrypted_data)
+            return header is None or KdfParams.from_header(header).cache_key() != self.kdf.cache_key()
+        except ValueError:
+            return True
+    
+    @timed_stage('encryption.encrypt')
     def encrypt_data(self, data: Dict[str, Any], hardware_id: Optional[str] = None) -> bytes:
-        """加密数据"""
-        json_data = json.dumps(data)
+        """加密数据，总是写出带文件头的新格式"""
+        with stage_timings.timing('encryption.json'):
+            json_data = json.dumps(data)
         
         if hardware_id is None:
             hardware_id = HardwareInfo.generate_hardware_id()
             
-        key = self.get_key(hardware_id)
-        fernet = Fernet(key)
-        encrypted_data = fernet.encrypt(json_data.encode())
+        fernet = self.get_fernet(hardware_id)
+        with stage_timings.timing('encryption.fernet'):
+            encrypted_data = fernet.encrypt(json_data.encode())
         
-        return encrypted_data
+        return self.pack(encrypted_data)
     
+    @timed_stage('encryption.decrypt')
     def decrypt_data(self, encrypted_data: bytes, hardware_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
-        """解密数据"""
+        """解密数据，兼容旧版无文件头的文件"""
         try:
             if hardware_id is None:
                 hardware_id = HardwareInfo.generate_hardware_id()
-                
-            key = self.get_key(hardware_id)
-            fernet = Fernet(key)
-            decrypted_data = fernet.decrypt(encrypted_data).decode()
             
-            return json.loads(decrypted_data)
+            header, token = self.unpack(encrypted_data)
+            kdf = KdfParams.from_header(header) if header else self.legacy_kdf
+            fernet = self.get_fernet(hardware_id, kdf)
+            with stage_timings.timing('encryption.fernet'):
+                decrypted_data = fernet.decrypt(token).decode()
+            
+            with stage_timings.timing('encryption.json'):
+                return json.loads(decrypted_data)
         except Exception as e:
             print(f"解密失败：{e}")
             return None
 
 
+
+
+def _b64url_decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def get_public_key_url(api_url: str) -> str:
+    """由验证API地址得到公钥接口地址，例如 .../card-keys/verify → .../card-keys/public-key"""
+    base = api_url.rstrip('/')
+    if base.endswith('/verify'):
+        base = base[:-len('/verify')]
+    return base + '/public-key'
+
+
+class LicenseTokenVerifier:
+    """
+    离线验证服务器签发的授权令牌
+    
+    令牌格式为 base64url(JSON载荷).base64url(Ed25519签名)，载荷包含卡密(key)、硬件ID(hwid)和到期时间(exp)。
+    只信任固定的根公钥（构造参数、LICENSE_PUBLIC_KEY 或环境变量 KAMI_LICENSE_PUBLIC_KEY）：令牌由根私钥签名，
+    或由服务器的签名密钥签名，这时签名公钥必须带有根私钥的背书（服务器公钥接口返回）。背书有效的签名公钥
+    缓存在 key_file 中，读取时重新检查背书，缓存文件被改动不会引入新的公钥。
+    
+    没有根公钥时不验证令牌（enforced 为False）。设置根公钥后本地记录必须带有有效的令牌，没有令牌的旧记录
+    只在本机还没有保存过带令牌的记录（marker_file 不存在）时按到期时间检查。
+    签名验证通过的令牌缓存在内存中，之后的检查只比较硬件ID和到期时间。
+    """
+    
+    def __init__(self,
+                 api_url: str = DEFAULT_API_URL,
+                 public_key: Optional[str] = None,
+                 key_file: Optional[str] = DEFAULT_PUBLIC_KEY_FILE,
+                 transport: Optional[KamiTransport] = None,
+                 marker_file: Optional[str] = DEFAULT_TOKEN_MARKER_FILE):
+        self.api_url = api_url
+        self.pinned_key = public_key or LICENSE_PUBLIC_KEY or os.environ.get(LICENSE_PUBLIC_KEY_ENV) or None
+        self.key_file = key_file
+        self.marker_file = marker_file
+        self.transport = transport
+        self._root_key = None
+        self._signing_keys: Dict[str, Ed25519PublicKey] = {}
+        self._cache_loaded = False
+        self._fetched_at = 0.0
+        self._verified: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @property
+    def enforced(self) -> bool:
+        """是否设置了根公钥（设置后本地记录必须带有有效的授权令牌）"""
+        return bool(self.pinned_key)
+    
+    def get_public_key(self) -> Optional[Ed25519PublicKey]:
+        """获取固定的根公钥，没有设置或格式错误时返回None"""
+        with self._lock:
+            if self._root_key is None and self.pinned_key:
+                try:
+                    self._root_key = Ed25519PublicKey.from_public_bytes(_b64url_decode(self.pinned_key))
+                except ValueError:
+                    print("固定公钥格式错误")
+            return self._root_key
+    
+    def _endorsed_key(self, text: Any, endorsement: Any) -> Optional[Ed25519PublicKey]:
+        """签名公钥带有根私钥的有效背书时返回公钥，否则返回None"""
+        root_key = self.get_public_key()
+        if root_key is None or not isinstance(text, str) or not isinstance(endorsement, str):
+            return None
+        try:
+            root_key.verify(_b64url_decode(endorsement), LICENSE_KEY_ENDORSEMENT_PREFIX + text.encode('ascii'))
+            return Ed25519PublicKey.from_public_bytes(_b64url_decode(text))
+        except (InvalidSignature, ValueError, UnicodeError):
+            return None
+    
+    def _trusted_keys(self) -> List[Ed25519PublicKey]:
+        """根公钥和背书有效的签名公钥（第一次调用时读取缓存文件）"""
+        root_key = self.get_public_key()
+        if root_key is None:
+            return []
+        with self._lock:
+            load_cache = not self._cache_loaded and self.key_file
+            self._cache_loaded = True
+        if load_cache:
+            try:
+                with open(self.key_file, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                cached = None
+            if isinstance(cached, dict):
+                key = self._endorsed_key(cached.get('publicKey'), cached.get('endorsement'))
+                if key is not None:
+                    with self._lock:
+                        self._signing_keys[cached['publicKey']] = key
+        with self._lock:
+            return [root_key] + list(self._signing_keys.values())
+    
+    def refresh_public_key(self) -> bool:
+        """
+        从服务器获取当前的签名公钥，返回是否得到了新的可信公钥
+        
+        只接受带有根私钥有效背书的公钥，不删除已有的公钥；没有根公钥时不请求，两次请求至少间隔
+        PUBLIC_KEY_RETRY_INTERVAL 秒。
+        """
+        if not self.enforced:
+            return False
+        with self._lock:
+            if self._fetched_at and time.monotonic() - self._fetched_at < PUBLIC_KEY_RETRY_INTERVAL:
+                return False
+            self._fetched_at = time.monotonic()
+        try:
+            response = (self.transport or get_transport()).get(get_public_key_url(self.api_url))
+            data = response.json().get('data', {}) if response.status_code == 200 else {}
+            text, endorsement = data.get('publicKey'), data.get('endorsement')
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            return False
+        if text == self.pinned_key or text in self._signing_keys:
+            return False
+        key = self._endorsed_key(text, endorsement)
+        if key is None:
+            print("服务器公钥没有有效的背书，已忽略")
+            return False
+        with self._lock:
+            self._signing_keys[text] = key
+        if self.key_file:
+            try:
+                atomic_write_file(self.key_file, json.dumps({'publicKey': text, 'endorsement': endorsement}).encode())
+            except OSError as e:
+                print(f"保存公钥失败: {e}")
+        return True
+    
+    def _verify_signature(self, token: str) -> Optional[Dict[str, Any]]:
+        """用可信公钥检查令牌签名，返回载荷"""
+        encoded, _, signature = token.partition('.')
+        try:
+            signature_bytes = _b64url_decode(signature)
+            message = encoded.encode('ascii')
+        except (ValueError, UnicodeError):
+            return None
+        for public_key in self._trusted_keys():
+            try:
+                public_key.verify(signature_bytes, message)
+                claims = json.loads(_b64url_decode(encoded))
+            except (InvalidSignature, ValueError, UnicodeError):
+                continue
+            if isinstance(claims, dict) and claims.get('v') == LICENSE_TOKEN_VERSION:
+                return claims
+            return None
+        return None
+    
+    @timed_stage('token.verify')
+    def verify(self, token: Optional[str], hardware_id: str, key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        验证令牌，签名有效、硬件ID（和卡密）一致且未到期时返回载荷，否则返回None
+        
+        签名无法用已知公钥验证时（服务器可能更换了签名密钥）获取一次新的签名公钥再试。
+        """
+        if not token or not isinstance(token, str):
+            return None
+        with self._lock:
+            claims = self._verified.get(token)
+            if claims is not None:
+                self._verified.move_to_end(token)
+        
+        if claims is None:
+            claims = self._verify_signature(token)
+            if claims is None and self.refresh_public_key():
+                claims = self._verify_signature(token)
+            if claims is None:
+                return None
+            with self._lock:
+                self._verified[token] = claims
+                while len(self._verified) > DEFAULT_TOKEN_CACHE_SIZE:
+                    self._verified.popitem(last=False)
+        
+        if claims.get('hwid') != hardware_id:
+            return None
+        if key is not None and claims.get('key') != key:
+            return None
+        exp = claims.get('exp')
+        if not isinstance(exp, (int, float)) or exp <= time.time():
+            return None
+        return dict(claims)
+    
+    def tokens_required(self) -> bool:
+        """本机是否已经保存过带有效令牌的记录，之后不再接受没有令牌的旧记录"""
+        return bool(self.marker_file) and os.path.exists(self.marker_file)
+    
+    def mark_tokens_required(self) -> None:
+        """联网验证得到有效令牌后调用，之后没有令牌的记录一律无效"""
+        if not self.enforced or not self.marker_file or os.path.exists(self.marker_file):
+            return
+        try:
+            atomic_write_file(self.marker_file, str(int(time.time())).encode())
+        except OSError as e:
+            print(f"保存令牌标记失败: {e}")
+    
+    def check_record(self, record: Dict[str, Any], hardware_id: str, key: Optional[str] = None) -> bool:
+        """
+        本地验证记录的授权令牌是否有效（到期时间由调用方另外检查）
+        
+        没有根公钥时总是返回True；设置了根公钥时记录必须带有签名、硬件ID（和卡密）一致且未到期的令牌，
+        没有令牌的旧记录只在本机还没有保存过带令牌的记录时通过。
+        """
+        if not self.enforced:
+            return True
+        token = record.get('token')
+        if token:
+            return self.verify(token, hardware_id, key) is not None
+        if self.tokens_required():
+            print("本地记录缺少授权令牌")
+            return False
+        print("本地记录缺少授权令牌，按旧版记录检查到期时间（下次联网验证后不再接受）")
+        return True
+
+
+class LicenseStore:
+    """
+    多卡密授权库
+    
+    每个卡密的验证记录加密后保存在SQLite中，主键为 (卡密SHA-256, 用户标识, 硬件ID)，按主键查找无需扫描；
+    库中不保存卡密明文。最近使用的解密记录缓存在内存中（LRU，最多 cache_size 条）。
+    多个进程可以同时使用同一个库文件（WAL模式）。
+    """
+    
+    def __init__(self,
+                 db_path: str = DEFAULT_LICENSE_DB,
+                 hardware_id: Optional[str] = None,
+                 encryption: Optional['KamiEncryption'] = None,
+                 cache_size: int = DEFAULT_LICENSE_CACHE_SIZE):
+        self.db_path = db_path
+        self.hardware_id = hardware_id or HardwareInfo.generate_hardware_id()
+        self.encryption = encryption or KamiEncryption()
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[Tuple[str, str], Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS licenses ('
+            ' key_hash TEXT NOT NULL,'
+            ' user_identifier TEXT NOT NULL,'
+            ' hardware_id TEXT NOT NULL,'
+            ' expires_at INTEGER,'
+            ' updated_at INTEGER NOT NULL,'
+            ' record BLOB NOT NULL,'
+            ' PRIMARY KEY (key_hash, user_identifier, hardware_id)'
+            ') WITHOUT ROWID'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS licenses_expires_at ON licenses (expires_at)')
+        self._conn.commit()
+    
+    @staticmethod
+    def key_hash(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+    
+    def _cache_put(self, cache_key: Tuple[str, str], record: Dict[str, Any]) -> None:
+        self._cache[cache_key] = copy.deepcopy(record)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    @timed_stage('license_store.put')
+    def put(self, key: str, record: Dict[str, Any], user_identifier: str = '') -> bool:
+        """加密保存一条验证记录，同一卡密和用户标识的旧记录被替换"""
+        try:
+            encrypted = self.encryption.encrypt_data(record, self.hardware_id)
+        except Exception as e:
+            print(f"加密授权记录失败: {e}")
+            return False
+        expires_at = get_record_expires_at(record)
+        cache_key = (self.key_hash(key), user_identifier)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO licenses VALUES (?, ?, ?, ?, ?, ?)',
+                (cache_key[0], user_identifier, self.hardware_id,
+                 int(expires_at) if expires_at is not None else None, int(time.time()), encrypted)
+            )
+            self._conn.commit()
+            self._cache_put(cache_key, record)
+        return True
+    
+    @timed_stage('license_store.get')
+    def get(self, key: str, user_identifier: str = '') -> Optional[Dict[str, Any]]:
+        """按卡密和用户标识查找未过期的记录，没有时返回None；没有过期时间的记录与本地验证一样视为无效"""
+        cache_key = (self.key_hash(key), user_identifier)
+        with self._lock:
+            record = self._cache.get(cache_key)
+            if record is not None:
+                self._cache.move_to_end(cache_key)
+            else:
+                row = self._conn.execute(
+                    'SELECT record FROM licenses WHERE key_hash = ? AND user_identifier = ? AND hardware_id = ?',
+                    (cache_key[0], user_identifier, self.hardware_id)
+                ).fetchone()
+                if row is None:
+                    return None
+                record = self.encryption.decrypt_data(row[0], self.hardware_id)
+                if record is None:
+                    return None
+                self._cache_put(cache_key, record)
+        expires_at = get_record_expires_at(record)
+        if expires_at is None or expires_at <= time.time():
+            return None
+        return copy.deepcopy(record)
+    
+    def delete(self, key: str, user_identifier: str = '') -> bool:
+        """删除一条记录，例如卡密被服务器撤销时"""
+        cache_key = (self.key_hash(key), user_identifier)
+        with self._lock:
+            self._cache.pop(cache_key, None)
+            cursor = self._conn.execute(
+                'DELETE FROM licenses WHERE key_hash = ? AND user_identifier = ? AND hardware_id = ?',
+                (cache_key[0], user_identifier, self.hardware_id)
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+    
+    def list(self) -> List[Dict[str, Any]]:
+        """列出本机的记录（不解密），包括卡密摘要、用户标识和过期时间"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key_hash, user_identifier, expires_at, updated_at FROM licenses'
+                ' WHERE hardware_id = ? ORDER BY updated_at DESC', (self.hardware_id,)
+            ).fetchall()
+        return [{'key_hash': key_hash, 'user_identifier': user_identifier,
+                 'expires_at': expires_at, 'updated_at': updated_at}
+                for key_hash, user_identifier, expires_at, updated_at in rows]
+    
+    def purge_expired(self) -> int:
+        """删除已过期或没有过期时间的记录，返回删除的条数"""
+        now = int(time.time())
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM licenses WHERE expires_at IS NULL OR expires_at <= ?', (now,))
+            self._conn.commit()
+            self._cache.clear()
+        return cursor.rowcount
+    
+    def compact(self) -> int:
+        """删除已过期的记录并整理数据库文件，返回删除的条数"""
+        removed = self.purge_expired()
+        with self._lock:
+            self._conn.execute('VACUUM')
+        return removed
+    
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
 class KamiVerifier:
     """卡密验证工具类"""
     
+    # 所有实例共享的在途请求表，同一卡密的并发验证只发送一次请求、保存一次文件
+    _inflight = SingleFlight()
+    
     def __init__(self, 
                  api_url: str = DEFAULT_API_URL,
                  verification_file: str = DEFAULT_VERIFICATION_FILE,
-                 legacy_file: str = DEFAULT_LEGACY_FILE):
+                 legacy_file: str = DEFAULT_LEGACY_FILE,
+                 kdf: Optional[KdfParams] = None,
+                 transport: Optional[KamiTransport] = None,
+                 public_key: Optional[str] = None,
+                 multi_license: bool = False):
         self.api_url = api_url
+        # 未指定时使用进程内共享的长连接传输
+        self.transport = transport or get_transport()
         self.verification_file = verification_file
         self.legacy_file = legacy_file
         self.hardware_id = HardwareInfo.generate_hardware_id()
-        self.encryption = KamiEncryption()
+        self.hardware_id_complete = HardwareInfo.is_complete(self.hardware_id)
+        # kdf 为保存时使用的密钥派生参数，读取时以文件头记录的参数为准
+        self.encryption = KamiEncryption(kdf=kdf)
+        # 授权令牌的签名公钥缓存和令牌标记文件在验证文件旁边
+        base_dir = os.path.dirname(os.path.abspath(verification_file))
+        self.token_verifier = LicenseTokenVerifier(api_url, public_key, os.path.join(base_dir, DEFAULT_PUBLIC_KEY_FILE),
+                                                   self.transport, os.path.join(base_dir, DEFAULT_TOKEN_MARKER_FILE))
+        # 多卡密模式下每次验证成功都记入授权库；关闭时只在第一次切换卡密后才创建授权库
+        self.multi_license = multi_license
+        self._license_store: Optional[LicenseStore] = None
+        self.writer = get_file_writer(verification_file)
+        # 上次写入的 (卡密, 到期时间, 令牌)，只有这些都不变的保存才允许合并推迟
+        self._saved_identity: Optional[Tuple[Any, Any, Any]] = None
+    
+    @property
+    def license_store(self) -> LicenseStore:
+        """多卡密授权库，保存在验证文件旁边，第一次使用时打开（不存在时创建）"""
+        return self._get_license_store(create=True)
     
+    def _get_license_store(self, create: bool = False) -> Optional[LicenseStore]:
+        """打开授权库；库文件不存在且未开启多卡密模式时，只有 create 为True才创建，否则返回None"""
+        if self._license_store is None:
+            db_path = os.path.join(os.path.dirname(os.path.abspath(self.verification_file)), DEFAULT_LICENSE_DB)
+            if not (create or self.multi_license or os.path.exists(db_path)):
+                return None
+            self._license_store = LicenseStore(db_path, self.hardware_id, self.encryption)
+            # 过期的记录不能再切换，打开时清理
+            self._license_store.purge_expired()
+        return self._license_store
+    
+    @timed_stage('verifier.verify')
     def verify_card_key(self, key: str, user_identifier: str = '') -> Dict[str, Any]:
-        """验证卡密是否有效"""
-        try:
-            response = requests.post(
-                self.api_url,
-                json={'key': key, 'userIdentifier': user_identifier},
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                # 如果验证成功，保存验证信息
-                if result.get('success', False):
-                    self.save_verification_data(result)
-                return result
-            else:
-                return {
-                    'success': False, 
-                    'message': f'API错误: HTTP {response.status_code}'
-                }
-                
-        except requests.exceptions.Timeout:
-            return {'success': False, 'message': '连接超时，请检查网络'}
-        except requests.exceptions.ConnectionError:
-            return {'success': False, 'message': '连接失败，请检查网络或API地址'}
-        except json.JSONDecodeError:
-            return {'success': False, 'message': 'API返回的数据格式错误'}
-        except Exception as e:
-            return {'success': False, 'message': f'未知错误: {str(e)}'}
+        """验证卡密是否有效，同一卡密和用户标识的并发调用共享一次验证结果"""
+        flight_key = (self.api_url, os.path.abspath(self.verification_file), key, user_identifier)
+        return KamiVerifier._inflight.do(flight_key, lambda: self._verify_and_save(key, user_identifier))
     
-    def load_verification_data(self) -> Optional[Dict[str, Any]]:
-        """加载验证信息，优先尝试加密文件，然后是旧版明文文件"""
-        # 尝试加载加密文件
-        if os.path.exists(self.verification_file):
+    def _verify_and_save(self, key: str, user_identifier: str) -> Dict[str, Any]:
+        # 服务器按硬件ID绑定设备，上次采集超时时先重新采集
+        self.refresh_hardware_id()
+        with stage_timings.timing('verifier.http'):
+            result = verify_card_key_request(key, user_identifier, self.api_url, self.transport,
+                                             hardware_id=self.hardware_id)
+        
+        # 如果验证成功，保存验证信息
+        if result.get('success', False):
+            self.save_verification_data(result, user_identifier, sync=True)
+        return result
+    
+    @timed_stage('verifier.activate')
+    def activate_license(self, key: str, user_identifier: str = '') -> Optional[Dict[str, Any]]:
+        """
+        从授权库中切换到之前验证过的卡密，不访问网络
+        
+        记录有效（授权令牌、硬件ID、过期时间检查通过）时把它保存为当前验证信息并返回，否则返回None。
+        还没有授权库时，第一次换用其他卡密会创建授权库并记入当前卡密，之后可以离线切换回来。
+        """
+        store = self._get_license_store()
+        if store is None:
             try:
-                with open(self.verification_file, 'rb') as f:
-                    encrypted_data = f.read()
-                
+                is_valid, current = self.is_verified()
+            except FileLockTimeout as e:
+                print(f"验证文件暂时无法读取: {e}")
+                return None
+            current_key = ((current or {}).get('data') or {}).get('key') if is_valid else None
+            # 按当前记录验证时的用户标识记入，之后用那个标识切换回来；旧记录没有保存用户标识，不记入
+            if current_key and current_key != key and 'user_identifier' in current:
+                try:
+                    self._get_license_store(create=True).put(current_key, current, current['user_identifier'])
+                except sqlite3.Error as e:
+                    print(f"保存到授权库失败: {e}")
+            return None
+        record = store.get(key, user_identifier)
+        if record is None:
+            return None
+        # 与本地验证相同：设置了根公钥时记录必须带有效的授权令牌
+        if not self.token_verifier.check_record(record, self.hardware_id, key):
+            return None
+        if not self.save_verification_data(record, user_identifier, sync=True):
+            return None
+        return record
+    
+    def remove_license(self, key: str, user_identifier: str = '') -> bool:
+        """从授权库中删除卡密的记录（例如被服务器撤销时），还没有授权库时不创建"""
+        store = self._get_license_store()
+        return store is not None and store.delete(key, user_identifier)
+    
+    def get_breaker_state(self) -> Dict[str, Any]:
+        """获取验证API熔断器状态，state 为 open 时可以直接使用本地验证结果"""
+        return self.transport.get_breaker_state()
+    
+    def verify_token(self, token: Optional[str]) -> Optional[Dict[str, Any]]:
+        """验证授权令牌的签名、硬件ID和到期时间，有效时返回载荷"""
+        return self.token_verifier.verify(token, self.hardware_id)
+    
+    def refresh_hardware_id(self) -> bool:
+        """硬件ID来自有超时项的采集（使用了兜底值）时重新采集，返回硬件ID是否完整"""
+        if not self.hardware_id_complete:
+            self.hardware_id = HardwareInfo.generate_hardware_id()
+            self.hardware_id_complete = HardwareInfo.is_complete(self.hardware_id)
+        return self.hardware_id_complete
+    
+    def _can_overwrite(self) -> bool:
+        """
+        硬件ID不完整时，只有现有验证文件不存在或能用当前硬件ID解密才允许覆盖
+        
+        兜底值算出的密钥解不开用真实硬件ID加密的文件，覆盖或删除会丢失仍然有效的验证信息。
+        """
+        if self.refresh_hardware_id():
+            return True
+        encrypted_data = self.writer.read()
+        return encrypted_data is None or self.encryption.decrypt_data(encrypted_data, self.hardware_id) is not None
+    
+    @timed_stage('verifier.load')
+    def load_verification_data(self) -> Optional[Dict[str, Any]]:
+        """
+        加载验证信息，优先尝试加密文件，然后是旧版明文文件
+        
+        其他进程长时间持有文件锁时抛出 FileLockTimeout（验证文件暂时无法读取，不代表未验证）。
+        """
+        # 尝试加载加密文件（包括尚未落盘的最新内容）
+        try:
+            encrypted_data = self.writer.read()
+        except FileLockTimeout:
+            raise
+        except OSError:
+            encrypted_data = None
+        if encrypted_data is not None:
+            data = self.encryption.decrypt_data(encrypted_data, self.hardware_id)
+            if data is None and not self.hardware_id_complete and self.refresh_hardware_id():
+                # 上次采集超时，重新采集到完整的硬件ID后再试一次
                 data = self.encryption.decrypt_data(encrypted_data, self.hardware_id)
-                if data:
-                    return data
-            except:
-                pass
+            if data:
+                return data
+        
+        # 文件损坏或写入时中断：使用最后一次完好的副本并恢复文件（硬件ID不完整时解不开，不做恢复）
+        backup_data = self.writer.read_backup() if self.hardware_id_complete else None
+        if backup_data is not None and backup_data != encrypted_data:
+            data = self.encryption.decrypt_data(backup_data, self.hardware_id)
+            if data:
+                print("验证文件损坏，已从备份恢复")
+                try:
+                    self.writer.restore_backup()
+                except OSError:
+                    pass
+                return data
         
         # 尝试加载旧版明文文件
         if os.path.exists(self.legacy_file):
@@ -238,22 +2063,59 @@ class KamiVerifier:
         
         return None
     
-    def save_verification_data(self, data: Dict[str, Any]) -> bool:
-        """加密并保存验证信息"""
+    @timed_stage('verifier.save')
+    def save_verification_data(self, data: Dict[str, Any], user_identifier: str = '', sync: bool = False) -> bool:
+        """
+        加密并保存验证信息，同时记入多卡密授权库，写入失败时返回False
+        
+        联网验证或切换卡密后的保存应传入 sync=True 立即落盘；卡密、到期时间或令牌有变化时同样立即落盘，
+        只有这些都不变的保存才可能在合并窗口内推迟。
+        """
         try:
             # 添加硬件信息和时间戳
             data['hardware_id'] = self.hardware_id
             data['device_bound'] = True
             data['verified_at'] = datetime.datetime.now().isoformat()
+            # 记下验证时的用户标识，第一次切换卡密时按它把当前记录记入授权库
+            data['user_identifier'] = user_identifier
+            # 保存时把过期时间换算为时间戳，之后只需整数比较
+            expires_at = parse_expiry_time((data.get('data') or {}).get('expiryTime'))
+            # 服务器签发了授权令牌时以令牌中签名的到期时间为准
+            claims = self.verify_token(data.get('token')) if data.get('token') else None
+            if claims is not None:
+                expires_at = claims['exp']
+                # 之后不再接受没有令牌的旧记录
+                self.token_verifier.mark_tokens_required()
+            if expires_at is not None:
+                data['expires_at'] = int(expires_at)
+            
+            if not self._can_overwrite():
+                print("硬件信息采集不完整，无法解密现有验证文件，不覆盖")
+                return False
+            data['hardware_id'] = self.hardware_id
             
             # 加密数据
             encrypted_data = self.encryption.encrypt_data(data, self.hardware_id)
             
-            # 保存到文件
-            with open(self.verification_file, 'wb') as f:
-                f.write(encrypted_data)
+            # 原子写入文件，只有冗余的连续保存合并为一次写入
+            identity = ((data.get('data') or {}).get('key'), data.get('expires_at'), data.get('token'))
+            self.writer.write(encrypted_data, sync=sync or identity != self._saved_identity)
+            self._saved_identity = identity
+            
+            # 记入多卡密授权库（已创建或开启了多卡密模式时），之后切换回这个卡密无需联网
+            key = (data.get('data') or {}).get('key')
+            store = self._get_license_store() if key else None
+            if store is not None:
+                try:
+                    store.put(key, data, user_identifier)
+                except sqlite3.Error as e:
+                    print(f"保存到授权库失败: {e}")
             
             return True
+        except OSError as e:
+            # 写入失败或等待文件锁超时，不改用明文保存
+            print(f"保存验证文件失败: {e}")
+            return False
         except:
             # 如果加密保存失败，尝试使用旧方式保存
             try:
@@ -263,8 +2125,20 @@ class KamiVerifier:
             except:
                 return False
     
+    def clear_verification_data(self) -> bool:
+        """删除验证文件及其备份；硬件ID不完整且无法解密现有文件、或等待文件锁超时时不删除，返回False"""
+        try:
+            if not self._can_overwrite():
+                return False
+            self.writer.remove()
+        except OSError as e:
+            print(f"删除验证文件失败: {e}")
+            return False
+        return True
+    
+    @timed_stage('verifier.is_verified')
     def is_verified(self) -> Tuple[bool, Optional[Dict[str, Any]]]:
-        """检查是否已经验证，并且验证信息是否与当前硬件匹配"""
+        """检查是否已经验证，并且验证信息是否与当前硬件匹配；验证文件暂时无法读取时抛出 FileLockTimeout"""
         data = self.load_verification_data()
         if not data:
             return False, None
@@ -273,16 +2147,14 @@ class KamiVerifier:
         if 'hardware_id' in data and data['hardware_id'] != self.hardware_id:
             return False, data
         
-        # 检查是否已过期
-        if 'data' in data and 'expiryTime' in data['data']:
-            expiry_time = data['data']['expiryTime']
-            try:
-                # 格式如 2023-12-31T23:59:59
-                expiry_date = datetime.datetime.fromisoformat(expiry_time)
-                if expiry_date < datetime.datetime.now():
-                    return False, data
-            except:
-                pass
+        # 设置了根公钥时离线验证授权令牌的签名、硬件ID和到期时间，缺少令牌或令牌无效时验证失败
+        if not self.token_verifier.check_record(data, self.hardware_id):
+            return False, data
+        
+        # 检查是否已过期；没有过期时间的记录无效（与授权库的规则相同）
+        expires_at = get_record_expires_at(data)
+        if expires_at is None or expires_at < time.time():
+            return False, data
         
         return True, data
 
@@ -11,6 +11,7 @@ import json
 # 检查是否安装了requests库
 try:
     import requests
+    from kami_transport import verify_card_key_request
 except ImportError:
     print("错误: 未安装requests库")
     print("请运行以下命令安装:")
@@ -30,31 +31,8 @@ def verify_card_key(key, user_identifier='', api_url='http://170.106.175.187/api
     返回:
         dict: 包含验证结果的字典
     """
-    try:
-        # 发送POST请求到API
-        response = requests.post(
-            api_url,
-            json={'key': key, 'userIdentifier': user_identifier},
-            timeout=10  # 10秒超时
-        )
-        
-        # 检查HTTP状态码
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return {
-                'success': False, 
-                'message': f'API错误: HTTP {response.status_code}'
-            }
-            
-    except requests.exceptions.Timeout:
-        return {'success': False, 'message': '连接超时，请检查网络'}
-    except requests.exceptions.ConnectionError:
-        return {'success': False, 'message': '连接失败，请检查网络或API地址'}
-    except json.JSONDecodeError:
-        return {'success': False, 'message': 'API返回的数据格式错误'}
-    except Exception as e:
-        return {'success': False, 'message': f'未知错误: {str(e)}'}
+    # 通过共享的长连接传输发送POST请求到API
+    return verify_card_key_request(key, user_identifier, api_url)
 
 def print_result(result):
     """打印验证结果"""
@@ -105,6 +83,12 @@ def main():
         print_result(result)
 
 if __name__ == "__main__":
+    # 批量验证模式，结果以JSON行输出，不进入交互界面
+    # 用法: python verify_card_key.py --batch keys.txt [--workers 8] [--rate 20] [--output results.jsonl]
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        from kami_batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    
     try:
         main()
     except KeyboardInterrupt:
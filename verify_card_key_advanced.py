@@ -16,6 +16,9 @@ import subprocess
 import base64
 import hashlib
 import datetime
+from collections import OrderedDict
+import threading
+import time
 from typing import Dict, Any, Optional, Tuple, Union
 
 # pyright: reportOptionalMemberAccess=none, reportOptionalSubscript=none
@@ -23,9 +26,11 @@ from typing import Dict, Any, Optional, Tuple, Union
 # 检查是否安装了必要的库
 try:
     import requests
+    from kami_transport import verify_card_key_request
     from cryptography.fernet import Fernet
     from cryptography.hazmat.primitives import hashes
     from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 except ImportError:
     print("错误: 未安装必要的库")
     print("请运行以下命令安装:")
@@ -38,11 +43,28 @@ API_URL = 'http://170.106.175.187/api/card-keys/verify'
 VERIFICATION_FILE = 'verification.bin'  # 加密的验证文件
 LEGACY_VERIFICATION_FILE = 'verification.json'  # 旧版明文验证文件
 SALT = b'kami_verification_system_salt'  # 盐值，用于密钥派生
+KDF_ALGORITHM = 'pbkdf2-sha256'  # 密钥派生算法，可选 pbkdf2-sha256 / scrypt
+KDF_ITERATIONS = 100000  # PBKDF2 迭代次数
+# 文件头中KDF参数的允许范围：验证文件可以被篡改，超出范围的参数会让派生耗尽CPU或内存
+MAX_KDF_ITERATIONS = 1000000
+SCRYPT_ALLOWED_N = (2 ** 14, 2 ** 15, 2 ** 16, 2 ** 17)
+MAX_SCRYPT_R = 8
+MAX_SCRYPT_P = 4
+MAX_KDF_SALT_LENGTH = 64
+FILE_MAGIC = b'KAMI/'  # 验证文件头标识，之后是JSON参数和换行
+FILE_VERSION = 1  # 验证文件格式版本
+KEY_CACHE_SIZE = 8  # 进程内最多缓存的派生密钥数量
+HARDWARE_CACHE_FILE = None  # 硬件ID磁盘缓存文件，None 表示只使用进程内缓存
 
 
 class HardwareInfo:
     """用于获取系统硬件信息"""
     
+    # 进程内缓存的硬件ID，以及可选的磁盘缓存文件
+    _cached_hardware_id: Optional[str] = None
+    _cache_lock = threading.Lock()
+    cache_file: Optional[str] = HARDWARE_CACHE_FILE
+    
     @staticmethod
     def get_cpu_id() -> str:
         """获取CPU ID"""
@@ -115,8 +137,85 @@ class HardwareInfo:
         return platform.node() + os.getlogin()
     
     @staticmethod
-    def generate_hardware_id() -> str:
-        """生成唯一的硬件标识符"""
+    def get_boot_key() -> str:
+        """
+        获取本次开机和本机的廉价标识（不启动子进程）
+        
+        用于判断磁盘缓存的硬件ID是否仍然可信：重启或换机后标识会变化，缓存随之失效。
+        """
+        parts = [platform.system(), platform.node()]
+        
+        for path in ('/proc/sys/kernel/random/boot_id', '/etc/machine-id', '/var/lib/dbus/machine-id'):
+            try:
+                with open(path, 'r') as f:
+                    parts.append(f.read().strip())
+            except OSError:
+                pass
+        
+        if platform.system() == "Windows":
+            try:
+                import winreg
+                with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography",
+                                    0, winreg.KEY_READ | winreg.KEY_WOW64_64KEY) as reg_key:
+                    parts.append(str(winreg.QueryValueEx(reg_key, "MachineGuid")[0]))
+            except Exception:
+                pass
+            try:
+                import ctypes
+                get_tick_count = ctypes.windll.kernel32.GetTickCount64
+                get_tick_count.restype = ctypes.c_ulonglong
+                # 开机时间精确到分钟，避免计算误差导致缓存频繁失效
+                parts.append(str(int(time.time() - get_tick_count() / 1000) // 60))
+            except Exception:
+                pass
+        
+        return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+    
+    @staticmethod
+    def _load_cache_file(boot_key: str) -> Optional[str]:
+        """读取磁盘缓存的硬件ID，标识不匹配时返回None"""
+        if not HardwareInfo.cache_file or not os.path.exists(HardwareInfo.cache_file):
+            return None
+        try:
+            with open(HardwareInfo.cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('boot_key') == boot_key and cache.get('hardware_id'):
+                return cache['hardware_id']
+        except Exception:
+            pass
+        return None
+    
+    @staticmethod
+    def _save_cache_file(boot_key: str, hardware_id: str) -> None:
+        """写入磁盘缓存，失败时忽略"""
+        if not HardwareInfo.cache_file:
+            return
+        try:
+            with open(HardwareInfo.cache_file, 'w') as f:
+                json.dump({'boot_key': boot_key, 'hardware_id': hardware_id}, f)
+        except Exception:
+            pass
+    
+    @staticmethod
+    def set_cache_file(cache_file: Optional[str]) -> None:
+        """设置硬件ID磁盘缓存文件，传入None关闭磁盘缓存"""
+        with HardwareInfo._cache_lock:
+            HardwareInfo.cache_file = cache_file
+    
+    @staticmethod
+    def invalidate_cache(remove_file: bool = True) -> None:
+        """清除缓存的硬件ID，下次调用时重新采集硬件信息"""
+        with HardwareInfo._cache_lock:
+            HardwareInfo._cached_hardware_id = None
+            if remove_file and HardwareInfo.cache_file:
+                try:
+                    os.remove(HardwareInfo.cache_file)
+                except OSError:
+                    pass
+    
+    @staticmethod
+    def probe_hardware_id() -> str:
+        """采集硬件信息并计算硬件标识符（不使用缓存）"""
         cpu_id = HardwareInfo.get_cpu_id()
         disk_serial = HardwareInfo.get_disk_serial()
         motherboard_serial = HardwareInfo.get_motherboard_serial()
@@ -126,27 +225,171 @@ class HardwareInfo:
         hardware_hash = hashlib.sha256(hardware_info.encode()).hexdigest()
         
         return hardware_hash
+    
+    @staticmethod
+    def generate_hardware_id(use_cache: bool = True) -> str:
+        """
+        生成唯一的硬件标识符
+        
+        默认使用进程内缓存，其次是磁盘缓存（需设置 cache_file），都未命中时才采集硬件信息。
+        use_cache=False 时强制重新采集并刷新缓存。
+        """
+        if use_cache:
+            cached = HardwareInfo._cached_hardware_id
+            if cached is not None:
+                return cached
+        
+        with HardwareInfo._cache_lock:
+            if use_cache and HardwareInfo._cached_hardware_id is not None:
+                return HardwareInfo._cached_hardware_id
+            
+            boot_key = HardwareInfo.get_boot_key() if HardwareInfo.cache_file else ''
+            hardware_id = HardwareInfo._load_cache_file(boot_key) if use_cache else None
+            if hardware_id is None:
+                hardware_id = HardwareInfo.probe_hardware_id()
+                HardwareInfo._save_cache_file(boot_key, hardware_id)
+            
+            HardwareInfo._cached_hardware_id = hardware_id
+            return hardware_id
+
+
+class KdfParams:
+    """密钥派生参数，随验证文件的文件头一起保存"""
+    
+    SUPPORTED_ALGORITHMS = ('pbkdf2-sha256', 'scrypt')
+    
+    def __init__(self,
+                 algorithm: str = KDF_ALGORITHM,
+                 salt: bytes = SALT,
+                 iterations: int = KDF_ITERATIONS,
+                 n: int = 2 ** 14,
+                 r: int = 8,
+                 p: int = 1):
+        if algorithm not in self.SUPPORTED_ALGORITHMS:
+            raise ValueError(f"不支持的密钥派生算法: {algorithm}")
+        self.algorithm = algorithm
+        self.salt = salt
+        self.iterations = iterations
+        self.n = n
+        self.r = r
+        self.p = p
+    
+    def derive(self, secret: bytes) -> bytes:
+        """派生32字节原始密钥"""
+        if self.algorithm == 'scrypt':
+            kdf = Scrypt(salt=self.salt, length=32, n=self.n, r=self.r, p=self.p)
+        else:
+            kdf = PBKDF2HMAC(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=self.salt,
+                iterations=self.iterations,
+            )
+        return kdf.derive(secret)
+    
+    def cache_key(self) -> Tuple[Any, ...]:
+        if self.algorithm == 'scrypt':
+            return (self.algorithm, self.salt, self.n, self.r, self.p)
+        return (self.algorithm, self.salt, self.iterations)
+    
+    def to_header(self) -> Dict[str, Any]:
+        """转换为文件头中的参数字段"""
+        header: Dict[str, Any] = {
+            'kdf': self.algorithm,
+            'salt': base64.b64encode(self.salt).decode(),
+        }
+        if self.algorithm == 'scrypt':
+            header.update({'n': self.n, 'r': self.r, 'p': self.p})
+        else:
+            header['iterations'] = self.iterations
+        return header
+    
+    @classmethod
+    def from_header(cls, header: Dict[str, Any]) -> 'KdfParams':
+        """从文件头恢复参数，参数超出允许范围时抛出 ValueError"""
+        params = cls(
+            algorithm=header.get('kdf', KDF_ALGORITHM),
+            salt=base64.b64decode(header['salt']) if 'salt' in header else SALT,
+            iterations=int(header.get('iterations', KDF_ITERATIONS)),
+            n=int(header.get('n', 2 ** 14)),
+            r=int(header.get('r', 8)),
+            p=int(header.get('p', 1)),
+        )
+        if len(params.salt) > MAX_KDF_SALT_LENGTH:
+            raise ValueError(f"密钥派生盐过长: {len(params.salt)}")
+        if params.algorithm == 'scrypt':
+            if params.n not in SCRYPT_ALLOWED_N or not 1 <= params.r <= MAX_SCRYPT_R or \
+                    not 1 <= params.p <= MAX_SCRYPT_P:
+                raise ValueError(f"不支持的scrypt参数: n={params.n}, r={params.r}, p={params.p}")
+        elif not 1 <= params.iterations <= MAX_KDF_ITERATIONS:
+            raise ValueError(f"不支持的迭代次数: {params.iterations}")
+        return params
 
 
 class Encryption:
     """处理加密和解密操作"""
     
+    # 保存验证文件时使用的密钥派生参数；读取时以文件头记录的参数为准
+    kdf = KdfParams()
+    # 旧版无文件头的文件固定使用默认参数
+    legacy_kdf = KdfParams()
+    
+    # 派生密钥缓存：(硬件ID, KDF参数) -> 密钥，避免每次加解密都重新运行KDF
+    _key_cache: "OrderedDict[Tuple[Any, ...], bytearray]" = OrderedDict()
+    _key_cache_lock = threading.Lock()
+    
     @staticmethod
-    def get_key(hardware_id: str) -> bytes:
-        """从硬件ID生成加密密钥"""
+    def derive_key(hardware_id: str, kdf: Optional[KdfParams] = None) -> bytes:
+        """从硬件ID派生加密密钥（不使用缓存）"""
         # 使用硬件ID和盐值派生一个密钥
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=SALT,
-            iterations=100000,
-        )
+        kdf = kdf or Encryption.kdf
         key = base64.urlsafe_b64encode(kdf.derive(hardware_id.encode()))
         return key
     
+    @staticmethod
+    def get_key(hardware_id: str, kdf: Optional[KdfParams] = None) -> bytes:
+        """从硬件ID生成加密密钥，同一进程内只派生一次"""
+        kdf = kdf or Encryption.kdf
+        cache_key = (hardware_id,) + kdf.cache_key()
+        with Encryption._key_cache_lock:
+            key = Encryption._key_cache.get(cache_key)
+            if key is not None:
+                Encryption._key_cache.move_to_end(cache_key)
+                return bytes(key)
+        
+        key = bytearray(Encryption.derive_key(hardware_id, kdf))
+        with Encryption._key_cache_lock:
+            Encryption._key_cache[cache_key] = key
+            while len(Encryption._key_cache) > KEY_CACHE_SIZE:
+                _, old_key = Encryption._key_cache.popitem(last=False)
+                old_key[:] = b'\x00' * len(old_key)
+        return bytes(key)
+    
+    @staticmethod
+    def clear_key_cache() -> None:
+        """清空密钥缓存并清零已缓存的密钥"""
+        with Encryption._key_cache_lock:
+            for key in Encryption._key_cache.values():
+                key[:] = b'\x00' * len(key)
+            Encryption._key_cache.clear()
+    
+    @staticmethod
+    def unpack(encrypted_data: bytes) -> Tuple[Optional[Dict[str, Any]], bytes]:
+        """拆分文件头和密文；旧版无文件头的文件返回 (None, 原始数据)"""
+        if not encrypted_data.startswith(FILE_MAGIC):
+            return None, encrypted_data
+        
+        header_line, _, token = encrypted_data[len(FILE_MAGIC):].partition(b'\n')
+        header = json.loads(header_line.decode())
+        if header.get('version') != FILE_VERSION:
+            raise ValueError(f"不支持的验证文件版本: {header.get('version')}")
+        if header.get('payload', 'fernet') != 'fernet' or header.get('encoding', 'json') != 'json':
+            raise ValueError(f"不支持的验证文件编码: {header.get('payload')}/{header.get('encoding')}")
+        return header, token
+    
     @staticmethod
     def encrypt_data(data: Dict[str, Any], hardware_id: str) -> bytes:
-        """加密数据"""
+        """加密数据，总是写出带文件头的新格式"""
         # 将数据转换为JSON字符串
         json_data = json.dumps(data)
         
@@ -157,18 +400,24 @@ class Encryption:
         fernet = Fernet(key)
         encrypted_data = fernet.encrypt(json_data.encode())
         
-        return encrypted_data
+        # 加上记录版本和KDF参数的文件头
+        header = {'version': FILE_VERSION}
+        header.update(Encryption.kdf.to_header())
+        header.update({'payload': 'fernet', 'encoding': 'json'})
+        return FILE_MAGIC + json.dumps(header, separators=(',', ':')).encode() + b'\n' + encrypted_data
     
     @staticmethod
     def decrypt_data(encrypted_data: bytes, hardware_id: str) -> Optional[Dict[str, Any]]:
-        """解密数据"""
+        """解密数据，兼容旧版无文件头的文件"""
         try:
-            # 获取解密密钥
-            key = Encryption.get_key(hardware_id)
+            # 按文件头记录的参数获取解密密钥
+            header, token = Encryption.unpack(encrypted_data)
+            kdf = KdfParams.from_header(header) if header else Encryption.legacy_kdf
+            key = Encryption.get_key(hardware_id, kdf)
             
             # 使用Fernet对称解密
             fernet = Fernet(key)
-            decrypted_data = fernet.decrypt(encrypted_data).decode()
+            decrypted_data = fernet.decrypt(token).decode()
             
             # 解析JSON
             return json.loads(decrypted_data)
@@ -266,31 +515,8 @@ def verify_card_key(key: str, user_identifier: str = '') -> Dict[str, Any]:
     返回:
         dict: 包含验证结果的字典
     """
-    try:
-        # 发送POST请求到API
-        response = requests.post(
-            API_URL,
-            json={'key': key, 'userIdentifier': user_identifier},
-            timeout=10  # 10秒超时
-        )
-        
-        # 检查HTTP状态码
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return {
-                'success': False, 
-                'message': f'API错误: HTTP {response.status_code}'
-            }
-            
-    except requests.exceptions.Timeout:
-        return {'success': False, 'message': '连接超时，请检查网络'}
-    except requests.exceptions.ConnectionError:
-        return {'success': False, 'message': '连接失败，请检查网络或API地址'}
-    except json.JSONDecodeError:
-        return {'success': False, 'message': 'API返回的数据格式错误'}
-    except Exception as e:
-        return {'success': False, 'message': f'未知错误: {str(e)}'}
+    # 通过共享的长连接传输发送POST请求到API
+    return verify_card_key_request(key, user_identifier, API_URL)
 
 
 def print_result(result: Dict[str, Any], verification_manager: VerificationManager) -> None:
@@ -394,6 +620,12 @@ def debug_hardware_info():
 
 
 if __name__ == "__main__":
+    # 批量验证模式，结果以JSON行输出，不进入交互界面
+    # 用法: python verify_card_key_advanced.py --batch keys.txt [--workers 8] [--rate 20] [--output results.jsonl]
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        from kami_batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:], api_url=API_URL))
+    
     try:
         # 检查是否是调试模式
         if len(sys.argv) > 1 and sys.argv[1] == "--debug":
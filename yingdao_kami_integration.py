@@ -4,6 +4,9 @@
 # 3. 当此模块作为流程独立运行时执行main函数
 # 4. 可视化流程中可以通过"调用模块"的指令使用此模块
 
+# 类型注解不在导入时求值，避免为了注解提前加载 requests
+from __future__ import annotations
+
 import xbot
 from xbot import print, sleep
 from .import package
@@ -11,43 +14,1510 @@ from .package import variables as glv
 
 import threading
 import time
+import atexit
+import bisect
+import functools
 import json
 import hashlib
-import winreg
-import wmi
+import importlib
 import os
+import sys
 import signal
-import win32api
-import win32con
-import ctypes.wintypes
-import binascii
-import inspect
-import requests
+import random
+import socket
 import platform
 import uuid
 import subprocess
 import base64
+import copy
 import datetime
+import re
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
 from enum import IntEnum
 from typing import List, Dict, Any, Optional, Tuple, Union
 
-# 安装必要的库
-try:
-    from cryptography.fernet import Fernet
-    from cryptography.hazmat.primitives import hashes, padding
-    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-    from cryptography.hazmat.primitives.ciphers import algorithms
-except ImportError:
-    os.system('pip install cryptography requests')
-    from cryptography.fernet import Fernet
-    from cryptography.hazmat.primitives import hashes, padding
-    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-    from cryptography.hazmat.primitives.ciphers import algorithms
+class _LazyModule:
+    """
+    延迟导入的模块，第一次访问属性时才真正导入
+    
+    requests、cryptography 加载较慢，放到第一次验证时再导入，流程加载本模块时不产生额外耗时；
+    缺少依赖时与以前一样自动安装，但同样推迟到第一次使用时。
+    """
+    _install_lock = threading.Lock()
+    
+    def __init__(self, name: str, install: str = ''):
+        self._name = name
+        self._install = install
+        self._module = None
+    
+    def _load(self):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError:
+                if not self._install:
+                    raise
+                with _LazyModule._install_lock:
+                    os.system(f'pip install {self._install}')
+                importlib.invalidate_caches()
+                self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+# 安装必要的库（第一次使用时导入）
+_REQUIRED_PACKAGES = 'cryptography requests'
+requests = _LazyModule('requests', _REQUIRED_PACKAGES)
+_requests_adapters = _LazyModule('requests.adapters', _REQUIRED_PACKAGES)
+_urllib3_exceptions = _LazyModule('urllib3.exceptions', _REQUIRED_PACKAGES)
+_fernet = _LazyModule('cryptography.fernet', _REQUIRED_PACKAGES)
+_hashes = _LazyModule('cryptography.hazmat.primitives.hashes', _REQUIRED_PACKAGES)
+_pbkdf2 = _LazyModule('cryptography.hazmat.primitives.kdf.pbkdf2', _REQUIRED_PACKAGES)
+_scrypt = _LazyModule('cryptography.hazmat.primitives.kdf.scrypt', _REQUIRED_PACKAGES)
+_ed25519 = _LazyModule('cryptography.hazmat.primitives.asymmetric.ed25519', _REQUIRED_PACKAGES)
+_crypto_exceptions = _LazyModule('cryptography.exceptions', _REQUIRED_PACKAGES)
+_sqlite3 = _LazyModule('sqlite3')
 
 # 配置常量
 DEFAULT_API_URL = 'http://170.106.175.187/api/card-keys/verify'
 DEFAULT_VERIFICATION_FILE = 'verification.bin'
 DEFAULT_SALT = b'kami_verification_system_salt'
+# HTTP连接超时、读取超时（秒）和长连接池大小
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 10
+DEFAULT_STATS_HISTORY = 1000
+# 连接失败时的重试次数与退避时间（秒），以及熔断阈值和熔断恢复时间（秒）
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_BASE = 0.2
+DEFAULT_BACKOFF_MAX = 2.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+# 被服务器拒绝的卡密在本地直接返回失败的时间（秒），按失败原因区分
+DEFAULT_NEGATIVE_CACHE_SIZE = 256
+DEFAULT_NEGATIVE_TTLS = {
+    '卡密不存在': 120,
+    '卡密已被使用': 600,
+    '卡密已过期': 3600,
+}
+# 熔断器状态
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+# 心跳检测间隔（秒），临近到期时会提前到到期时刻检查
+DEFAULT_HEARTBEAT_INTERVAL = 300
+# 后台复验：本地记录距上次服务器确认超过该时间（秒）后，由心跳线程在后台重新验证
+DEFAULT_STALE_AFTER = 3600
+# 后台复验：无法连接服务器时，距上次服务器确认多久（秒）以内仍允许继续使用
+DEFAULT_OFFLINE_GRACE = 72 * 3600
+DEFAULT_KDF_ALGORITHM = 'pbkdf2-sha256'
+DEFAULT_KDF_ITERATIONS = 100000
+# 文件头中KDF参数的允许范围：验证文件可以被篡改，超出范围的参数会让派生耗尽CPU或内存
+MAX_KDF_ITERATIONS = 1000000
+SCRYPT_ALLOWED_N = (2 ** 14, 2 ** 15, 2 ** 16, 2 ** 17)
+MAX_SCRYPT_R = 8
+MAX_SCRYPT_P = 4
+MAX_KDF_SALT_LENGTH = 64
+# 验证文件头：KAMI/ + JSON参数 + 换行，之后是Fernet密文
+KAMI_FILE_MAGIC = b'KAMI/'
+KAMI_FILE_VERSION = 1
+# 进程内最多缓存的派生密钥数量
+DEFAULT_KEY_CACHE_SIZE = 8
+# 硬件ID磁盘缓存文件，None 表示只使用进程内缓存
+DEFAULT_HARDWARE_CACHE_FILE = None
+# 硬件信息单项采集期限和整体时间预算（秒）
+DEFAULT_PROBE_TIMEOUT = 3.0
+DEFAULT_PROBE_BUDGET = 5.0
+# 一次硬件采集中通过同一个WMI连接查询的属性
+WMI_PROBE_QUERIES = (
+    ('Win32_Processor', 'ProcessorId'),
+    ('Win32_DiskDrive', 'SerialNumber'),
+    ('Win32_BaseBoard', 'SerialNumber'),
+)
+# 授权令牌：服务器用Ed25519签名，客户端用公钥离线验证卡密、硬件ID和到期时间
+LICENSE_TOKEN_VERSION = 1
+# 固定的服务器根公钥（base64url），也可以用环境变量 KAMI_LICENSE_PUBLIC_KEY 指定；
+# 设置后本地验证必须带有有效的授权令牌，运行时获取的公钥只有带根私钥背书时才被接受
+LICENSE_PUBLIC_KEY = None
+LICENSE_PUBLIC_KEY_ENV = 'KAMI_LICENSE_PUBLIC_KEY'
+# 签名公钥的背书：根私钥对 前缀 + base64url签名公钥 的签名
+LICENSE_KEY_ENDORSEMENT_PREFIX = b'kami-license-key:v1:'
+# 背书有效的签名公钥缓存在验证文件所在目录的这个文件中
+DEFAULT_PUBLIC_KEY_FILE = 'license_public.key'
+# 本机保存过带令牌的记录后创建的标记文件，之后不再接受没有令牌的旧记录
+DEFAULT_TOKEN_MARKER_FILE = 'license_token.required'
+PUBLIC_KEY_RETRY_INTERVAL = 300  # 两次从服务器获取签名公钥之间至少间隔（秒）
+DEFAULT_TOKEN_CACHE_SIZE = 16  # 内存中缓存的已验证令牌数量
+# 多卡密授权库：保存在验证文件所在目录，内存中最多缓存的解密记录数
+DEFAULT_LICENSE_DB = 'licenses.db'
+DEFAULT_LICENSE_CACHE_SIZE = 32
+# 验证文件写入：冗余的连续保存在这个时间窗口（秒）内合并为一次磁盘写入；备份文件保存最后一次同步写入的内容
+DEFAULT_WRITE_COALESCE_WINDOW = 0.2
+BACKUP_SUFFIX = '.bak'
+# 多进程读写验证文件时的文件锁：锁文件为验证文件路径加 .lock，等待锁最多这么久（秒）；
+# 读取超时后再等待这么多次，写入超时直接失败，任何情况下都不会不加锁读写
+LOCK_SUFFIX = '.lock'
+DEFAULT_LOCK_TIMEOUT = 2.0
+READ_LOCK_RETRIES = 1
+# 验证文件变更监控：无法使用 inotify / ReadDirectoryChangesW 时改为定时检查文件状态，间隔（秒）
+DEFAULT_WATCH_POLL_INTERVAL = 1.0
+# 各阶段耗时统计（默认关闭）：直方图各桶的上限（毫秒），超过最后一个上限的计入最后一桶；
+# 单次耗时达到阈值（秒）时调用慢操作回调
+TIMING_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+DEFAULT_SLOW_THRESHOLD = 1.0
+# 本地授权代理（kami_agent.py）：地址可以用环境变量 KAMI_AGENT_ADDRESS 指定
+AGENT_ADDRESS_ENV = 'KAMI_AGENT_ADDRESS'
+DEFAULT_AGENT_TIMEOUT = 15.0  # 等待代理响应的时间（秒），验证请求需要访问服务器
+DEFAULT_AGENT_RETRY_INTERVAL = 30.0  # 连接代理失败后，多久之后再尝试连接（秒）
+
+# 过期时间格式：2023-12-31、2023-12-31 23:59:59、2023-12-31T23:59:59.000Z、2023-12-31T23:59:59+08:00
+_EXPIRY_TIME_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d{2}:?\d{2})?$'
+)
+
+
+class _NullTimer:
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    __slots__ = ('timings', 'stage', 'start')
+    
+    def __init__(self, timings: 'StageTimings', stage: str):
+        self.timings = timings
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.timings.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimings:
+    """
+    验证流程各阶段耗时统计
+    
+    默认关闭，关闭时计时点只多一次属性判断。开启后按阶段记录次数、总耗时、最大耗时和直方图，
+    单次耗时达到 slow_threshold 秒时调用 slow_callback(阶段, 耗时秒)。
+    """
+    
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = DEFAULT_SLOW_THRESHOLD
+        self.slow_callback = None
+        self._lock = threading.Lock()
+        self._stages: Dict[str, List[Any]] = {}
+    
+    def enable(self, enabled: bool = True, slow_threshold: Optional[float] = None, slow_callback=None) -> None:
+        """开启或关闭统计，slow_callback 为None时保留原来的回调"""
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if slow_callback is not None:
+            self.slow_callback = slow_callback
+        self.enabled = enabled
+    
+    def timing(self, stage: str):
+        """计时上下文：with stage_timings.timing('阶段'): ..."""
+        return _StageTimer(self, stage) if self.enabled else _NULL_TIMER
+    
+    def record(self, stage: str, elapsed: float) -> None:
+        """记录一次耗时（秒）"""
+        bucket = min(bisect.bisect_left(TIMING_BUCKETS_MS, elapsed * 1000), len(TIMING_BUCKETS_MS) - 1)
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [0, 0.0, 0.0, [0] * len(TIMING_BUCKETS_MS)]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3][bucket] += 1
+        callback = self.slow_callback
+        if callback is not None and elapsed >= self.slow_threshold:
+            try:
+                callback(stage, elapsed)
+            except Exception as e:
+                print(f"慢操作回调执行失败: {e}")
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        按阶段导出统计：count 次数，total/avg/max 耗时（秒），
+        histogram 为各耗时区间的次数（键为区间上限，如 "<=5ms"，最后一桶包括更慢的）
+        """
+        labels = [f'<={bound:g}ms' for bound in TIMING_BUCKETS_MS]
+        with self._lock:
+            return {
+                stage: {
+                    'count': count,
+                    'total': total,
+                    'avg': total / count if count else 0.0,
+                    'max': max_time,
+                    'histogram': dict(zip(labels, buckets)),
+                }
+                for stage, (count, total, max_time, buckets) in sorted(self._stages.items())
+            }
+    
+    def reset(self) -> None:
+        with self._lock:
+            self._stages.clear()
+
+
+stage_timings = StageTimings()
+
+
+def timed_stage(stage: str):
+    """函数计时装饰器，统计关闭时直接调用原函数"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not stage_timings.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage_timings.record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def enable_timings(enabled: bool = True, slow_threshold: Optional[float] = None, slow_callback=None) -> None:
+    """开启或关闭各阶段耗时统计，slow_callback(阶段, 耗时秒) 在单次耗时达到 slow_threshold 秒时调用"""
+    stage_timings.enable(enabled, slow_threshold, slow_callback)
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """获取各阶段耗时统计，见 StageTimings.get_stats()"""
+    return stage_timings.get_stats()
+
+
+@timed_stage('parse_expiry')
+def parse_expiry_time(expiry_time: Any) -> Optional[float]:
+    """
+    将过期时间解析为Unix时间戳，无法解析时返回None
+    
+    带 Z 或时区偏移的时间按对应时区解析，不带时区的按本地时间解析；数字视为已是时间戳。
+    """
+    if isinstance(expiry_time, (int, float)) and not isinstance(expiry_time, bool):
+        return float(expiry_time)
+    if not isinstance(expiry_time, str):
+        return None
+    
+    match = _EXPIRY_TIME_PATTERN.match(expiry_time.strip())
+    if not match:
+        return None
+    
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    tzinfo = None
+    if zone == 'Z':
+        tzinfo = datetime.timezone.utc
+    elif zone:
+        sign = -1 if zone[0] == '-' else 1
+        digits = zone[1:].replace(':', '')
+        offset = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+        tzinfo = datetime.timezone(sign * offset)
+    
+    try:
+        expiry = datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour or 0), int(minute or 0), int(second or 0),
+            int((fraction or '0').ljust(6, '0')),
+            tzinfo=tzinfo,
+        )
+        return expiry.timestamp()
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+def get_record_expires_at(record: Optional[Dict[str, Any]]) -> Optional[float]:
+    """获取验证记录的过期时间戳，优先使用保存时记录的 expires_at"""
+    if not record:
+        return None
+    expires_at = record.get('expires_at')
+    if isinstance(expires_at, (int, float)) and not isinstance(expires_at, bool):
+        return float(expires_at)
+    data = record.get('data') or {}
+    return parse_expiry_time(data.get('expiryTime'))
+
+
+class FileLockTimeout(OSError):
+    """等待文件锁超时，验证文件暂时无法读写"""
+    pass
+
+
+class FileLock:
+    """
+    跨进程文件锁（建议锁）
+    
+    共享锁用于读取，多个进程可以同时持有；排他锁用于写入和删除。Linux/macOS 使用 fcntl.flock，
+    Windows 使用 LockFileEx（通过 msvcrt 获取文件句柄，msvcrt.locking 不支持共享锁）。
+    每次加锁单独打开锁文件，同一进程的不同线程之间同样互斥。等待超过 timeout 秒时抛出 FileLockTimeout。
+    """
+    
+    def __init__(self, path: str, timeout: float = DEFAULT_LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self._stats = {'shared': 0, 'exclusive': 0, 'contended': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+    
+    if os.name == 'nt':
+        _overlapped_type = None
+        
+        @staticmethod
+        def _win_args(fd: int):
+            import ctypes
+            import msvcrt
+            from ctypes import wintypes
+            if FileLock._overlapped_type is None:
+                class _Overlapped(ctypes.Structure):
+                    _fields_ = [('Internal', ctypes.c_void_p), ('InternalHigh', ctypes.c_void_p),
+                                ('Offset', wintypes.DWORD), ('OffsetHigh', wintypes.DWORD),
+                                ('hEvent', wintypes.HANDLE)]
+                FileLock._overlapped_type = _Overlapped
+            handle = wintypes.HANDLE(msvcrt.get_osfhandle(fd))
+            return ctypes.windll.kernel32, handle, ctypes.byref(FileLock._overlapped_type())
+        
+        @staticmethod
+        def _try_lock(fd: int, exclusive: bool) -> bool:
+            kernel32, handle, overlapped = FileLock._win_args(fd)
+            flags = 0x1  # LOCKFILE_FAIL_IMMEDIATELY
+            if exclusive:
+                flags |= 0x2  # LOCKFILE_EXCLUSIVE_LOCK
+            return bool(kernel32.LockFileEx(handle, flags, 0, 1, 0, overlapped))
+        
+        @staticmethod
+        def _unlock(fd: int) -> None:
+            kernel32, handle, overlapped = FileLock._win_args(fd)
+            kernel32.UnlockFileEx(handle, 0, 1, 0, overlapped)
+    else:
+        @staticmethod
+        def _try_lock(fd: int, exclusive: bool) -> bool:
+            import fcntl
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                return False
+        
+        @staticmethod
+        def _unlock(fd: int) -> None:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    
+    def acquire(self, exclusive: bool = False, timeout: Optional[float] = None) -> int:
+        """加锁并返回锁文件描述符，传给 release() 释放（关闭描述符即释放锁）"""
+        timeout = self.timeout if timeout is None else timeout
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        start = None
+        delay = 0.001
+        try:
+            while not self._try_lock(fd, exclusive):
+                now = time.monotonic()
+                if start is None:
+                    start = now
+                elif now - start >= timeout:
+                    with self._stats_lock:
+                        self._stats['contended'] += 1
+                        self._stats['timeouts'] += 1
+                        self._stats['wait_seconds'] += now - start
+                    raise FileLockTimeout(f"等待文件锁超时: {self.path}")
+                time.sleep(min(delay, max(timeout - (now - start), 0.0)))
+                delay = min(delay * 2, 0.05)
+        except BaseException:
+            os.close(fd)
+            raise
+        with self._stats_lock:
+            self._stats['exclusive' if exclusive else 'shared'] += 1
+            if start is not None:
+                waited = time.monotonic() - start
+                self._stats['contended'] += 1
+                self._stats['wait_seconds'] += waited
+        if start is not None and stage_timings.enabled:
+            stage_timings.record('file.lock_wait', waited)
+        return fd
+    
+    @staticmethod
+    def release(fd: int) -> None:
+        try:
+            FileLock._unlock(fd)
+        finally:
+            os.close(fd)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """加锁次数（shared/exclusive）、需要等待的次数（contended）、超时次数和累计等待时间"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 6)
+        return stats
+
+
+def atomic_write_file(path: str, data: bytes) -> None:
+    """
+    原子写入文件：先写入同目录下的临时文件并 fsync，再重命名覆盖目标文件
+    
+    写入过程中崩溃或断电时，目标文件保持原来的完整内容，不会出现写了一半的文件。
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if os.name != 'nt':
+        # 重命名本身也要落盘，否则断电后目录中可能仍是旧文件
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+
+class AtomicFileWriter:
+    """
+    验证文件写入器
+    
+    每次写入都是原子的（临时文件、fsync、重命名）。sync 写入立即落盘，并同样原子地更新备份文件（路径加 .bak），
+    作为最后一次完好的副本，因此每次 sync 写入会写两个文件。调用方只对冗余的写入（例如只刷新复验时间）
+    不传 sync：一段时间内的第一次立即落盘（不更新备份），窗口内随后的写入只保留最新内容，在窗口结束时
+    合并为一次写入，进程退出时写入未落盘的内容；进程崩溃或被强制结束时最多丢失这些冗余写入。
+    写入失败时 write()、flush() 抛出 OSError；后台合并写入失败时，下一次 write() 立即写入并报告错误。
+    同一路径在进程内共用一个写入器，通过 get_file_writer() 获取。
+    
+    读取时持有共享锁、写入和删除时持有排他锁（锁文件为路径加 .lock），多个进程共用同一文件时不会读到
+    正在替换的文件；Windows 上也不会因为其他进程正打开文件而替换失败。从不在没有锁的情况下读写：
+    读取等锁超时后重试 READ_LOCK_RETRIES 次，仍超时或写入等锁超时时抛出 FileLockTimeout，
+    无法创建锁文件时抛出 OSError。超时次数记录在 lock.get_stats() 中。
+    """
+    
+    def __init__(self, path: str, coalesce_window: float = DEFAULT_WRITE_COALESCE_WINDOW, backup: bool = True,
+                 lock_timeout: float = DEFAULT_LOCK_TIMEOUT):
+        self.path = path
+        self.backup_path = path + BACKUP_SUFFIX if backup else None
+        self.coalesce_window = coalesce_window
+        self.lock = FileLock(path + LOCK_SUFFIX, lock_timeout)
+        self._lock = threading.RLock()
+        self._pending: Optional[bytes] = None
+        self._timer: Optional[threading.Timer] = None
+        self._failed: Optional[OSError] = None
+        self._last_write = 0.0
+        self.writes = 0
+        self.coalesced = 0
+    
+    def _lock_file(self, exclusive: bool) -> int:
+        """加文件锁；共享锁超时后重试，仍超时或排他锁超时时抛出 FileLockTimeout"""
+        retries = 0 if exclusive else READ_LOCK_RETRIES
+        while True:
+            try:
+                return self.lock.acquire(exclusive)
+            except FileLockTimeout:
+                if retries <= 0:
+                    raise
+                retries -= 1
+    
+    def _unlock_file(self, fd: int) -> None:
+        self.lock.release(fd)
+    
+    @timed_stage('file.read')
+    def _read_file(self, path: str) -> bytes:
+        fd = self._lock_file(exclusive=False)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            self._unlock_file(fd)
+    
+    @timed_stage('file.write')
+    def _write_now(self, data: bytes, backup: bool = False) -> None:
+        fd = self._lock_file(exclusive=True)
+        try:
+            atomic_write_file(self.path, data)
+            if backup and self.backup_path:
+                atomic_write_file(self.backup_path, data)
+        finally:
+            self._unlock_file(fd)
+        self._failed = None
+        self._last_write = time.monotonic()
+        self.writes += 1
+    
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+    
+    def write(self, data: bytes, sync: bool = False) -> None:
+        """
+        写入数据，失败时抛出 OSError
+        
+        sync 为True时立即落盘并更新备份，取代尚未落盘的内容；否则处于合并窗口内时推迟到窗口结束再落盘。
+        """
+        with self._lock:
+            # 上次推迟的写入失败时立即写入，让调用方得知
+            sync = sync or self._failed is not None
+            wait = self._last_write + self.coalesce_window - time.monotonic()
+            if sync or (self._timer is None and wait <= 0):
+                self._cancel_timer()
+                self._write_now(data, backup=sync)
+                self._pending = None
+                return
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = data
+            if self._timer is None:
+                self._timer = threading.Timer(max(wait, 0.0), self._flush_timer)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def _flush_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            try:
+                self._flush_pending()
+            except OSError as e:
+                # 内容保留在 _pending 中，下一次 write() 或 flush() 时重试并报告错误
+                print(f"写入文件失败: {self.path}: {e}")
+    
+    def _flush_pending(self) -> None:
+        if self._pending is None:
+            return
+        try:
+            self._write_now(self._pending)
+        except OSError as e:
+            self._failed = e
+            raise
+        self._pending = None
+    
+    def flush(self) -> None:
+        """立即写入尚未落盘的内容，失败时抛出 OSError"""
+        with self._lock:
+            self._cancel_timer()
+            self._flush_pending()
+    
+    def pending(self) -> Optional[bytes]:
+        """尚未落盘的内容，没有时返回None"""
+        with self._lock:
+            return self._pending
+    
+    def read(self) -> Optional[bytes]:
+        """读取最新内容（包括尚未落盘的），文件不存在时返回None"""
+        with self._lock:
+            if self._pending is not None:
+                return self._pending
+        try:
+            return self._read_file(self.path)
+        except FileNotFoundError:
+            return None
+    
+    def read_backup(self) -> Optional[bytes]:
+        """读取最后一次完好的副本，没有时返回None"""
+        if not self.backup_path:
+            return None
+        try:
+            return self._read_file(self.backup_path)
+        except OSError:
+            return None
+    
+    def restore_backup(self) -> bool:
+        """用备份文件恢复损坏的文件"""
+        data = self.read_backup()
+        if data is None:
+            return False
+        with self._lock:
+            if self._pending is not None:
+                return False
+            fd = self._lock_file(exclusive=True)
+            try:
+                atomic_write_file(self.path, data)
+            finally:
+                self._unlock_file(fd)
+        return True
+    
+    def remove(self, backup: bool = True) -> None:
+        """丢弃尚未落盘的内容并删除文件（backup 为True时同时删除备份）"""
+        with self._lock:
+            self._cancel_timer()
+            self._pending = None
+            self._failed = None
+            paths = [self.path] + ([self.backup_path] if backup and self.backup_path else [])
+            fd = self._lock_file(exclusive=True)
+            try:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                self._unlock_file(fd)
+
+
+_file_writers: Dict[str, AtomicFileWriter] = {}
+_file_writers_lock = threading.Lock()
+
+
+def get_file_writer(path: str) -> AtomicFileWriter:
+    """获取路径对应的写入器，同一文件在进程内只有一个写入器"""
+    path = os.path.abspath(path)
+    with _file_writers_lock:
+        writer = _file_writers.get(path)
+        if writer is None:
+            writer = _file_writers[path] = AtomicFileWriter(path)
+        return writer
+
+
+class FileWatcher:
+    """
+    验证文件变更监控
+    
+    在后台线程中监控文件所在目录，文件被创建、修改、替换或删除时调用 callback(path)，
+    其他进程重新验证或清理验证文件后，本进程几毫秒内即可得知，无需定时重新读取解密。
+    Linux 使用 inotify，Windows 使用 ReadDirectoryChangesW，都不可用时每隔 poll_interval 秒
+    比较一次文件的 (mtime, size, inode)。同一批事件只调用一次回调，本进程自己的写入也会触发。
+    """
+    
+    # inotify 事件：写入后关闭、移入（原子替换）、移出、创建、删除
+    _IN_EVENTS = 0x8 | 0x80 | 0x40 | 0x100 | 0x200
+    # ReadDirectoryChangesW：文件名、大小、最后写入时间变化
+    _WIN_FILTER = 0x1 | 0x8 | 0x10
+    
+    def __init__(self, path: str, callback, poll_interval: float = DEFAULT_WATCH_POLL_INTERVAL,
+                 use_native: bool = True):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.use_native = use_native
+        self.backend: Optional[str] = None
+        self.events = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._wake_fds: Optional[Tuple[int, int]] = None
+        self._win_handle = None
+    
+    def start(self) -> 'FileWatcher':
+        """启动监控线程，backend 为实际使用的方式：inotify、windows 或 polling"""
+        if self._thread is not None:
+            return self
+        target = self._poll_loop
+        self.backend = 'polling'
+        if self.use_native:
+            try:
+                if sys.platform.startswith('linux'):
+                    target = self._inotify_setup()
+                    self.backend = 'inotify'
+                elif os.name == 'nt':
+                    target = self._windows_setup()
+                    self.backend = 'windows'
+            except (OSError, AttributeError) as e:
+                print(f"无法使用系统文件监控，改为定时检查: {e}")
+        self._thread = threading.Thread(target=target, name='kami-file-watcher', daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        """停止监控线程"""
+        self._stop.set()
+        if self._wake_fds is not None:
+            try:
+                os.write(self._wake_fds[1], b'x')
+            except OSError:
+                pass
+        if self._win_handle is not None:
+            import ctypes
+            ctypes.windll.kernel32.CancelIoEx(self._win_handle, None)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.poll_interval + 1)
+        self._thread = None
+    
+    def _notify(self) -> None:
+        self.events += 1
+        try:
+            self.callback(self.path)
+        except Exception as e:
+            print(f"文件变更回调执行失败: {e}")
+    
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    
+    def _poll_loop(self) -> None:
+        last = self._stat()
+        while not self._stop.wait(self.poll_interval):
+            current = self._stat()
+            if current != last:
+                last = current
+                self._notify()
+    
+    def _inotify_setup(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+        directory = os.path.dirname(self.path).encode()
+        if libc.inotify_add_watch(fd, directory, FileWatcher._IN_EVENTS) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, 'inotify_add_watch 失败')
+        self._wake_fds = os.pipe()
+        return lambda: self._inotify_loop(fd)
+    
+    def _inotify_loop(self, fd: int) -> None:
+        import select
+        import struct
+        name = os.path.basename(self.path).encode()
+        wake_r, wake_w = self._wake_fds
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select([fd, wake_r], [], [])
+                if wake_r in readable:
+                    break
+                try:
+                    buf = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                changed = False
+                offset = 0
+                # struct inotify_event { int wd; uint32 mask, cookie, len; char name[len]; }
+                while offset + 16 <= len(buf):
+                    _, _, _, length = struct.unpack_from('iIII', buf, offset)
+                    if buf[offset + 16:offset + 16 + length].rstrip(b'\0') == name:
+                        changed = True
+                    offset += 16 + length
+                if changed:
+                    self._notify()
+        finally:
+            os.close(fd)
+            os.close(wake_r)
+            os.close(wake_w)
+            self._wake_fds = None
+    
+    def _windows_setup(self):
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        handle = kernel32.CreateFileW(
+            os.path.dirname(self.path), 0x1,  # FILE_LIST_DIRECTORY
+            0x1 | 0x2 | 0x4, None, 3,  # FILE_SHARE_READ | WRITE | DELETE, OPEN_EXISTING
+            0x02000000, None  # FILE_FLAG_BACKUP_SEMANTICS
+        )
+        if handle in (None, wintypes.HANDLE(-1).value):
+            raise OSError(ctypes.GetLastError(), 'CreateFileW 失败')
+        self._win_handle = wintypes.HANDLE(handle)
+        return self._windows_loop
+    
+    def _windows_loop(self) -> None:
+        import ctypes
+        import struct
+        from ctypes import wintypes
+        kernel32 = ctypes.windll.kernel32
+        name = os.path.basename(self.path).lower()
+        buf = ctypes.create_string_buffer(65536)
+        returned = wintypes.DWORD()
+        try:
+            while not self._stop.is_set():
+                # 同步等待目录变化，stop() 调用 CancelIoEx 后返回失败
+                if not kernel32.ReadDirectoryChangesW(self._win_handle, buf, len(buf), False,
+                                                      FileWatcher._WIN_FILTER, ctypes.byref(returned),
+                                                      None, None):
+                    break
+                data = buf.raw[:returned.value]
+                changed = False
+                offset = 0
+                # FILE_NOTIFY_INFORMATION { DWORD NextEntryOffset, Action, FileNameLength; WCHAR FileName[]; }
+                while offset + 12 <= len(data):
+                    next_offset, _, length = struct.unpack_from('<III', data, offset)
+                    if data[offset + 12:offset + 12 + length].decode('utf-16-le').lower() == name:
+                        changed = True
+                    if not next_offset:
+                        break
+                    offset += next_offset
+                if changed or not data:
+                    # 缓冲区溢出时 returned 为0，无法得知具体文件，按变化处理
+                    self._notify()
+        finally:
+            kernel32.CloseHandle(self._win_handle)
+            self._win_handle = None
+
+
+@atexit.register
+def flush_file_writers() -> None:
+    """写入所有尚未落盘的内容，进程退出时自动调用"""
+    with _file_writers_lock:
+        writers = list(_file_writers.values())
+    for writer in writers:
+        try:
+            writer.flush()
+        except OSError as e:
+            print(f"写入文件失败: {writer.path}: {e}")
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发出"""
+
+class TransportStats:
+    """HTTP请求耗时统计"""
+
+    def __init__(self, history: int = DEFAULT_STATS_HISTORY):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.recent: deque = deque(maxlen=history)
+
+    def record(self, url: str, elapsed: float, status: Optional[int] = None, error: Optional[str] = None) -> None:
+        """记录一次请求"""
+        with self._lock:
+            self.count += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            if error is not None:
+                self.errors += 1
+            self.recent.append({
+                'time': time.time(),
+                'url': url,
+                'status': status,
+                'elapsed': elapsed,
+                'error': error,
+            })
+
+    @staticmethod
+    def _percentile(values, percent: float) -> float:
+        if not values:
+            return 0.0
+        index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+        return values[index]
+
+    def to_dict(self, include_recent: bool = False) -> Dict[str, Any]:
+        """导出统计信息，百分位数基于最近的请求记录"""
+        with self._lock:
+            latencies = sorted(item['elapsed'] for item in self.recent)
+            stats = {
+                'count': self.count,
+                'errors': self.errors,
+                'avg': self.total_time / self.count if self.count else 0.0,
+                'max': self.max_time,
+                'p50': self._percentile(latencies, 50),
+                'p95': self._percentile(latencies, 95),
+                'p99': self._percentile(latencies, 99),
+            }
+            if include_recent:
+                stats['recent'] = list(self.recent)
+            return stats
+
+    def reset(self) -> None:
+        with self._lock:
+            self.count = 0
+            self.errors = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.recent.clear()
+
+class CircuitBreaker:
+    """
+    验证API的熔断器
+
+    连续失败达到阈值后进入打开状态，此后的请求直接失败；经过 reset_timeout 秒后
+    进入半开状态，只放行一个探测请求，探测成功则关闭熔断器，失败则重新打开。
+    """
+
+    def __init__(self,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.last_error: Optional[str] = None
+
+    def _current_state(self) -> str:
+        if self._state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = CIRCUIT_HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow_request(self) -> Tuple[bool, bool]:
+        """
+        是否允许发出请求，半开状态下只放行一个探测请求
+
+        返回 (是否放行, 是否占用了探测名额)，占用了名额的调用结束时要调用 release_probe()。
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CIRCUIT_CLOSED:
+                return True, False
+            if state == CIRCUIT_HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True, True
+            return False, False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CIRCUIT_CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+            self.last_error = None
+
+    def record_failure(self, error: Optional[str] = None) -> None:
+        with self._lock:
+            self._failures += 1
+            self.last_error = error
+            if self._state == CIRCUIT_HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """
+        探测请求结束但没有记录成功或失败时（例如抛出了非网络异常）释放半开状态的探测名额
+
+        只能由 allow_request() 返回占用了探测名额的调用在 finally 中调用；已记录结果时熔断器已不在半开状态，
+        调用没有影响。
+        """
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN:
+                self._probe_in_flight = False
+
+    def reset(self) -> None:
+        """手动关闭熔断器"""
+        self.record_success()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """导出熔断器状态"""
+        with self._lock:
+            state = self._current_state()
+            retry_after = 0.0
+            if state == CIRCUIT_OPEN:
+                retry_after = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+            return {
+                'state': state,
+                'failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'retry_after': retry_after,
+                'last_error': self.last_error,
+            }
+
+class NegativeCache:
+    """
+    被服务器拒绝的卡密的本地缓存
+
+    只缓存卡密不存在、已被使用、已过期这类确定的业务失败，有效期内再次验证直接返回原失败消息，
+    不再请求服务器。缓存键是API地址和卡密的SHA-256摘要，不保存卡密明文。
+    """
+
+    def __init__(self,
+                 max_entries: int = DEFAULT_NEGATIVE_CACHE_SIZE,
+                 ttls: Optional[Dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_NEGATIVE_TTLS if ttls is None else ttls)
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self.hits = 0
+
+    @staticmethod
+    def _cache_key(api_url: str, key: str) -> str:
+        return hashlib.sha256(f'{api_url}\n{key}'.encode('utf-8')).hexdigest()
+
+    def get(self, api_url: str, key: str) -> Optional[Dict[str, Any]]:
+        """返回未过期的失败结果，没有时返回None"""
+        cache_key = self._cache_key(api_url, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[cache_key]
+                return None
+            self.hits += 1
+            return dict(result, cached=True)
+
+    def put(self, api_url: str, key: str, result: Dict[str, Any]) -> bool:
+        """记录失败结果，只有 ttls 中列出的失败原因会被缓存"""
+        ttl = self.ttls.get(result.get('message', ''))
+        if not ttl or result.get('success', False):
+            return False
+        cache_key = self._cache_key(api_url, key)
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + ttl, dict(result))
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def clear(self) -> int:
+        """清空缓存，返回清除的条目数"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+def is_connect_error(error: Exception) -> bool:
+    """
+    判断异常是否发生在建立连接阶段
+
+    只有连接阶段的错误才能确定请求没有到达服务器；验证接口会把卡密标记为已使用，
+    读取超时等请求已发出的错误不能重试。
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, (_urllib3_exceptions.NewConnectionError, _urllib3_exceptions.ConnectTimeoutError))
+
+def backoff_delay(attempt: int,
+                  base: float = DEFAULT_BACKOFF_BASE,
+                  cap: float = DEFAULT_BACKOFF_MAX) -> float:
+    """第 attempt 次重试前的等待时间（指数退避，全抖动）"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class KamiTransport:
+    """共享的HTTP传输，复用TCP连接"""
+
+    def __init__(self,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.stats = TransportStats()
+        self.breaker = breaker or CircuitBreaker()
+        self.negative_cache = NegativeCache()
+
+        self.session = requests.Session()
+        adapter = _requests_adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        """requests 使用的 (连接超时, 读取超时)"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def _send(self, url: str, payload: Dict[str, Any]) -> requests.Response:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.stats.record(url, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        self.stats.record(url, time.perf_counter() - start, status=response.status_code)
+        return response
+
+    def post_json(self, url: str, payload: Dict[str, Any]) -> requests.Response:
+        """
+        发送JSON POST请求
+
+        连接阶段失败时按指数退避重试，其余网络异常原样抛出；熔断器打开时抛出 CircuitOpenError。
+        """
+        allowed, probe = self.breaker.allow_request()
+        if not allowed:
+            retry_after = self.breaker.to_dict()['retry_after']
+            raise CircuitOpenError(f'验证服务暂时不可用，请{retry_after:.0f}秒后重试')
+
+        try:
+            attempt = 0
+            while True:
+                try:
+                    response = self._send(url, payload)
+                except requests.exceptions.RequestException as e:
+                    attempt += 1
+                    if attempt >= self.max_attempts or not is_connect_error(e):
+                        self.breaker.record_failure(type(e).__name__)
+                        raise
+                    time.sleep(backoff_delay(attempt - 1))
+                    continue
+
+                if response.status_code >= 500:
+                    self.breaker.record_failure(f'HTTP {response.status_code}')
+                else:
+                    self.breaker.record_success()
+                return response
+        finally:
+            # 只有占用了探测名额的请求才释放，否则会放行第二个探测请求
+            if probe:
+                self.breaker.release_probe()
+
+    def get(self, url: str) -> requests.Response:
+        """发送GET请求，用于获取公钥等只读接口，不重试也不经过熔断器"""
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.stats.record(url, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        self.stats.record(url, time.perf_counter() - start, status=response.status_code)
+        return response
+    
+    def warm_up(self, url: str = DEFAULT_API_URL) -> bool:
+        """
+        预先解析域名并建立长连接，之后的首次验证无需再等待握手
+
+        使用 OPTIONS 请求（后端的CORS中间件会直接应答），不会触发卡密验证。
+        """
+        parts = urlsplit(url)
+        try:
+            socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+            self.session.options(url, timeout=self.timeout)
+            return True
+        except (OSError, requests.exceptions.RequestException):
+            return False
+
+    def get_stats(self, include_recent: bool = False) -> Dict[str, Any]:
+        """获取请求耗时统计"""
+        return self.stats.to_dict(include_recent)
+
+    def get_breaker_state(self) -> Dict[str, Any]:
+        """获取熔断器状态"""
+        return self.breaker.to_dict()
+
+    def close(self) -> None:
+        """关闭连接池"""
+        self.session.close()
+
+# 进程内共享的HTTP传输
+_transport: Optional[KamiTransport] = None
+_transport_lock = threading.Lock()
+
+def get_transport() -> KamiTransport:
+    """获取进程内共享的传输实例"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = KamiTransport()
+    return _transport
+
+def _b64url_decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def get_public_key_url(api_url: str) -> str:
+    """由验证API地址得到公钥接口地址，例如 .../card-keys/verify → .../card-keys/public-key"""
+    base = api_url.rstrip('/')
+    if base.endswith('/verify'):
+        base = base[:-len('/verify')]
+    return base + '/public-key'
+
+class LicenseTokenVerifier:
+    """
+    离线验证服务器签发的授权令牌
+    
+    令牌格式为 base64url(JSON载荷).base64url(Ed25519签名)，载荷包含卡密(key)、硬件ID(hwid)和到期时间(exp)。
+    只信任固定的根公钥（构造参数、LICENSE_PUBLIC_KEY 或环境变量 KAMI_LICENSE_PUBLIC_KEY）：令牌由根私钥签名，
+    或由服务器的签名密钥签名，这时签名公钥必须带有根私钥的背书（服务器公钥接口返回）。背书有效的签名公钥
+    缓存在 key_file 中，读取时重新检查背书，缓存文件被改动不会引入新的公钥。
+    
+    没有根公钥时不验证令牌（enforced 为False）。设置根公钥后本地记录必须带有有效的令牌，没有令牌的旧记录
+    只在本机还没有保存过带令牌的记录（marker_file 不存在）时按到期时间检查。
+    签名验证通过的令牌缓存在内存中，之后的检查只比较硬件ID和到期时间。
+    """
+    
+    def __init__(self,
+                 api_url: str = DEFAULT_API_URL,
+                 public_key: Optional[str] = None,
+                 key_file: Optional[str] = DEFAULT_PUBLIC_KEY_FILE,
+                 transport: Optional[Any] = None,
+                 marker_file: Optional[str] = DEFAULT_TOKEN_MARKER_FILE):
+        self.api_url = api_url
+        self.pinned_key = public_key or LICENSE_PUBLIC_KEY or os.environ.get(LICENSE_PUBLIC_KEY_ENV) or None
+        self.key_file = key_file
+        self.marker_file = marker_file
+        self.transport = transport
+        self._root_key = None
+        self._signing_keys: Dict[str, Any] = {}
+        self._cache_loaded = False
+        self._fetched_at = 0.0
+        self._verified: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @property
+    def enforced(self) -> bool:
+        """是否设置了根公钥（设置后本地记录必须带有有效的授权令牌）"""
+        return bool(self.pinned_key)
+    
+    def get_public_key(self) -> Any:
+        """获取固定的根公钥，没有设置或格式错误时返回None"""
+        with self._lock:
+            if self._root_key is None and self.pinned_key:
+                try:
+                    self._root_key = _ed25519.Ed25519PublicKey.from_public_bytes(_b64url_decode(self.pinned_key))
+                except ValueError:
+                    print("固定公钥格式错误")
+            return self._root_key
+    
+    def _endorsed_key(self, text: Any, endorsement: Any) -> Any:
+        """签名公钥带有根私钥的有效背书时返回公钥，否则返回None"""
+        root_key = self.get_public_key()
+        if root_key is None or not isinstance(text, str) or not isinstance(endorsement, str):
+            return None
+        try:
+            root_key.verify(_b64url_decode(endorsement), LICENSE_KEY_ENDORSEMENT_PREFIX + text.encode('ascii'))
+            return _ed25519.Ed25519PublicKey.from_public_bytes(_b64url_decode(text))
+        except (_crypto_exceptions.InvalidSignature, ValueError, UnicodeError):
+            return None
+    
+    def _trusted_keys(self) -> List[Any]:
+        """根公钥和背书有效的签名公钥（第一次调用时读取缓存文件）"""
+        root_key = self.get_public_key()
+        if root_key is None:
+            return []
+        with self._lock:
+            load_cache = not self._cache_loaded and self.key_file
+            self._cache_loaded = True
+        if load_cache:
+            try:
+                with open(self.key_file, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                cached = None
+            if isinstance(cached, dict):
+                key = self._endorsed_key(cached.get('publicKey'), cached.get('endorsement'))
+                if key is not None:
+                    with self._lock:
+                        self._signing_keys[cached['publicKey']] = key
+        with self._lock:
+            return [root_key] + list(self._signing_keys.values())
+    
+    def refresh_public_key(self) -> bool:
+        """
+        从服务器获取当前的签名公钥，返回是否得到了新的可信公钥
+        
+        只接受带有根私钥有效背书的公钥，不删除已有的公钥；没有根公钥时不请求，两次请求至少间隔
+        PUBLIC_KEY_RETRY_INTERVAL 秒。
+        """
+        if not self.enforced:
+            return False
+        with self._lock:
+            if self._fetched_at and time.monotonic() - self._fetched_at < PUBLIC_KEY_RETRY_INTERVAL:
+                return False
+            self._fetched_at = time.monotonic()
+        try:
+            response = (self.transport or get_transport()).get(get_public_key_url(self.api_url))
+            data = response.json().get('data', {}) if response.status_code == 200 else {}
+            text, endorsement = data.get('publicKey'), data.get('endorsement')
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            return False
+        if text == self.pinned_key or text in self._signing_keys:
+            return False
+        key = self._endorsed_key(text, endorsement)
+        if key is None:
+            print("服务器公钥没有有效的背书，已忽略")
+            return False
+        with self._lock:
+            self._signing_keys[text] = key
+        if self.key_file:
+            try:
+                atomic_write_file(self.key_file, json.dumps({'publicKey': text, 'endorsement': endorsement}).encode())
+            except OSError as e:
+                print(f"保存公钥失败: {e}")
+        return True
+    
+    def _verify_signature(self, token: str) -> Optional[Dict[str, Any]]:
+        """用可信公钥检查令牌签名，返回载荷"""
+        encoded, _, signature = token.partition('.')
+        try:
+            signature_bytes = _b64url_decode(signature)
+            message = encoded.encode('ascii')
+        except (ValueError, UnicodeError):
+            return None
+        for public_key in self._trusted_keys():
+            try:
+                public_key.verify(signature_bytes, message)
+                claims = json.loads(_b64url_decode(encoded))
+            except (_crypto_exceptions.InvalidSignature, ValueError, UnicodeError):
+                continue
+            if isinstance(claims, dict) and claims.get('v') == LICENSE_TOKEN_VERSION:
+                return claims
+            return None
+        return None
+    
+    @timed_stage('token.verify')
+    def verify(self, token: Optional[str], hardware_id: str, key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        验证令牌，签名有效、硬件ID（和卡密）一致且未到期时返回载荷，否则返回None
+        
+        签名无法用已知公钥验证时（服务器可能更换了签名密钥）获取一次新的签名公钥再试。
+        """
+        if not token or not isinstance(token, str):
+            return None
+        with self._lock:
+            claims = self._verified.get(token)
+            if claims is not None:
+                self._verified.move_to_end(token)
+        
+        if claims is None:
+            claims = self._verify_signature(token)
+            if claims is None and self.refresh_public_key():
+                claims = self._verify_signature(token)
+            if claims is None:
+                return None
+            with self._lock:
+                self._verified[token] = claims
+                while len(self._verified) > DEFAULT_TOKEN_CACHE_SIZE:
+                    self._verified.popitem(last=False)
+        
+        if claims.get('hwid') != hardware_id:
+            return None
+        if key is not None and claims.get('key') != key:
+            return None
+        exp = claims.get('exp')
+        if not isinstance(exp, (int, float)) or exp <= time.time():
+            return None
+        return dict(claims)
+    
+    def tokens_required(self) -> bool:
+        """本机是否已经保存过带有效令牌的记录，之后不再接受没有令牌的旧记录"""
+        return bool(self.marker_file) and os.path.exists(self.marker_file)
+    
+    def mark_tokens_required(self) -> None:
+        """联网验证得到有效令牌后调用，之后没有令牌的记录一律无效"""
+        if not self.enforced or not self.marker_file or os.path.exists(self.marker_file):
+            return
+        try:
+            atomic_write_file(self.marker_file, str(int(time.time())).encode())
+        except OSError as e:
+            print(f"保存令牌标记失败: {e}")
+    
+    def check_record(self, record: Dict[str, Any], hardware_id: str, key: Optional[str] = None) -> bool:
+        """
+        本地验证记录的授权令牌是否有效（到期时间由调用方另外检查）
+        
+        没有根公钥时总是返回True；设置了根公钥时记录必须带有签名、硬件ID（和卡密）一致且未到期的令牌，
+        没有令牌的旧记录只在本机还没有保存过带令牌的记录时通过。
+        """
+        if not self.enforced:
+            return True
+        token = record.get('token')
+        if token:
+            return self.verify(token, hardware_id, key) is not None
+        if self.tokens_required():
+            print("本地记录缺少授权令牌")
+            return False
+        print("本地记录缺少授权令牌，按旧版记录检查到期时间（下次联网验证后不再接受）")
+        return True
+
+def get_agent_address() -> str:
+    """授权代理的地址：Windows 为当前用户的命名管道，其他系统为临时目录中的Unix套接字"""
+    address = os.environ.get(AGENT_ADDRESS_ENV)
+    if address:
+        return address
+    if os.name == 'nt':
+        return r'\\.\pipe\kami_agent_' + os.environ.get('USERNAME', 'default')
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), f'kami_agent_{os.getuid()}.sock')
+
+class AgentError(Exception):
+    """授权代理返回错误或连接中断"""
+
+class AgentClient:
+    """
+    授权代理客户端，保持一个长连接，线程安全
+    消息为JSON，通过 multiprocessing.connection 的 send_bytes/recv_bytes 收发
+    """
+    
+    def __init__(self, address: Optional[str] = None, timeout: float = DEFAULT_AGENT_TIMEOUT):
+        self.address = address or get_agent_address()
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def connect(self) -> bool:
+        """连接代理，代理未运行时返回False"""
+        with self._lock:
+            return self._connect()
+    
+    def _connect(self) -> bool:
+        if self._conn is not None:
+            return True
+        from multiprocessing.connection import Client
+        try:
+            self._conn = Client(self.address)
+            return True
+        except (OSError, EOFError):
+            self._conn = None
+            return False
+    
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+    
+    def request(self, cmd: str, **params) -> Any:
+        """发送命令并返回结果，失败时抛出 AgentError"""
+        message = json.dumps(dict(params, cmd=cmd), ensure_ascii=False).encode('utf-8')
+        with self._lock:
+            for attempt in range(2):
+                if not self._connect():
+                    raise AgentError('无法连接授权代理')
+                try:
+                    self._conn.send_bytes(message)
+                    if not self._conn.poll(self.timeout):
+                        self._close()
+                        raise AgentError('授权代理响应超时')
+                    response = json.loads(self._conn.recv_bytes())
+                    break
+                except (OSError, EOFError):
+                    # 代理重启后旧连接失效，重连后再试一次
+                    self._close()
+                    if attempt:
+                        raise AgentError('与授权代理的连接已断开')
+        if not response.get('ok'):
+            raise AgentError(response.get('error', '授权代理返回错误'))
+        return response.get('result')
+    
+    def close(self) -> None:
+        with self._lock:
+            self._close()
 
 class Result:
     """API调用结果类"""
@@ -69,18 +1539,160 @@ class LocalVerificationResult:
     剩余天数: int = 0
     错误消息: str = ""
 
+class _WmiProbeRun:
+    """
+    一次硬件采集内共享的WMI查询
+    
+    各采集线程并行调用，第一个调用者用同一个WMI连接查完 queries 中的全部属性，
+    其余调用者等待它的结果，避免每项采集都建立一次WMI连接。
+    """
+    
+    def __init__(self, queries):
+        self.queries = tuple(queries)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = False
+        self._results: Optional[Dict[Tuple[str, str], Optional[str]]] = None
+    
+    def get(self, wmi_class: str, prop: str) -> Optional[str]:
+        if (wmi_class, prop) not in self.queries:
+            return HardwareInfo._query_wmi_all([(wmi_class, prop)]).get((wmi_class, prop))
+        
+        with self._lock:
+            leader = not self._started
+            self._started = True
+        if leader:
+            try:
+                self._results = HardwareInfo._query_wmi_all(self.queries)
+            finally:
+                self._done.set()
+        else:
+            self._done.wait()
+        return (self._results or {}).get((wmi_class, prop))
+
+
+class HardwareProbeStats:
+    """一次硬件ID获取过程的统计信息"""
+    
+    def __init__(self):
+        self.source = 'probe'  # probe：实际采集；disk：命中磁盘缓存
+        self.total_time = 0.0
+        self.durations: Dict[str, float] = {}
+        self.timed_out: List[str] = []
+    
+    @property
+    def complete(self) -> bool:
+        """所有硬件信息是否都在期限内采集完成"""
+        return not self.timed_out
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'source': self.source,
+            'total_time': self.total_time,
+            'durations': dict(self.durations),
+            'timed_out': list(self.timed_out),
+        }
+
+
 class HardwareInfo:
     """硬件信息收集工具类"""
     
+    # 进程内缓存的硬件ID，以及可选的磁盘缓存文件
+    _cached_hardware_id: Optional[str] = None
+    _cache_lock = threading.Lock()
+    cache_file: Optional[str] = DEFAULT_HARDWARE_CACHE_FILE
+    # 单项采集期限和整体时间预算（秒）
+    probe_timeout: float = DEFAULT_PROBE_TIMEOUT
+    probe_budget: float = DEFAULT_PROBE_BUDGET
+    last_probe_stats: Optional[HardwareProbeStats] = None
+    # 采集线程中记录本次采集共享的WMI查询（_WmiProbeRun）
+    _probe_local = threading.local()
+    
+    @staticmethod
+    def _read_sys_file(path: str) -> Optional[str]:
+        """读取 sysfs/procfs 文件并去掉首尾空白，文件不存在或为空时返回None"""
+        try:
+            with open(path, 'r') as f:
+                value = f.read().strip()
+            return value or None
+        except (OSError, UnicodeDecodeError):
+            return None
+    
+    @staticmethod
+    def _query_wmi_all(queries) -> Dict[Tuple[str, str], Optional[str]]:
+        """
+        用同一个WMI连接依次查询多个 (类名, 属性) 第一条记录的值
+        
+        每项返回值与 wmic 输出首行一致（去掉首尾空白）；WMI不可用、连接失败或单项查询失败时该项为None。
+        """
+        results: Dict[Tuple[str, str], Optional[str]] = {query: None for query in queries}
+        try:
+            import pythoncom
+            import wmi
+        except ImportError:
+            return results
+        
+        try:
+            pythoncom.CoInitialize()
+            try:
+                connection = wmi.WMI()
+                for wmi_class, prop in queries:
+                    try:
+                        rows = getattr(connection, wmi_class)([prop])
+                        results[(wmi_class, prop)] = str(getattr(rows[0], prop) or '').strip() if rows else ''
+                    except Exception:
+                        pass
+            finally:
+                pythoncom.CoUninitialize()
+        except Exception:
+            pass
+        return results
+    
+    @staticmethod
+    def _query_wmi(wmi_class: str, prop: str) -> Optional[str]:
+        """
+        进程内查询WMI第一条记录的属性，替代启动 wmic 子进程
+        
+        在 probe_hardware_id 中调用时与其他采集项共用一个WMI连接。
+        返回值与 wmic 输出首行一致（去掉首尾空白）；WMI不可用或查询失败时返回None。
+        """
+        wmi_run = getattr(HardwareInfo._probe_local, 'wmi_run', None)
+        if wmi_run is not None:
+            return wmi_run.get(wmi_class, prop)
+        return HardwareInfo._query_wmi_all([(wmi_class, prop)])[(wmi_class, prop)]
+    
+    @staticmethod
+    def get_machine_id() -> Optional[str]:
+        """获取系统机器ID（Linux 的 /etc/machine-id 或 Windows 的 MachineGuid），不启动子进程"""
+        if platform.system() == "Windows":
+            try:
+                import winreg
+                with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography",
+                                    0, winreg.KEY_READ | winreg.KEY_WOW64_64KEY) as reg_key:
+                    return str(winreg.QueryValueEx(reg_key, "MachineGuid")[0])
+            except Exception:
+                return None
+        
+        for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+            machine_id = HardwareInfo._read_sys_file(path)
+            if machine_id:
+                return machine_id
+        return None
+    
     @staticmethod
     def get_cpu_id() -> str:
         """获取CPU ID"""
         if platform.system() == "Windows":
-            try:
-                output = subprocess.check_output("wmic cpu get ProcessorId", shell=True).decode()
-                return output.strip().split('\n')[1].strip()
-            except:
-                pass
+            processor_id = HardwareInfo._query_wmi('Win32_Processor', 'ProcessorId')
+            if processor_id:
+                return processor_id
+            if processor_id is None:
+                try:
+                    output = subprocess.check_output("wmic cpu get ProcessorId", shell=True,
+                                                     timeout=HardwareInfo.probe_timeout).decode()
+                    return output.strip().split('\n')[1].strip()
+                except:
+                    pass
         elif platform.system() == "Linux":
             try:
                 with open('/proc/cpuinfo', 'r') as f:
@@ -91,7 +1703,8 @@ class HardwareInfo:
                 pass
         elif platform.system() == "Darwin":  # macOS
             try:
-                output = subprocess.check_output("ioreg -l | grep IOPlatformSerialNumber", shell=True).decode()
+                output = subprocess.check_output("ioreg -l | grep IOPlatformSerialNumber", shell=True,
+                                                 timeout=HardwareInfo.probe_timeout).decode()
                 return output.strip().split('=')[1].strip().replace('"', '')
             except:
                 pass
@@ -102,101 +1715,628 @@ class HardwareInfo:
     def get_disk_serial() -> str:
         """获取硬盘序列号"""
         if platform.system() == "Windows":
+            serial = HardwareInfo._query_wmi('Win32_DiskDrive', 'SerialNumber')
+            if serial is not None:
+                return serial if serial else str(uuid.getnode())
             try:
-                output = subprocess.check_output("wmic diskdrive get SerialNumber", shell=True).decode()
+                output = subprocess.check_output("wmic diskdrive get SerialNumber", shell=True,
+                                                 timeout=HardwareInfo.probe_timeout).decode()
                 serial = output.strip().split('\n')[1].strip()
                 return serial if serial and serial != "" else str(uuid.getnode())
             except:
                 pass
         elif platform.system() == "Linux":
+            # 硬件ID依赖 lsblk 的输出格式（设备顺序、列宽），不自行读取 sysfs 拼装，以免与已有验证文件不一致
             try:
-                output = subprocess.check_output("lsblk -d -o name,serial | grep -v loop", shell=True).decode()
+                output = subprocess.check_output("lsblk -d -o name,serial | grep -v loop", shell=True,
+                                                 timeout=HardwareInfo.probe_timeout).decode()
                 return output.strip().split('\n')[1].strip()
             except:
                 pass
         
+        # 如果无法获取，返回MAC地址的hash
+        return str(uuid.getnode())
+    
+    @staticmethod
+    def get_motherboard_serial() -> str:
+        """获取主板序列号"""
+        if platform.system() == "Windows":
+            serial = HardwareInfo._query_wmi('Win32_BaseBoard', 'SerialNumber')
+            if serial:
+                return serial
+            if serial is None:
+                try:
+                    output = subprocess.check_output("wmic baseboard get SerialNumber", shell=True,
+                                                     timeout=HardwareInfo.probe_timeout).decode()
+                    return output.strip().split('\n')[1].strip()
+                except:
+                    pass
+        elif platform.system() == "Linux":
+            try:
+                with open('/sys/class/dmi/id/board_serial', 'r') as f:
+                    serial = f.read().strip()
+                if serial:
+                    return serial
+                run_dmidecode = True
+            except PermissionError:
+                # 普通用户无权读取时 dmidecode 同样会失败，直接使用兜底值
+                run_dmidecode = False
+            except OSError:
+                run_dmidecode = True
+            
+            if run_dmidecode:
+                try:
+                    output = subprocess.check_output("dmidecode -s baseboard-serial-number", shell=True,
+                                                     timeout=HardwareInfo.probe_timeout).decode()
+                    return output.strip()
+                except:
+                    pass
+        
+        # 如果无法获取特定序列号，使用计算机名称和当前用户名
+        return platform.node() + os.getlogin()
+    
+    @staticmethod
+    def get_boot_key() -> str:
+        """
+        获取本次开机和本机的廉价标识（不启动子进程）
+        
+        用于判断磁盘缓存的硬件ID是否仍然可信：重启或换机后标识会变化，缓存随之失效。
+        """
+        parts = [platform.system(), platform.node()]
+        
+        boot_id = HardwareInfo._read_sys_file('/proc/sys/kernel/random/boot_id')
+        if boot_id:
+            parts.append(boot_id)
+        machine_id = HardwareInfo.get_machine_id()
+        if machine_id:
+            parts.append(machine_id)
+        
+        if platform.system() == "Windows":
+            try:
+                import ctypes
+                get_tick_count = ctypes.windll.kernel32.GetTickCount64
+                get_tick_count.restype = ctypes.c_ulonglong
+                # 开机时间精确到分钟，避免计算误差导致缓存频繁失效
+                parts.append(str(int(time.time() - get_tick_count() / 1000) // 60))
+            except Exception:
+                pass
+        
+        return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+    
+    @staticmethod
+    @timed_stage('hardware.cache_file')
+    def _load_cache_file(boot_key: str) -> Optional[str]:
+        """读取磁盘缓存的硬件ID，标识不匹配时返回None"""
+        if not HardwareInfo.cache_file or not os.path.exists(HardwareInfo.cache_file):
+            return None
+        try:
+            with open(HardwareInfo.cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('boot_key') == boot_key and cache.get('hardware_id'):
+                return cache['hardware_id']
+        except Exception:
+            pass
+        return None
+    
+    @staticmethod
+    def _save_cache_file(boot_key: str, hardware_id: str) -> None:
+        """写入磁盘缓存，失败时忽略"""
+        if not HardwareInfo.cache_file:
+            return
+        try:
+            with open(HardwareInfo.cache_file, 'w') as f:
+                json.dump({'boot_key': boot_key, 'hardware_id': hardware_id}, f)
+        except Exception:
+            pass
+    
+    @staticmethod
+    def set_cache_file(cache_file: Optional[str]) -> None:
+        """设置硬件ID磁盘缓存文件，传入None关闭磁盘缓存"""
+        with HardwareInfo._cache_lock:
+            HardwareInfo.cache_file = cache_file
+    
+    @staticmethod
+    def invalidate_cache(remove_file: bool = True) -> None:
+        """清除缓存的硬件ID，下次调用时重新采集硬件信息"""
+        with HardwareInfo._cache_lock:
+            HardwareInfo._cached_hardware_id = None
+            if remove_file and HardwareInfo.cache_file:
+                try:
+                    os.remove(HardwareInfo.cache_file)
+                except OSError:
+                    pass
+    
+    @staticmethod
+    def _fallback_cpu_id() -> str:
+        return platform.processor() + platform.machine()
+    
+    @staticmethod
+    def _fallback_disk_serial() -> str:
         return str(uuid.getnode())
     
     @staticmethod
-    def get_motherboard_serial() -> str:
-        """获取主板序列号"""
-        if platform.system() == "Windows":
-            try:
-                output = subprocess.check_output("wmic baseboard get SerialNumber", shell=True).decode()
-                return output.strip().split('\n')[1].strip()
-            except:
-                pass
-        elif platform.system() == "Linux":
-            try:
-                output = subprocess.check_output("dmidecode -s baseboard-serial-number", shell=True).decode()
-                return output.strip()
-            except:
-                pass
-        
+    def _fallback_motherboard_serial() -> str:
         return platform.node() + os.getlogin()
     
     @staticmethod
-    def generate_hardware_id() -> str:
-        """生成唯一的硬件标识符"""
-        cpu_id = HardwareInfo.get_cpu_id()
-        disk_serial = HardwareInfo.get_disk_serial()
-        motherboard_serial = HardwareInfo.get_motherboard_serial()
+    @timed_stage('hardware.probe')
+    def probe_hardware_id(probe_timeouts: Optional[Dict[str, float]] = None,
+                          total_timeout: Optional[float] = None) -> str:
+        """
+        并行采集硬件信息并计算硬件标识符（不使用缓存）
+        
+        每项采集在独立线程中运行，超过自身期限或总时间预算的项改用固定的兜底值，
+        因此结果仍是确定的；超时项记录在 last_probe_stats.timed_out 中。
+        """
+        probes = (
+            ('cpu', HardwareInfo.get_cpu_id, HardwareInfo._fallback_cpu_id),
+            ('disk', HardwareInfo.get_disk_serial, HardwareInfo._fallback_disk_serial),
+            ('motherboard', HardwareInfo.get_motherboard_serial, HardwareInfo._fallback_motherboard_serial),
+        )
+        if total_timeout is None:
+            total_timeout = HardwareInfo.probe_budget
+        
+        stats = HardwareProbeStats()
+        results: Dict[str, str] = {}
+        errors: Dict[str, BaseException] = {}
+        
+        wmi_run = _WmiProbeRun(WMI_PROBE_QUERIES)
+        
+        def run_probe(name, probe):
+            probe_start = time.perf_counter()
+            HardwareInfo._probe_local.wmi_run = wmi_run
+            try:
+                results[name] = probe()
+            except BaseException as e:
+                errors[name] = e
+            finally:
+                stats.durations.setdefault(name, time.perf_counter() - probe_start)
+                if stage_timings.enabled:
+                    stage_timings.record(f'hardware.probe.{name}', time.perf_counter() - probe_start)
+        
+        start = time.perf_counter()
+        threads = []
+        for name, probe, _ in probes:
+            # 守护线程：卡死的 wmic 不会阻止进程退出
+            thread = threading.Thread(target=run_probe, args=(name, probe), daemon=True)
+            thread.start()
+            threads.append(thread)
         
-        hardware_info = f"{cpu_id}|{disk_serial}|{motherboard_serial}"
+        values = []
+        for (name, _, fallback), thread in zip(probes, threads):
+            timeout = (probe_timeouts or {}).get(name, HardwareInfo.probe_timeout)
+            deadline = start + min(timeout, total_timeout)
+            thread.join(max(0.0, deadline - time.perf_counter()))
+            
+            if thread.is_alive():
+                stats.timed_out.append(name)
+                stats.durations[name] = time.perf_counter() - start
+                values.append(fallback())
+            elif name in errors:
+                raise errors[name]
+            else:
+                values.append(results[name])
+        
+        stats.total_time = time.perf_counter() - start
+        HardwareInfo.last_probe_stats = stats
+        if stats.timed_out:
+            print(f"硬件信息采集超时: {', '.join(stats.timed_out)}，已使用兜底值")
+        
+        hardware_info = "|".join(values)
         hardware_hash = hashlib.sha256(hardware_info.encode()).hexdigest()
         
         return hardware_hash
+    
+    @staticmethod
+    def get_probe_stats() -> Optional[HardwareProbeStats]:
+        """获取最近一次 generate_hardware_id 的统计信息"""
+        return HardwareInfo.last_probe_stats
+    
+    @staticmethod
+    def is_complete(hardware_id: str) -> bool:
+        """硬件ID是否来自完整的采集（没有超时项）；只有完整采集的结果会进入缓存"""
+        return hardware_id is not None and hardware_id == HardwareInfo._cached_hardware_id
+    
+    @staticmethod
+    def generate_hardware_id(use_cache: bool = True) -> str:
+        """
+        生成唯一的硬件标识符
+        
+        默认使用进程内缓存，其次是磁盘缓存（需设置 cache_file），都未命中时才采集硬件信息。
+        use_cache=False 时强制重新采集并刷新缓存。有超时项（使用了兜底值）的结果不缓存，
+        下次调用时重新采集，可以用 is_complete 判断返回的硬件ID是否完整。
+        """
+        if use_cache:
+            cached = HardwareInfo._cached_hardware_id
+            if cached is not None:
+                return cached
+        
+        with HardwareInfo._cache_lock:
+            if use_cache and HardwareInfo._cached_hardware_id is not None:
+                return HardwareInfo._cached_hardware_id
+            
+            start = time.perf_counter()
+            boot_key = HardwareInfo.get_boot_key() if HardwareInfo.cache_file else ''
+            hardware_id = HardwareInfo._load_cache_file(boot_key) if use_cache else None
+            if hardware_id is None:
+                hardware_id = HardwareInfo.probe_hardware_id()
+                # 有超时项的结果与真实硬件ID不同，不写入任何缓存
+                if not (HardwareInfo.last_probe_stats and HardwareInfo.last_probe_stats.complete):
+                    return hardware_id
+                HardwareInfo._save_cache_file(boot_key, hardware_id)
+            else:
+                stats = HardwareProbeStats()
+                stats.source = 'disk'
+                stats.total_time = time.perf_counter() - start
+                HardwareInfo.last_probe_stats = stats
+            
+            HardwareInfo._cached_hardware_id = hardware_id
+            return hardware_id
+
+
+class KdfParams:
+    """密钥派生参数，随验证文件的文件头一起保存"""
+    
+    SUPPORTED_ALGORITHMS = ('pbkdf2-sha256', 'scrypt')
+    
+    def __init__(self,
+                 algorithm: str = DEFAULT_KDF_ALGORITHM,
+                 salt: bytes = DEFAULT_SALT,
+                 iterations: int = DEFAULT_KDF_ITERATIONS,
+                 n: int = 2 ** 14,
+                 r: int = 8,
+                 p: int = 1):
+        if algorithm not in self.SUPPORTED_ALGORITHMS:
+            raise ValueError(f"不支持的密钥派生算法: {algorithm}")
+        self.algorithm = algorithm
+        self.salt = salt
+        self.iterations = iterations
+        self.n = n
+        self.r = r
+        self.p = p
+    
+    @timed_stage('encryption.kdf')
+    def derive(self, secret: bytes) -> bytes:
+        """派生32字节原始密钥"""
+        if self.algorithm == 'scrypt':
+            kdf = _scrypt.Scrypt(salt=self.salt, length=32, n=self.n, r=self.r, p=self.p)
+        else:
+            kdf = _pbkdf2.PBKDF2HMAC(
+                algorithm=_hashes.SHA256(),
+                length=32,
+                salt=self.salt,
+                iterations=self.iterations,
+            )
+        return kdf.derive(secret)
+    
+    def cache_key(self) -> Tuple[Any, ...]:
+        if self.algorithm == 'scrypt':
+            return (self.algorithm, self.salt, self.n, self.r, self.p)
+        return (self.algorithm, self.salt, self.iterations)
+    
+    def to_header(self) -> Dict[str, Any]:
+        """转换为文件头中的参数字段"""
+        header: Dict[str, Any] = {
+            'kdf': self.algorithm,
+            'salt': base64.b64encode(self.salt).decode(),
+        }
+        if self.algorithm == 'scrypt':
+            header.update({'n': self.n, 'r': self.r, 'p': self.p})
+        else:
+            header['iterations'] = self.iterations
+        return header
+    
+    @classmethod
+    def from_header(cls, header: Dict[str, Any]) -> 'KdfParams':
+        """从文件头恢复参数，参数超出允许范围时抛出 ValueError"""
+        params = cls(
+            algorithm=header.get('kdf', DEFAULT_KDF_ALGORITHM),
+            salt=base64.b64decode(header['salt']) if 'salt' in header else DEFAULT_SALT,
+            iterations=int(header.get('iterations', DEFAULT_KDF_ITERATIONS)),
+            n=int(header.get('n', 2 ** 14)),
+            r=int(header.get('r', 8)),
+            p=int(header.get('p', 1)),
+        )
+        if len(params.salt) > MAX_KDF_SALT_LENGTH:
+            raise ValueError(f"密钥派生盐过长: {len(params.salt)}")
+        if params.algorithm == 'scrypt':
+            if params.n not in SCRYPT_ALLOWED_N or not 1 <= params.r <= MAX_SCRYPT_R or \
+                    not 1 <= params.p <= MAX_SCRYPT_P:
+                raise ValueError(f"不支持的scrypt参数: n={params.n}, r={params.r}, p={params.p}")
+        elif not 1 <= params.iterations <= MAX_KDF_ITERATIONS:
+            raise ValueError(f"不支持的迭代次数: {params.iterations}")
+        return params
+
 
 class KamiEncryption:
     """卡密验证加密工具类"""
     
-    def __init__(self, salt: bytes = DEFAULT_SALT):
+    # 进程内共享的派生密钥缓存：(硬件ID, KDF参数) -> (密钥, Fernet实例)
+    _key_cache: "OrderedDict[Tuple[Any, ...], Tuple[bytearray, Any]]" = OrderedDict()
+    _key_cache_lock = threading.Lock()
+    key_cache_size: int = DEFAULT_KEY_CACHE_SIZE
+    
+    def __init__(self, salt: bytes = DEFAULT_SALT, iterations: int = DEFAULT_KDF_ITERATIONS,
+                 kdf: Optional[KdfParams] = None):
         self.salt = salt
+        self.iterations = iterations
+        # 保存时使用的参数；旧版无文件头的文件固定为 PBKDF2 + 默认迭代次数
+        self.kdf = kdf or KdfParams(salt=salt, iterations=iterations)
+        self.legacy_kdf = KdfParams(salt=salt, iterations=DEFAULT_KDF_ITERATIONS)
     
     def get_key_from_hardware(self) -> bytes:
         """从当前硬件生成加密密钥"""
         hardware_id = HardwareInfo.generate_hardware_id()
         return self.get_key(hardware_id)
     
-    def get_key(self, hardware_id: str) -> bytes:
-        """从硬件ID生成加密密钥"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=self.salt,
-            iterations=100000,
-        )
+    def derive_key(self, hardware_id: str, kdf: Optional[KdfParams] = None) -> bytes:
+        """从硬件ID派生加密密钥（不使用缓存）"""
+        kdf = kdf or self.kdf
         key = base64.urlsafe_b64encode(kdf.derive(hardware_id.encode()))
         return key
     
+    def _get_cached_key(self, hardware_id: str, kdf: Optional[KdfParams] = None,
+                        copy_key: bool = False) -> Tuple[Union[bytearray, bytes], Any]:
+        """
+        从缓存获取密钥和Fernet实例，未命中时派生并放入缓存
+        
+        copy_key 为True时在持有锁期间复制密钥，其他线程淘汰缓存时清零的是缓存中的那一份。
+        """
+        kdf = kdf or self.kdf
+        cache_key = (hardware_id,) + kdf.cache_key()
+        cache = KamiEncryption._key_cache
+        
+        with KamiEncryption._key_cache_lock:
+            entry = cache.get(cache_key)
+            if entry is not None:
+                cache.move_to_end(cache_key)
+                return (bytes(entry[0]), entry[1]) if copy_key else entry
+        
+        # 在锁外派生，避免阻塞其他线程读取缓存
+        key = bytearray(self.derive_key(hardware_id, kdf))
+        entry = (key, _fernet.Fernet(bytes(key)))
+        
+        with KamiEncryption._key_cache_lock:
+            existing = cache.get(cache_key)
+            if existing is not None:
+                KamiEncryption._zero_key(key)
+                entry = existing
+            else:
+                cache[cache_key] = entry
+            result = (bytes(entry[0]), entry[1]) if copy_key else entry
+            while len(cache) > max(1, KamiEncryption.key_cache_size):
+                _, (old_key, _) = cache.popitem(last=False)
+                KamiEncryption._zero_key(old_key)
+        
+        return result
+    
+    @staticmethod
+    def _zero_key(key: bytearray) -> None:
+        """覆盖密钥内容（Fernet 内部持有的副本无法擦除，只能丢弃引用）"""
+        key[:] = b'\x00' * len(key)
+    
+    @classmethod
+    def evict_key(cls, hardware_id: Optional[str] = None) -> int:
+        """从缓存移除指定硬件ID的密钥，hardware_id 为None时清空全部，返回移除数量"""
+        with cls._key_cache_lock:
+            cache_keys = [cache_key for cache_key in cls._key_cache
+                          if hardware_id is None or cache_key[0] == hardware_id]
+            for cache_key in cache_keys:
+                key, _ = cls._key_cache.pop(cache_key)
+                cls._zero_key(key)
+        return len(cache_keys)
+    
+    @classmethod
+    def clear_key_cache(cls) -> int:
+        """清空密钥缓存并清零已缓存的密钥，退出登录时调用"""
+        return cls.evict_key()
+    
+    def get_key(self, hardware_id: str) -> bytes:
+        """从硬件ID生成加密密钥，同一进程内只派生一次"""
+        return self._get_cached_key(hardware_id, copy_key=True)[0]
+    
+    def get_fernet(self, hardware_id: str, kdf: Optional[KdfParams] = None) -> Any:
+        """获取对应硬件ID的Fernet实例"""
+        return self._get_cached_key(hardware_id, kdf)[1]
+    
+    def pack(self, token: bytes) -> bytes:
+        """在密文前加上带版本号和KDF参数的文件头"""
+        header = {'version': KAMI_FILE_VERSION}
+        header.update(self.kdf.to_header())
+        header.update({'payload': 'fernet', 'encoding': 'json'})
+        return KAMI_FILE_MAGIC + json.dumps(header, separators=(',', ':')).encode() + b'\n' + token
+    
+    @staticmethod
+    def unpack(encrypted_data: bytes) -> Tuple[Optional[Dict[str, Any]], bytes]:
+        """拆分文件头和密文；旧版无文件头的文件返回 (None, 原始数据)"""
+        if not encrypted_data.startswith(KAMI_FILE_MAGIC):
+            return None, encrypted_data
+        
+        header_line, _, token = encrypted_data[len(KAMI_FILE_MAGIC):].partition(b'\n')
+        header = json.loads(header_line.decode())
+        if header.get('version') != KAMI_FILE_VERSION:
+            raise ValueError(f"不支持的验证文件版本: {header.get('version')}")
+        if header.get('payload', 'fernet') != 'fernet' or header.get('encoding', 'json') != 'json':
+            raise ValueError(f"不支持的验证文件编码: {header.get('payload')}/{header.get('encoding')}")
+        return header, token
+    
+    def needs_upgrade(self, encrypted_data: bytes) -> bool:
+        """文件是否为旧格式或使用了与当前配置不同的KDF参数"""
+        try:
+            header, _ = self.unpack(encrypted_data)
+            return header is None or KdfParams.from_header(header).cache_key() != self.kdf.cache_key()
+        except ValueError:
+            return True
+    
+    @timed_stage('encryption.encrypt')
     def encrypt_data(self, data: Dict[str, Any], hardware_id: Optional[str] = None) -> bytes:
-        """加密数据"""
-        json_data = json.dumps(data)
+        """加密数据，总是写出带文件头的新格式"""
+        with stage_timings.timing('encryption.json'):
+            json_data = json.dumps(data)
         
         if hardware_id is None:
             hardware_id = HardwareInfo.generate_hardware_id()
             
-        key = self.get_key(hardware_id)
-        fernet = Fernet(key)
-        encrypted_data = fernet.encrypt(json_data.encode())
+        fernet = self.get_fernet(hardware_id)
+        with stage_timings.timing('encryption.fernet'):
+            encrypted_data = fernet.encrypt(json_data.encode())
         
-        return encrypted_data
+        return self.pack(encrypted_data)
     
+    @timed_stage('encryption.decrypt')
     def decrypt_data(self, encrypted_data: bytes, hardware_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
-        """解密数据"""
+        """解密数据，兼容旧版无文件头的文件"""
         try:
             if hardware_id is None:
                 hardware_id = HardwareInfo.generate_hardware_id()
-                
-            key = self.get_key(hardware_id)
-            fernet = Fernet(key)
-            decrypted_data = fernet.decrypt(encrypted_data).decode()
             
-            return json.loads(decrypted_data)
+            header, token = self.unpack(encrypted_data)
+            kdf = KdfParams.from_header(header) if header else self.legacy_kdf
+            fernet = self.get_fernet(hardware_id, kdf)
+            with stage_timings.timing('encryption.fernet'):
+                decrypted_data = fernet.decrypt(token).decode()
+            
+            with stage_timings.timing('encryption.json'):
+                return json.loads(decrypted_data)
         except Exception as e:
             print(f"解密失败：{e}")
             return None
 
+
+
+class LicenseStore:
+    """
+    多卡密授权库
+    
+    每个卡密的验证记录加密后保存在SQLite中，主键为 (卡密SHA-256, 用户标识, 硬件ID)，按主键查找无需扫描；
+    库中不保存卡密明文。最近使用的解密记录缓存在内存中（LRU，最多 cache_size 条）。
+    多个进程可以同时使用同一个库文件（WAL模式）。
+    """
+    
+    def __init__(self,
+                 db_path: str = DEFAULT_LICENSE_DB,
+                 hardware_id: Optional[str] = None,
+                 encryption: Optional['KamiEncryption'] = None,
+                 cache_size: int = DEFAULT_LICENSE_CACHE_SIZE):
+        self.db_path = db_path
+        self.hardware_id = hardware_id or HardwareInfo.generate_hardware_id()
+        self.encryption = encryption or KamiEncryption()
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[Tuple[str, str], Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = _sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS licenses ('
+            ' key_hash TEXT NOT NULL,'
+            ' user_identifier TEXT NOT NULL,'
+            ' hardware_id TEXT NOT NULL,'
+            ' expires_at INTEGER,'
+            ' updated_at INTEGER NOT NULL,'
+            ' record BLOB NOT NULL,'
+            ' PRIMARY KEY (key_hash, user_identifier, hardware_id)'
+            ') WITHOUT ROWID'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS licenses_expires_at ON licenses (expires_at)')
+        self._conn.commit()
+    
+    @staticmethod
+    def key_hash(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+    
+    def _cache_put(self, cache_key: Tuple[str, str], record: Dict[str, Any]) -> None:
+        self._cache[cache_key] = copy.deepcopy(record)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    @timed_stage('license_store.put')
+    def put(self, key: str, record: Dict[str, Any], user_identifier: str = '') -> bool:
+        """加密保存一条验证记录，同一卡密和用户标识的旧记录被替换"""
+        try:
+            encrypted = self.encryption.encrypt_data(record, self.hardware_id)
+        except Exception as e:
+            print(f"加密授权记录失败: {e}")
+            return False
+        expires_at = get_record_expires_at(record)
+        cache_key = (self.key_hash(key), user_identifier)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO licenses VALUES (?, ?, ?, ?, ?, ?)',
+                (cache_key[0], user_identifier, self.hardware_id,
+                 int(expires_at) if expires_at is not None else None, int(time.time()), encrypted)
+            )
+            self._conn.commit()
+            self._cache_put(cache_key, record)
+        return True
+    
+    @timed_stage('license_store.get')
+    def get(self, key: str, user_identifier: str = '') -> Optional[Dict[str, Any]]:
+        """按卡密和用户标识查找未过期的记录，没有时返回None；没有过期时间的记录与本地验证一样视为无效"""
+        cache_key = (self.key_hash(key), user_identifier)
+        with self._lock:
+            record = self._cache.get(cache_key)
+            if record is not None:
+                self._cache.move_to_end(cache_key)
+            else:
+                row = self._conn.execute(
+                    'SELECT record FROM licenses WHERE key_hash = ? AND user_identifier = ? AND hardware_id = ?',
+                    (cache_key[0], user_identifier, self.hardware_id)
+                ).fetchone()
+                if row is None:
+                    return None
+                record = self.encryption.decrypt_data(row[0], self.hardware_id)
+                if record is None:
+                    return None
+                self._cache_put(cache_key, record)
+        expires_at = get_record_expires_at(record)
+        if expires_at is None or expires_at <= time.time():
+            return None
+        return copy.deepcopy(record)
+    
+    def delete(self, key: str, user_identifier: str = '') -> bool:
+        """删除一条记录，例如卡密被服务器撤销时"""
+        cache_key = (self.key_hash(key), user_identifier)
+        with self._lock:
+            self._cache.pop(cache_key, None)
+            cursor = self._conn.execute(
+                'DELETE FROM licenses WHERE key_hash = ? AND user_identifier = ? AND hardware_id = ?',
+                (cache_key[0], user_identifier, self.hardware_id)
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+    
+    def list(self) -> List[Dict[str, Any]]:
+        """列出本机的记录（不解密），包括卡密摘要、用户标识和过期时间"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key_hash, user_identifier, expires_at, updated_at FROM licenses'
+                ' WHERE hardware_id = ? ORDER BY updated_at DESC', (self.hardware_id,)
+            ).fetchall()
+        return [{'key_hash': key_hash, 'user_identifier': user_identifier,
+                 'expires_at': expires_at, 'updated_at': updated_at}
+                for key_hash, user_identifier, expires_at, updated_at in rows]
+    
+    def purge_expired(self) -> int:
+        """删除已过期或没有过期时间的记录，返回删除的条数"""
+        now = int(time.time())
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM licenses WHERE expires_at IS NULL OR expires_at <= ?', (now,))
+            self._conn.commit()
+            self._cache.clear()
+        return cursor.rowcount
+    
+    def compact(self) -> int:
+        """删除已过期的记录并整理数据库文件，返回删除的条数"""
+        removed = self.purge_expired()
+        with self._lock:
+            self._conn.execute('VACUUM')
+        return removed
+    
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
 class KamiLoginResult:
     """卡密登录结果类"""
     错误编码: int = -999
@@ -237,42 +2377,269 @@ class KamiSDK(Singleton):
             return
         
         self._initialized = True
-        self.__hardware_id = HardwareInfo.generate_hardware_id()
+        # 硬件ID在第一次在本进程内读写验证文件时才采集，使用授权代理时不需要
+        self.__hardware_id_value = None
+        self.__hardware_id_complete = False
         self.__api_url = DEFAULT_API_URL
         self.__verification_file = DEFAULT_VERIFICATION_FILE
+        # 原子写入验证文件，连续保存合并为一次写入，并保留最后一次完好的备份
+        self.__writer = get_file_writer(self.__verification_file)
+        # 上次写入的 (卡密, 到期时间, 令牌)，只有这些都不变的保存才允许合并推迟
+        self.__saved_identity = None
         self.__encryption = KamiEncryption()
+        self.__token_verifier = None
+        self.__license_store = None
+        # 多卡密模式下每次验证成功都记入授权库；关闭时只在第一次切换卡密后才创建授权库
+        self.__multi_license = False
         
         # 登录状态
         self.__is_login = False
         self.__current_login_key = ""
+        self.__current_user_identifier = ""
         self.__login_data = None
         self.__heartbeat_thread = None
         self.__is_stop_heartbeat = False
         self.__heartbeat_callback = None
+        self.__heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
+        self.__heartbeat_event = threading.Event()  # 用于提前唤醒心跳线程
+        self.__next_heartbeat_time = None
+        
+        # 后台复验（stale-while-revalidate）：本地记录有效时立即登录，由心跳线程在后台向服务器复验
+        self.__revalidate_enabled = False
+        self.__stale_after = DEFAULT_STALE_AFTER
+        self.__offline_grace = DEFAULT_OFFLINE_GRACE
+        
+        # 验证数据内存缓存，文件的 (mtime, size, inode) 未变化时不重新读取解密
+        self.__cached_file_stat = None
+        self.__cached_record = None
+        self.__cache_hits = 0
+        self.__cache_misses = 0
+        
+        # 验证文件变更监控（可选）：其他流程修改或清理验证文件后立即丢弃内存中的记录并唤醒心跳
+        self.__watcher = None
+        self.__watch_invalidations = 0
+        
+        # 本地授权代理：运行时由代理保存验证状态并访问服务器，未运行时在本进程内验证
+        self.__agent_enabled = True
+        self.__agent = None
+        self.__agent_checked_at = 0.0
+        self.__agent_lock = threading.Lock()
         
         # 线程锁
         self.__login_lock = threading.Lock()
         self.__heartbeat_lock = threading.Lock()
+        self.__cache_lock = threading.RLock()
+        
+        print("卡密SDK初始化完成")
+    
+    @property
+    def __hardware_id(self) -> str:
+        if self.__hardware_id_value is None:
+            self.__refresh_hardware_id()
+        return self.__hardware_id_value
+    
+    def __refresh_hardware_id(self) -> bool:
+        """采集硬件ID；上次采集有超时项（使用了兜底值）时重新采集，返回硬件ID是否完整"""
+        if self.__hardware_id_value is None or not self.__hardware_id_complete:
+            hardware_id = HardwareInfo.generate_hardware_id()
+            self.__hardware_id_complete = HardwareInfo.is_complete(hardware_id)
+            if hardware_id != self.__hardware_id_value:
+                self.__hardware_id_value = hardware_id
+                print(f"硬件ID: {hardware_id[:8]}...")
+        return self.__hardware_id_complete
+    
+    def __can_overwrite_verification_file(self) -> bool:
+        """
+        硬件ID不完整时，只有现有验证文件不存在或能用当前硬件ID解密才允许覆盖或删除
+        
+        兜底值算出的密钥解不开用真实硬件ID加密的文件，覆盖或删除会丢失仍然有效的验证信息。
+        """
+        if self.__refresh_hardware_id():
+            return True
+        encrypted_data = self.__writer.read()
+        return encrypted_data is None or \
+            self.__encryption.decrypt_data(encrypted_data, self.__hardware_id) is not None
+    
+    def __get_agent(self) -> Optional[AgentClient]:
+        """获取已连接的授权代理，代理未运行或已禁用时返回None；连接失败后一段时间内不再尝试"""
+        if not self.__agent_enabled:
+            return None
+        with self.__agent_lock:
+            if self.__agent is not None:
+                return self.__agent
+            now = time.monotonic()
+            if self.__agent_checked_at and now - self.__agent_checked_at < DEFAULT_AGENT_RETRY_INTERVAL:
+                return None
+            self.__agent_checked_at = now
+            agent = AgentClient()
+            if agent.connect():
+                if self.__agent_matches(agent):
+                    self.__agent = agent
+                    print(f"已连接授权代理: {agent.address}")
+                else:
+                    agent.close()
+            return self.__agent
+    
+    def __agent_matches(self, agent: AgentClient) -> bool:
+        """代理管理的验证文件和验证API与本流程相同时才使用代理，否则会读写另一份验证状态"""
+        try:
+            info = agent.request('hello')
+        except AgentError as e:
+            print(f"授权代理版本过旧，不使用代理: {e}")
+            return False
+        agent_file = info.get('verification_file') or ''
+        same_file = os.path.normcase(os.path.abspath(agent_file)) == os.path.normcase(self.__writer.path)
+        if not same_file or info.get('api_url') != self.__api_url:
+            print(f"授权代理使用的验证文件或验证地址与本流程不同（{agent_file}），不使用代理")
+            return False
+        return True
+    
+    def __drop_agent(self, error: Exception) -> None:
+        """代理不可用时断开，之后改为在本进程内验证"""
+        print(f"授权代理不可用，改为本地验证: {error}")
+        with self.__agent_lock:
+            if self.__agent is not None:
+                self.__agent.close()
+            self.__agent = None
+            self.__agent_checked_at = time.monotonic()
+    
+    def 设置授权代理(self, enabled: bool = True) -> None:
+        """设置是否使用本地授权代理（默认使用），关闭后总是在本进程内验证"""
+        self.__agent_enabled = enabled
+        with self.__agent_lock:
+            if self.__agent is not None:
+                self.__agent.close()
+            self.__agent = None
+            self.__agent_checked_at = 0.0
+    
+    def __get_token_verifier(self) -> LicenseTokenVerifier:
+        """授权令牌验证器，签名公钥缓存和令牌标记文件在验证文件旁边"""
+        if self.__token_verifier is None:
+            base_dir = os.path.dirname(os.path.abspath(self.__verification_file))
+            self.__token_verifier = LicenseTokenVerifier(
+                self.__api_url, key_file=os.path.join(base_dir, DEFAULT_PUBLIC_KEY_FILE),
+                marker_file=os.path.join(base_dir, DEFAULT_TOKEN_MARKER_FILE))
+        return self.__token_verifier
+    
+    def __get_license_store(self, create: bool = False) -> Optional[LicenseStore]:
+        """多卡密授权库，保存在验证文件旁边；库文件不存在且未开启多卡密模式时，只有 create 为True才创建"""
+        if self.__license_store is None:
+            db_path = os.path.join(os.path.dirname(os.path.abspath(self.__verification_file)), DEFAULT_LICENSE_DB)
+            if not (create or self.__multi_license or os.path.exists(db_path)):
+                return None
+            self.__license_store = LicenseStore(db_path, self.__hardware_id, self.__encryption)
+            # 过期的记录不能再切换，打开时清理；流程退出时关闭数据库连接
+            self.__license_store.purge_expired()
+            atexit.register(self.__license_store.close)
+        return self.__license_store
+    
+    def 设置多卡密模式(self, enabled: bool = True) -> None:
+        """开启后每次验证成功都记入授权库；默认关闭，第一次换用其他卡密时才创建授权库"""
+        self.__multi_license = enabled
+    
+    @timed_stage('sdk.activate_license')
+    def __activate_license(self, card_key: str, user_identifier: str) -> Optional[Dict[str, Any]]:
+        """
+        从授权库中切换到之前验证过的卡密，记录有效时保存为当前验证信息并返回，不访问网络
+        
+        还没有授权库时，第一次换用其他卡密会创建授权库并记入当前卡密，之后可以离线切换回来。
+        """
+        agent = self.__get_agent()
+        if agent is not None:
+            try:
+                record = agent.request('activate', key=card_key, user_identifier=user_identifier)
+                if record:
+                    record.setdefault('verified_key', record.get('data', {}).get('key', ''))
+                return record
+            except AgentError as e:
+                self.__drop_agent(e)
         
-        print(f"卡密SDK初始化完成，硬件ID: {self.__hardware_id[:8]}...")
+        try:
+            store = self.__get_license_store()
+            if store is None:
+                is_valid, current = self.__is_verified()
+                current_key = current.get('verified_key') if is_valid and current else None
+                # 按当前记录验证时的用户标识记入，之后用那个标识切换回来；旧记录没有保存用户标识，不记入
+                if current_key and current_key != card_key and 'user_identifier' in current:
+                    self.__get_license_store(create=True).put(current_key, current, current['user_identifier'])
+                return None
+            record = store.get(card_key, user_identifier)
+        except Exception as e:
+            print(f"读取授权库失败: {e}")
+            return None
+        if record is None:
+            return None
+        # 与本地验证相同：设置了根公钥时记录必须带有效的授权令牌
+        if not self.__get_token_verifier().check_record(record, self.__hardware_id, card_key):
+            return None
+        self.__save_verification_data(record, self.__get_validated_at(record), user_identifier, sync=True)
+        return record
+    
+    def 获取授权列表(self) -> List[Dict[str, Any]]:
+        """列出授权库中本机的记录（卡密只显示摘要）"""
+        store = self.__get_license_store()
+        return store.list() if store is not None else []
+    
+    def 清理过期授权(self) -> int:
+        """删除授权库中已过期的记录并整理文件，返回删除的条数"""
+        store = self.__get_license_store()
+        return store.compact() if store is not None else 0
     
-    def __verify_card_key_api(self, key: str, user_identifier: str = '') -> Dict[str, Any]:
-        """调用API验证卡密"""
+    def __verify_token(self, token: Optional[str]) -> Optional[Dict[str, Any]]:
+        """验证授权令牌的签名、硬件ID和到期时间，有效时返回载荷"""
+        return self.__get_token_verifier().verify(token, self.__hardware_id)
+    
+    def 授权代理是否可用(self) -> bool:
+        """本地授权代理正在运行且已连接时返回True"""
+        return self.__get_agent() is not None
+    
+    @timed_stage('sdk.http')
+    def __verify_card_key_api(self, key: str, user_identifier: str = '',
+                              use_negative_cache: bool = True) -> Dict[str, Any]:
+        """
+        调用API验证卡密，use_negative_cache 为True时被拒绝过的卡密直接返回缓存的失败结果
+        通过授权代理验证时，成功的结果已由代理保存，带有 saved=True
+        """
+        agent = self.__get_agent()
+        if agent is not None:
+            try:
+                return agent.request('verify', key=key, user_identifier=user_identifier,
+                                     use_negative_cache=use_negative_cache)
+            except AgentError as e:
+                self.__drop_agent(e)
+        
+        negative_cache = get_transport().negative_cache
+        if use_negative_cache:
+            cached = negative_cache.get(self.__api_url, key)
+            if cached is not None:
+                return cached
+        
         try:
-            response = requests.post(
+            # 服务器按硬件ID绑定设备并写入授权令牌，上次采集超时时先重新采集
+            self.__refresh_hardware_id()
+            response = get_transport().post_json(
                 self.__api_url,
-                json={'key': key, 'userIdentifier': user_identifier},
-                timeout=10
+                {'key': key, 'userIdentifier': user_identifier, 'hardwareId': self.__hardware_id}
             )
             
             if response.status_code == 200:
                 return response.json()
             else:
-                return {
+                # 卡密不存在、已被使用、已过期等业务错误由服务器在响应体中说明
+                try:
+                    message = response.json().get('message')
+                except (ValueError, AttributeError):
+                    message = None
+                result = {
                     'success': False, 
-                    'message': f'API错误: HTTP {response.status_code}'
+                    'message': message or f'API错误: HTTP {response.status_code}',
+                    'status_code': response.status_code
                 }
+                negative_cache.put(self.__api_url, key, result)
+                return result
                 
+        except CircuitOpenError as e:
+            return {'success': False, 'message': str(e), 'circuit_open': True}
         except requests.exceptions.Timeout:
             return {'success': False, 'message': '连接超时，请检查网络'}
         except requests.exceptions.ConnectionError:
@@ -282,23 +2649,77 @@ class KamiSDK(Singleton):
         except Exception as e:
             return {'success': False, 'message': f'未知错误: {str(e)}'}
     
-    def __save_verification_data(self, data: Dict[str, Any]) -> bool:
-        """保存验证数据到本地"""
+    @timed_stage('sdk.save')
+    def __save_verification_data(self, data: Dict[str, Any], validated_at: Optional[float] = None,
+                                 user_identifier: Optional[str] = None, sync: bool = False) -> bool:
+        """
+        保存验证数据到本地，同时记入多卡密授权库，写入失败时返回False
+        validated_at 为服务器最后一次确认卡密有效的时间戳，默认为当前时间
+        user_identifier 默认为当前登录的用户标识
+        sync 为True时立即落盘（联网验证或切换卡密后）；卡密、到期时间或令牌有变化时同样立即落盘，
+        只有这些都不变的保存（例如复验只刷新时间）才可能在合并窗口内推迟
+        """
+        if user_identifier is None:
+            user_identifier = self.__current_user_identifier
+        agent = self.__get_agent()
+        if agent is not None:
+            try:
+                return agent.request('save', result=dict(
+                    data, validated_at=int(validated_at if validated_at is not None else time.time())
+                ), user_identifier=user_identifier, sync=sync)
+            except AgentError as e:
+                self.__drop_agent(e)
+        
         try:
             # 添加硬件ID和保存时间
             save_data = {
                 'hardware_id': self.__hardware_id,
                 'save_time': datetime.datetime.now().isoformat(),
+                'validated_at': int(validated_at if validated_at is not None else time.time()),
                 'data': data.get('data', {}),
                 'success': data.get('success', False),
                 'message': data.get('message', ''),
-                'verified_key': data.get('data', {}).get('key', '')  # 保存验证过的卡密
+                'verified_key': data.get('data', {}).get('key', ''),  # 保存验证过的卡密
+                # 验证时的用户标识，第一次切换卡密时按它把当前记录记入授权库
+                'user_identifier': user_identifier
             }
+            # 保存时把过期时间换算为时间戳，之后只需整数比较
+            expires_at = parse_expiry_time(save_data['data'].get('expiryTime'))
+            if data.get('token'):
+                # 服务器签发了授权令牌时以令牌中签名的到期时间为准
+                save_data['token'] = data['token']
+                claims = self.__verify_token(data['token'])
+                if claims is not None:
+                    expires_at = claims['exp']
+                    # 之后不再接受没有令牌的旧记录
+                    self.__get_token_verifier().mark_tokens_required()
+            if expires_at is not None:
+                save_data['expires_at'] = int(expires_at)
             
-            encrypted_data = self.__encryption.encrypt_data(save_data)
+            if not self.__can_overwrite_verification_file():
+                print("硬件信息采集不完整，无法解密现有验证文件，不覆盖")
+                return False
+            save_data['hardware_id'] = self.__hardware_id
             
-            with open(self.__verification_file, 'wb') as f:
-                f.write(encrypted_data)
+            encrypted_data = self.__encryption.encrypt_data(save_data, self.__hardware_id)
+            
+            # 刚写入的数据直接放入内存缓存，下次加载无需解密（写入被合并推迟时也以这份为准）；
+            # 写入和更新缓存之间持有锁，文件监控不会把本流程的写入当作其他流程的修改
+            # 写入失败时抛出 OSError，保存失败、内存缓存不变
+            identity = (save_data['verified_key'], save_data.get('expires_at'), save_data.get('token'))
+            with self.__cache_lock:
+                self.__writer.write(encrypted_data, sync=sync or identity != self.__saved_identity)
+                self.__update_verification_cache(self.__stat_verification_file(), save_data)
+            self.__saved_identity = identity
+            
+            # 记入多卡密授权库（已创建或开启了多卡密模式时），之后切换回这个卡密无需联网
+            if save_data['verified_key']:
+                try:
+                    store = self.__get_license_store()
+                    if store is not None:
+                        store.put(save_data['verified_key'], save_data, user_identifier)
+                except Exception as e:
+                    print(f"保存到授权库失败: {e}")
             
             print(f"验证数据已保存，卡密: {save_data['verified_key']}")
             return True
@@ -306,75 +2727,130 @@ class KamiSDK(Singleton):
             print(f"保存验证数据失败: {e}")
             return False
     
+    def __stat_verification_file(self) -> Optional[Tuple[int, int, int]]:
+        """获取验证文件的 (mtime, size, inode)，文件不存在时返回None"""
+        try:
+            st = os.stat(self.__writer.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    
+    def __update_verification_cache(self, file_stat: Optional[Tuple[int, int, int]],
+                                    record: Optional[Dict[str, Any]]) -> None:
+        """更新内存中的验证记录"""
+        with self.__cache_lock:
+            self.__cached_file_stat = file_stat if record is not None else None
+            self.__cached_record = copy.deepcopy(record) if record is not None else None
+    
+    def __read_verification_record(self, file_stat: Optional[Tuple[int, int, int]]) -> Optional[Dict[str, Any]]:
+        """读取并解密验证文件；文件未变化或有尚未落盘的写入时直接返回内存中的记录副本"""
+        with self.__cache_lock:
+            if self.__cached_record is not None and (
+                    self.__cached_file_stat == file_stat or self.__writer.pending() is not None):
+                self.__cache_hits += 1
+                return copy.deepcopy(self.__cached_record)
+            self.__cache_misses += 1
+        
+        # 持有共享锁读取，其他流程正在替换文件时等待
+        encrypted_data = self.__writer.read()
+        if encrypted_data is None:
+            return None
+        
+        record = self.__encryption.decrypt_data(encrypted_data, self.__hardware_id)
+        if record is None and not self.__hardware_id_complete and self.__refresh_hardware_id():
+            # 上次采集超时，重新采集到完整的硬件ID后再试一次
+            record = self.__encryption.decrypt_data(encrypted_data, self.__hardware_id)
+        if record is None and self.__hardware_id_complete:
+            # 文件损坏或写入时中断：使用最后一次完好的副本并恢复文件（硬件ID不完整时解不开，不做恢复）
+            backup_data = self.__writer.read_backup()
+            if backup_data is not None and backup_data != encrypted_data:
+                record = self.__encryption.decrypt_data(backup_data, self.__hardware_id)
+                if record is not None:
+                    print("验证文件损坏，已从备份恢复")
+                    try:
+                        if self.__writer.restore_backup():
+                            file_stat = self.__stat_verification_file()
+                    except OSError as e:
+                        # 备份内容可用，只是暂时无法改写验证文件，下次读取时再恢复
+                        print(f"恢复验证文件失败: {e}")
+        if record and 'expires_at' not in record:
+            # 旧文件没有时间戳，只在解密时解析一次
+            expires_at = get_record_expires_at(record)
+            if expires_at is not None:
+                record['expires_at'] = int(expires_at)
+        self.__update_verification_cache(file_stat, record)
+        return record
+    
+    def 获取文件锁统计(self) -> Dict[str, Any]:
+        """获取验证文件锁的加锁次数、等待次数、超时次数和累计等待时间"""
+        return self.__writer.lock.get_stats()
+    
+    def 获取缓存统计(self) -> Dict[str, int]:
+        """获取验证数据内存缓存的命中/未命中次数"""
+        with self.__cache_lock:
+            return {'hits': self.__cache_hits, 'misses': self.__cache_misses,
+                    'invalidations': self.__watch_invalidations}
+    
+    def 设置文件监控(self, enabled: bool = True) -> Optional[str]:
+        """
+        设置是否监控验证文件（默认不监控），返回使用的监控方式：inotify、windows 或 polling
+        
+        监控时其他流程重新验证、切换卡密或清理验证文件后，本流程几毫秒内丢弃内存中的记录，
+        已登录时立即进行一次心跳检测，不必等到下一个心跳周期。
+        """
+        if self.__watcher is not None:
+            self.__watcher.stop()
+            self.__watcher = None
+        if enabled:
+            self.__watcher = FileWatcher(self.__writer.path, self.__on_verification_file_changed).start()
+            return self.__watcher.backend
+        return None
+    
+    def __on_verification_file_changed(self, path: str) -> None:
+        """验证文件变化（监控线程中调用）"""
+        file_stat = self.__stat_verification_file()
+        with self.__cache_lock:
+            if self.__cached_record is not None and self.__cached_file_stat == file_stat:
+                # 本流程刚写入的内容，内存中已是最新记录
+                return
+            self.__cached_file_stat = None
+            self.__cached_record = None
+            self.__watch_invalidations += 1
+        if self.__is_login:
+            self.__heartbeat_event.set()
+    
+    @timed_stage('sdk.load')
     def __load_verification_data(self) -> Optional[Dict[str, Any]]:
-        """加载本地验证数据"""
+        """加载本地验证数据；其他流程长时间持有文件锁时抛出 FileLockTimeout（暂时无法读取，不删除文件）"""
         try:
-            if os.path.exists(self.__verification_file):
-                with open(self.__verification_file, 'rb') as f:
-                    encrypted_data = f.read()
-                
-                decrypted_data = self.__encryption.decrypt_data(encrypted_data)
+            file_stat = self.__stat_verification_file()
+            if file_stat is not None or self.__writer.pending() is not None:
+                decrypted_data = self.__read_verification_record(file_stat)
                 if decrypted_data:
                     # 检查硬件ID是否匹配
                     if decrypted_data.get('hardware_id') == self.__hardware_id:
-                        # 检查是否过期
-                        expiry_time = decrypted_data.get('data', {}).get('expiryTime')
-                        if expiry_time:
-                            try:
-                                # 尝试多种日期格式解析
-                                expiry = None
-                                
-                                # 格式1: ISO格式 (2023-12-31T23:59:59)
-                                try:
-                                    expiry = datetime.datetime.fromisoformat(expiry_time)
-                                except ValueError:
-                                    pass
-                                
-                                # 格式2: 带Z的UTC格式 (2023-12-31T23:59:59Z)
-                                if expiry is None:
-                                    try:
-                                        if expiry_time.endswith('Z'):
-                                            expiry_time_clean = expiry_time[:-1]
-                                            expiry = datetime.datetime.fromisoformat(expiry_time_clean)
-                                        else:
-                                            expiry = datetime.datetime.fromisoformat(expiry_time)
-                                    except ValueError:
-                                        pass
-                                
-                                # 格式3: 标准格式 (2023-12-31 23:59:59)
-                                if expiry is None:
-                                    try:
-                                        expiry = datetime.datetime.strptime(expiry_time, '%Y-%m-%d %H:%M:%S')
-                                    except ValueError:
-                                        pass
-                                
-                                # 格式4: 日期格式 (2023-12-31)
-                                if expiry is None:
-                                    try:
-                                        expiry = datetime.datetime.strptime(expiry_time[:10], '%Y-%m-%d')
-                                    except ValueError:
-                                        pass
-                                
-                                # 如果所有格式都失败，记录错误但不阻止程序运行
-                                if expiry is None:
-                                    print(f"警告: 无法解析过期时间格式: {expiry_time}")
-                                    # 假设已过期，要求重新验证
-                                    return None
-                                
-                                # 检查是否过期
-                                if datetime.datetime.now() < expiry:
-                                    verified_key = decrypted_data.get('verified_key', '')
-                                    print(f"本地验证有效，过期时间: {expiry}, 验证过的卡密: {verified_key}")
-                                    return decrypted_data
-                                else:
-                                    print(f"本地验证已过期: {expiry}")
-                                    return None
-                                    
-                            except Exception as date_error:
-                                print(f"日期解析错误: {date_error}")
-                                return None
+                        # 设置了根公钥时离线验证授权令牌的签名、硬件ID和到期时间，缺少令牌或令牌无效时验证失败
+                        if not self.__get_token_verifier().check_record(decrypted_data, self.__hardware_id):
+                            print("授权令牌无效或已过期")
+                            return None
+                        # 检查是否过期（保存时已记录 expires_at 时间戳，旧文件在读取时换算）
+                        expires_at = get_record_expires_at(decrypted_data)
+                        if expires_at is None:
+                            expiry_time = decrypted_data.get('data', {}).get('expiryTime')
+                            if expiry_time:
+                                # 无法解析时假设已过期，要求重新验证
+                                print(f"警告: 无法解析过期时间格式: {expiry_time}")
+                            else:
+                                print("警告: 验证数据中没有过期时间信息")
+                            return None
+                        
+                        expiry = datetime.datetime.fromtimestamp(expires_at)
+                        if time.time() < expires_at:
+                            verified_key = decrypted_data.get('verified_key', '')
+                            print(f"本地验证有效，过期时间: {expiry}, 验证过的卡密: {verified_key}")
+                            return decrypted_data
                         else:
-                            print("警告: 验证数据中没有过期时间信息")
+                            print(f"本地验证已过期: {expiry}")
                             return None
                     else:
                         print("硬件ID不匹配，本地验证无效")
@@ -385,41 +2861,147 @@ class KamiSDK(Singleton):
             else:
                 print("验证文件不存在")
                 return None
-                
+        
+        except FileLockTimeout:
+            raise
         except Exception as e:
             print(f"加载验证数据失败: {e}")
-            # 如果是文件损坏，尝试删除损坏的文件
+            # 如果是文件损坏（备份也无法使用），尝试删除损坏的文件；硬件ID不完整时无法判断是否损坏，保留文件
             try:
-                if os.path.exists(self.__verification_file):
-                    os.remove(self.__verification_file)
+                if os.path.exists(self.__writer.path) and self.__refresh_hardware_id():
+                    self.__writer.remove(backup=False)
+                    self.__update_verification_cache(None, None)
                     print("已删除损坏的验证文件")
             except:
                 pass
             return None
     
+    @timed_stage('sdk.is_verified')
     def __is_verified(self) -> Tuple[bool, Optional[Dict[str, Any]]]:
-        """检查是否已验证"""
+        """检查是否已验证，授权代理运行时直接查询代理内存中的状态；验证文件暂时无法读取时抛出 FileLockTimeout"""
+        agent = self.__get_agent()
+        if agent is not None:
+            try:
+                status = agent.request('status')
+                record = status.get('record')
+                if status.get('verified') and record and record.get('success', False):
+                    # 代理保存的记录没有 verified_key，卡密在 data.key 中
+                    record.setdefault('verified_key', record.get('data', {}).get('key', ''))
+                    return True, record
+                return False, None
+            except AgentError as e:
+                self.__drop_agent(e)
+        
         data = self.__load_verification_data()
         if data and data.get('success', False):
             return True, data
         return False, None
     
+    @staticmethod
+    def __get_validated_at(record: Dict[str, Any]) -> float:
+        """服务器最后一次确认卡密有效的时间戳，旧文件使用保存时间（授权代理的记录为 verified_at）"""
+        validated_at = record.get('validated_at')
+        if isinstance(validated_at, (int, float)):
+            return float(validated_at)
+        return parse_expiry_time(record.get('save_time') or record.get('verified_at')) or 0.0
+    
+    @timed_stage('sdk.revalidate')
+    def __revalidate(self, data: Dict[str, Any]) -> Optional[KamiHeartbeatFailure]:
+        """
+        向服务器复验本地记录，卡密被撤销或离线超过宽限期时返回心跳失败信息
+        
+        验证接口对已激活且未过期的卡密返回"卡密已被使用"，视为仍然有效。
+        """
+        card_key = data.get('verified_key') or self.__current_login_key
+        # 复验需要服务器的最新状态，不使用失败缓存
+        api_result = self.__verify_card_key_api(card_key, self.__current_user_identifier, use_negative_cache=False)
+        status_code = api_result.get('status_code')
+        message = api_result.get('message', '')
+        
+        if api_result.get('success', False) or (status_code == 400 and message == '卡密已被使用'):
+            if api_result.get('saved'):
+                # 授权代理已保存了服务器返回的结果
+                pass
+            elif api_result.get('success', False) and api_result.get('data'):
+                api_result['data']['key'] = card_key
+                self.__save_verification_data(api_result, sync=True)
+            else:
+                self.__save_verification_data({'success': True, 'data': data.get('data', {}),
+                                               'token': data.get('token')})
+            print("后台复验通过")
+            return None
+        
+        failure = KamiHeartbeatFailure()
+        if status_code == 400 and message == '卡密已过期':
+            failure.错误编码 = 6003  # 卡密到期
+            failure.错误消息 = "卡密已过期"
+        elif status_code == 404:
+            failure.错误编码 = 6005  # 卡密被禁用
+            failure.错误消息 = message or "卡密不存在"
+        else:
+            # 网络不可用或服务器异常，在离线宽限期内继续使用本地记录
+            offline_until = self.__get_validated_at(data) + self.__offline_grace
+            if time.time() < offline_until:
+                print(f"后台复验失败，离线宽限期内继续使用: {message}")
+                return None
+            failure.错误编码 = 6006  # 离线超过宽限期
+            failure.错误消息 = f"长时间无法连接验证服务器: {message}"
+            return failure
+        
+        # 卡密已被服务器撤销，删除本地记录和授权库中的记录
+        agent = self.__get_agent()
+        if agent is not None:
+            try:
+                agent.request('clear', key=card_key, user_identifier=self.__current_user_identifier)
+                return failure
+            except AgentError as e:
+                self.__drop_agent(e)
+        try:
+            store = self.__get_license_store()
+            if store is not None:
+                store.delete(card_key, self.__current_user_identifier)
+        except Exception as e:
+            print(f"删除授权记录失败: {e}")
+        try:
+            if self.__can_overwrite_verification_file():
+                self.__writer.remove()
+                self.__update_verification_cache(None, None)
+        except OSError as e:
+            print(f"删除验证文件失败: {e}")
+        return failure
+    
     def __heartbeat_worker(self):
         """心跳检测工作线程"""
         self.__heartbeat_lock.acquire()
         
         try:
             while not self.__is_stop_heartbeat and self.__is_login:
-                # 检查本地验证是否仍然有效
-                is_valid, data = self.__is_verified()
+                # 检查本地验证是否仍然有效；验证文件暂时无法读取时本次不判断，等待一个心跳周期后再检查
+                try:
+                    is_valid, data = self.__is_verified()
+                except FileLockTimeout as e:
+                    print(f"验证文件暂时无法读取: {e}")
+                    is_valid, data = True, None
                 
+                failure = None
                 if not is_valid:
-                    # 本地验证失效，触发心跳失败回调
+                    # 本地验证失效
+                    failure = KamiHeartbeatFailure()
+                    failure.错误编码 = 6003  # 卡密到期
+                    failure.错误消息 = "卡密已过期或无效"
+                elif data is not None and self.__revalidate_enabled and \
+                        time.time() - self.__get_validated_at(data) >= self.__stale_after:
+                    # 本地记录已超过复验窗口，向服务器复验
+                    failure = self.__revalidate(data)
+                    if failure is None:
+                        try:
+                            is_valid, data = self.__is_verified()
+                        except FileLockTimeout as e:
+                            print(f"验证文件暂时无法读取: {e}")
+                
+                if failure is not None:
+                    # 触发心跳失败回调
                     if self.__heartbeat_callback:
-                        failure = KamiHeartbeatFailure()
-                        failure.错误编码 = 6003  # 卡密到期
-                        failure.错误消息 = "卡密已过期或无效"
-                        
                         try:
                             self.__heartbeat_callback(failure)
                         except Exception as e:
@@ -429,16 +3011,26 @@ class KamiSDK(Singleton):
                 
                 print("心跳检测正常...")
                 
-                # 等待5分钟
-                for _ in range(300):  # 5分钟 = 300秒
-                    if self.__is_stop_heartbeat:
-                        break
-                    time.sleep(1)
+                # 休眠到检查间隔、卡密到期时刻或下次复验时刻（取最早者），退出登录等事件会提前唤醒
+                wait_seconds = self.__heartbeat_interval
+                expires_at = get_record_expires_at(data)
+                if expires_at is not None:
+                    wait_seconds = min(wait_seconds, max(0.0, expires_at - time.time()))
+                if self.__revalidate_enabled and data:
+                    # 复验失败（离线）时至少间隔一个心跳周期再试
+                    stale_at = self.__get_validated_at(data) + self.__stale_after
+                    if stale_at > time.time():
+                        wait_seconds = min(wait_seconds, stale_at - time.time())
+                self.__next_heartbeat_time = time.time() + wait_seconds
+                
+                self.__heartbeat_event.wait(wait_seconds)
+                self.__heartbeat_event.clear()
         
         except Exception as e:
             print(f"心跳检测异常: {e}")
         
         finally:
+            self.__next_heartbeat_time = None
             print("心跳检测已停止")
             self.__heartbeat_lock.release()
     
@@ -460,6 +3052,7 @@ class KamiSDK(Singleton):
         
         return result
     
+    @timed_stage('sdk.login')
     def 单码登录函数(self, card_key: str, user_identifier: str = '') -> KamiLoginResult:
         """卡密登录"""
         self.__login_lock.acquire()
@@ -489,6 +3082,7 @@ class KamiSDK(Singleton):
                     # 使用本地数据登录
                     self.__is_login = True
                     self.__current_login_key = card_key
+                    self.__current_user_identifier = user_identifier
                     self.__login_data = local_data.get('data', {})
                     
                     result.错误编码 = 0
@@ -503,8 +3097,9 @@ class KamiSDK(Singleton):
                         local_data['data']['key'] = card_key
                         self.__save_verification_data({
                             'success': True,
-                            'data': local_data['data']
-                        })
+                            'data': local_data['data'],
+                            'token': local_data.get('token')
+                        }, self.__get_validated_at(local_data), user_identifier)
                         print(f"更新本地验证卡密: {card_key}")
                     
                     # 启动心跳检测
@@ -515,6 +3110,26 @@ class KamiSDK(Singleton):
                 else:
                     print(f"卡密不匹配，本地验证卡密: {verified_key}, 输入卡密: {card_key}")
             
+            # 授权库中有这个卡密的有效记录时直接切换，不访问网络
+            license_data = self.__activate_license(card_key, user_identifier)
+            if license_data is not None:
+                self.__is_login = True
+                self.__current_login_key = card_key
+                self.__current_user_identifier = user_identifier
+                self.__login_data = license_data.get('data', {})
+                
+                result.错误编码 = 0
+                result.错误消息 = "登录成功（切换到本地已验证的卡密）"
+                result.到期时间 = self.__login_data.get('expiryTime', '')
+                result.卡密类型 = self.__login_data.get('cardType', '')
+                result.剩余点数 = self.__login_data.get('validDays', 0)
+                
+                # 启动心跳检测
+                self.__start_heartbeat()
+                
+                print(f"切换到本地已验证的卡密: {card_key}")
+                return result
+            
             # 在线验证卡密
             print("正在验证卡密...")
             api_result = self.__verify_card_key_api(card_key, user_identifier)
@@ -525,10 +3140,12 @@ class KamiSDK(Singleton):
                 if 'data' in api_result and api_result['data']:
                     api_result['data']['key'] = card_key
                 
-                self.__save_verification_data(api_result)
+                if not api_result.get('saved'):
+                    self.__save_verification_data(api_result, user_identifier=user_identifier, sync=True)
                 
                 self.__is_login = True
                 self.__current_login_key = card_key
+                self.__current_user_identifier = user_identifier
                 self.__login_data = api_result.get('data', {})
                 
                 result.错误编码 = 0
@@ -547,6 +3164,12 @@ class KamiSDK(Singleton):
                 result.错误消息 = api_result.get('message', '卡密验证失败')
                 print(f"卡密验证失败: {result.错误消息}")
         
+        except FileLockTimeout as e:
+            # 其他流程长时间占用验证文件，不联网验证（已激活的卡密会返回"卡密已被使用"）
+            result.错误编码 = -1
+            result.错误消息 = f"验证文件暂时无法读取，请稍后重试: {e}"
+            print(result.错误消息)
+        
         except Exception as e:
             result.错误编码 = -1
             result.错误消息 = f"登录过程出错: {str(e)}"
@@ -563,12 +3186,41 @@ class KamiSDK(Singleton):
             return
         
         self.__is_stop_heartbeat = False
+        self.__heartbeat_event.clear()
         self.__heartbeat_thread = threading.Thread(target=self.__heartbeat_worker)
         self.__heartbeat_thread.daemon = True
         self.__heartbeat_thread.start()
         
         print("心跳检测已启动")
     
+    def 设置心跳间隔(self, seconds: float) -> None:
+        """设置心跳检测间隔（秒），正在运行的心跳立即按新间隔重新计时"""
+        if seconds <= 0:
+            raise ValueError("心跳间隔必须大于0")
+        self.__heartbeat_interval = seconds
+        self.__heartbeat_event.set()
+    
+    def 获取下次心跳时间(self) -> Optional[float]:
+        """获取下次心跳检测的时间戳，心跳未运行时返回None"""
+        return self.__next_heartbeat_time
+    
+    def 设置后台复验(self, enabled: bool = True,
+               stale_after: float = DEFAULT_STALE_AFTER,
+               offline_grace: float = DEFAULT_OFFLINE_GRACE) -> None:
+        """
+        设置后台复验模式
+        
+        开启后本地记录有效时立即登录，本地记录距上次服务器确认超过 stale_after 秒时，
+        由心跳线程在后台向服务器复验；卡密被撤销时通过心跳失败回调通知。
+        无法连接服务器时，距上次确认 offline_grace 秒以内继续使用本地记录。
+        """
+        if stale_after <= 0 or offline_grace < 0:
+            raise ValueError("复验窗口必须大于0，离线宽限期不能为负数")
+        self.__revalidate_enabled = enabled
+        self.__stale_after = stale_after
+        self.__offline_grace = offline_grace
+        self.__heartbeat_event.set()
+    
     def 退出登录函数(self) -> Result:
         """退出登录"""
         result = Result()
@@ -579,8 +3231,9 @@ class KamiSDK(Singleton):
                 result.msg = "未登录状态"
                 return result
             
-            # 停止心跳检测
+            # 停止心跳检测，唤醒正在休眠的心跳线程
             self.__is_stop_heartbeat = True
+            self.__heartbeat_event.set()
             if self.__heartbeat_thread and self.__heartbeat_thread.is_alive():
                 print("等待心跳线程结束...")
                 self.__heartbeat_thread.join(timeout=5)
@@ -588,8 +3241,12 @@ class KamiSDK(Singleton):
             # 清理登录状态
             self.__is_login = False
             self.__current_login_key = ""
+            self.__current_user_identifier = ""
             self.__login_data = None
             
+            # 清零缓存的派生密钥
+            KamiEncryption.clear_key_cache()
+            
             result.code = 0
             result.msg = "退出登录成功"
             
@@ -601,6 +3258,29 @@ class KamiSDK(Singleton):
         
         return result
     
+    def 获取网络统计(self) -> Dict[str, Any]:
+        """获取验证请求的次数、错误数和耗时统计"""
+        return get_transport().get_stats()
+    
+    def 清除失败缓存(self) -> int:
+        """清除被拒绝卡密的本地缓存，返回清除的条目数"""
+        return get_transport().negative_cache.clear()
+    
+    def 获取熔断状态(self) -> Dict[str, Any]:
+        """
+        获取验证API熔断器的状态
+        state 为 open 时验证请求会直接失败，流程可以改用本地验证
+        """
+        return get_transport().get_breaker_state()
+    
+    def 验证服务是否可用(self) -> bool:
+        """熔断器未打开时返回True"""
+        return get_transport().breaker.state != CIRCUIT_OPEN
+    
+    def 设置加密参数(self, kdf: KdfParams) -> None:
+        """设置保存验证文件时使用的密钥派生参数，已有文件在下次保存时自动升级"""
+        self.__encryption = KamiEncryption(kdf=kdf)
+    
     def 检查登录状态(self) -> bool:
         """检查是否已登录"""
         return self.__is_login
@@ -644,37 +3324,9 @@ class KamiSDK(Singleton):
                 result.剩余点数 = card_data.get('validDays', 0)
                 
                 # 计算实际剩余天数
-                if result.到期时间:
-                    try:
-                        # 使用相同的日期解析逻辑
-                        expiry = None
-                        expiry_time = result.到期时间
-                        
-                        # 尝试多种格式
-                        try:
-                            expiry = datetime.datetime.fromisoformat(expiry_time)
-                        except ValueError:
-                            try:
-                                if expiry_time.endswith('Z'):
-                                    expiry_time = expiry_time[:-1]
-                                expiry = datetime.datetime.fromisoformat(expiry_time)
-                            except ValueError:
-                                try:
-                                    expiry = datetime.datetime.strptime(expiry_time, '%Y-%m-%d %H:%M:%S')
-                                except ValueError:
-                                    try:
-                                        expiry = datetime.datetime.strptime(expiry_time[:10], '%Y-%m-%d')
-                                    except ValueError:
-                                        pass
-                        
-                        if expiry:
-                            now = datetime.datetime.now()
-                            days_left = (expiry - now).days
-                            result.剩余天数 = max(0, days_left)
-                        
-                    except Exception as e:
-                        print(f"计算剩余天数时出错: {e}")
-                        result.剩余天数 = 0
+                expires_at = get_record_expires_at(data)
+                if expires_at is not None:
+                    result.剩余天数 = max(0, int((expires_at - time.time()) // 86400))
                 
                 print(f"发现有效的本地验证: {result.卡密}, 类型: {result.卡密类型}, 剩余: {result.剩余天数}天")
             else:
@@ -731,8 +3383,29 @@ class KamiSDK(Singleton):
         
         return result
 
-# 全局SDK实例
-kami_sdk = KamiSDK()
+# 全局SDK实例，第一次使用时才创建（创建时会采集硬件信息）
+_kami_sdk: Optional[KamiSDK] = None
+_kami_sdk_lock = threading.Lock()
+
+def get_kami_sdk() -> KamiSDK:
+    """获取全局SDK实例"""
+    global _kami_sdk
+    if _kami_sdk is None:
+        with _kami_sdk_lock:
+            if _kami_sdk is None:
+                _kami_sdk = KamiSDK()
+    return _kami_sdk
+
+class _LazyKamiSDK:
+    """kami_sdk 的占位对象，访问任何属性时创建并转发给真正的SDK实例"""
+    
+    def __getattr__(self, name):
+        return getattr(get_kami_sdk(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(get_kami_sdk(), name, value)
+
+kami_sdk = _LazyKamiSDK()
 
 # 心跳失败回调函数
 def 接收心跳失败的函数(failure: KamiHeartbeatFailure):
@@ -747,6 +3420,8 @@ def 接收心跳失败的函数(failure: KamiHeartbeatFailure):
         print("卡密已被禁用")
     elif failure.错误编码 == 6004:  # 卡密点数不足
         print("卡密点数不足")
+    elif failure.错误编码 == 6006:  # 离线超过宽限期
+        print("长时间无法连接验证服务器，请检查网络")
     
     # 强制关闭软件
     kami_sdk.关闭当前软件()
@@ -829,6 +3504,77 @@ def 获取登录信息() -> str:
     else:
         return "未登录"
 
+# 设置心跳间隔
+def 设置心跳间隔(秒: float):
+    """设置心跳检测间隔（秒）"""
+    kami_sdk.设置心跳间隔(秒)
+
+# 列出本机授权库中的卡密
+def 获取授权列表() -> List[Dict[str, Any]]:
+    """列出授权库中本机的记录，卡密只显示摘要"""
+    return kami_sdk.获取授权列表()
+
+# 清理过期授权
+def 清理过期授权() -> int:
+    """删除授权库中已过期的记录，返回删除的条数"""
+    return kami_sdk.清理过期授权()
+
+# 设置多卡密模式
+def 设置多卡密模式(启用: bool = True):
+    """开启后每次验证成功都记入授权库，默认只在第一次换用其他卡密后才创建授权库"""
+    kami_sdk.设置多卡密模式(启用)
+
+# 设置验证文件监控
+def 设置文件监控(启用: bool = True) -> Optional[str]:
+    """设置是否监控验证文件，其他流程修改或清理验证文件后立即生效，返回使用的监控方式"""
+    return kami_sdk.设置文件监控(启用)
+
+# 设置耗时统计
+def 设置耗时统计(启用: bool = True, 慢操作阈值秒: Optional[float] = None, 慢操作回调=None):
+    """
+    开启或关闭各阶段耗时统计（默认关闭）
+    慢操作回调(阶段, 耗时秒) 在单次耗时达到阈值（默认1秒）时调用
+    """
+    enable_timings(启用, 慢操作阈值秒, 慢操作回调)
+
+# 获取耗时统计
+def 获取耗时统计() -> Dict[str, Dict[str, Any]]:
+    """按阶段获取次数、总耗时、平均、最大耗时（秒）和耗时直方图"""
+    return get_stats()
+
+# 设置授权代理
+def 设置授权代理(启用: bool = True):
+    """设置是否使用本地授权代理，关闭后总是在本流程内验证"""
+    kami_sdk.设置授权代理(启用)
+
+# 设置后台复验
+def 设置后台复验(启用: bool = True, 复验窗口秒: float = DEFAULT_STALE_AFTER, 离线宽限秒: float = DEFAULT_OFFLINE_GRACE):
+    """本地记录有效时立即登录，超过复验窗口后在后台向服务器复验"""
+    kami_sdk.设置后台复验(启用, 复验窗口秒, 离线宽限秒)
+
+# 获取下次心跳时间
+def 获取下次心跳时间() -> str:
+    """获取下次心跳检测的时间"""
+    next_time = kami_sdk.获取下次心跳时间()
+    if next_time is None:
+        return "心跳未运行"
+    return datetime.datetime.fromtimestamp(next_time).strftime('%Y-%m-%d %H:%M:%S')
+
+# 清除被拒绝卡密的本地缓存
+def 清除失败缓存() -> int:
+    """清除被拒绝卡密的本地缓存，返回清除的条目数"""
+    return kami_sdk.清除失败缓存()
+
+# 获取验证API熔断状态
+def 获取熔断状态() -> Dict[str, Any]:
+    """获取验证API熔断器的状态（closed/open/half_open）"""
+    return kami_sdk.获取熔断状态()
+
+# 验证服务是否可用，不可用时可直接走本地验证
+def 验证服务是否可用() -> bool:
+    """验证API熔断器未打开时返回True"""
+    return kami_sdk.验证服务是否可用()
+
 # 退出登录
 def 退出():
     """退出登录"""
@@ -859,6 +3605,16 @@ def 调试验证文件() -> str:
         except Exception as e:
             return result + f"读取文件失败: {e}"
         
+        # 检查文件格式
+        try:
+            header, _ = KamiEncryption.unpack(encrypted_data)
+            if header:
+                result += f"文件格式: v{header.get('version')}，密钥派生: {header.get('kdf')}\n"
+            else:
+                result += "文件格式: 旧版（无文件头），下次保存时自动升级\n"
+        except Exception as e:
+            result += f"文件头解析失败: {e}\n"
+        
         # 尝试解密
         try:
             encryption = KamiEncryption()
@@ -887,23 +3643,19 @@ def 调试验证文件() -> str:
                 if expiry_time:
                     result += f"原始过期时间: {expiry_time}\n"
                     
-                    # 尝试解析日期
-                    try:
-                        if expiry_time.endswith('Z'):
-                            expiry_time_clean = expiry_time[:-1]
-                            expiry = datetime.datetime.fromisoformat(expiry_time_clean)
-                        else:
-                            expiry = datetime.datetime.fromisoformat(expiry_time)
-                        
+                    # 解析日期
+                    expires_at = get_record_expires_at(decrypted_data)
+                    if expires_at is not None:
+                        expiry = datetime.datetime.fromtimestamp(expires_at)
                         now = datetime.datetime.now()
-                        days_left = (expiry - now).days
+                        days_left = int((expires_at - time.time()) // 86400)
                         result += f"解析后过期时间: {expiry}\n"
+                        result += f"过期时间戳: {decrypted_data.get('expires_at', '未记录')}\n"
                         result += f"当前时间: {now}\n"
                         result += f"剩余天数: {days_left}\n"
-                        result += f"是否有效: {days_left > 0}\n"
-                        
-                    except Exception as date_error:
-                        result += f"日期解析失败: {date_error}\n"
+                        result += f"是否有效: {expires_at > time.time()}\n"
+                    else:
+                        result += f"日期解析失败: {expiry_time}\n"
                 else:
                     result += "没有过期时间信息\n"
                     
@@ -922,9 +3674,9 @@ def 调试验证文件() -> str:
 def 清理验证文件() -> str:
     """清理损坏的验证文件"""
     try:
-        verification_file = DEFAULT_VERIFICATION_FILE
-        if os.path.exists(verification_file):
-            os.remove(verification_file)
+        writer = get_file_writer(DEFAULT_VERIFICATION_FILE)
+        if os.path.exists(writer.path) or os.path.exists(writer.backup_path) or writer.pending() is not None:
+            writer.remove()
             return "验证文件已删除，下次使用时需要重新验证卡密"
         else:
             return "验证文件不存在"